@@ -0,0 +1,270 @@
+"""
+answer_cache.py - Persistent Per-Paper Answer Cache
+
+Researchers often re-ask the same question over (mostly) the same papers. This module
+stores each paper's RAG result (answer, classified context and evaluation) in a SQLite
+database, so a repeated question is answered without retrieval or an LLM call.
+
+An entry is keyed by:
+- the paper's version: the PDF content hash plus the fingerprints of its vectorstore and
+  extracted table/figure files, so re-processing a paper invalidates its entries,
+- the normalized question and the canonical answer structure (ans_format),
+- the answer model/deployment, the RAG prompt version and the retrieval settings,
+- the requested evaluation metrics and, with metrics, the evaluation and scoring modes.
+
+The answer structure (ans_format) designed for a question is cached as well, in memory
+(LRU) and optionally in the same database, so a repeated question skips that LLM call.
+
+Main Components:
+- AnswerCache: SQLite-backed get/put of per-paper results.
+- AnswerStructureCache: LRU (plus optional SQLite) cache of answer structures per normalized question.
+- paper_version: Version string of a paper's PDF and derived files.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import globalVariable as GV
+    import utils
+    from corpus_index import paper_fingerprint
+except:
+    import app.dataService.globalVariable as GV
+    import app.dataService.utils as utils
+    from app.dataService.corpus_index import paper_fingerprint
+
+
+def _file_stat_(path: str):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def paper_version(pdf_file: str):
+    """
+    Version of a paper: hash of the PDF content plus fingerprints of its vectorstore and
+    table/figure files. Returns None if the PDF does not exist.
+    """
+    pdf_path = os.path.join(GV.data_dir, pdf_file)
+    content_hash = utils.file_content_hash(pdf_path)
+    if content_hash is None:
+        return None
+    pdf_name = pdf_file.split(".")[0]
+    payload = json.dumps({
+        "pdf": content_hash,
+        "vectorstore": paper_fingerprint(GV.vectorstore_dir, pdf_file),
+        "tables": _file_stat_(os.path.join(GV.table_dir, pdf_name + ".json")),
+        "figures": _file_stat_(os.path.join(GV.figure_dir, pdf_name + ".json")),
+    })
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+def canonical_ans_format(ans_format: str) -> str:
+    try:
+        return json.dumps(json.loads(ans_format), sort_keys=True)
+    except (TypeError, ValueError):
+        return ans_format
+
+
+class AnswerCache(object):
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY,"
+                " pdf_file TEXT NOT NULL,"
+                " paper_version TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS answers_pdf_file ON answers (pdf_file)")
+            self.conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, pdf_file: str, question: str, ans_format: str, evaluation_metrics = None):
+        """
+        Cache key of a paper's result, or None if the paper cannot be versioned (missing PDF).
+
+        Returns:
+            tuple: (key, paper_version) or None.
+        """
+        version = paper_version(pdf_file)
+        if version is None:
+            return None
+        payload = json.dumps({
+            "pdf_file": pdf_file,
+            "paper_version": version,
+            "question": normalize_question(question),
+            "ans_format": canonical_ans_format(ans_format),
+            "deployment": GV.azure_openai_deployment,
+            "model": utils.RAG_ANSWER_MODEL,
+            "prompt_version": utils.RAG_PROMPT_VERSION,
+            "retrieval": {
+                "corpus_index": GV.use_corpus_index,
+                "k": GV.corpus_index_k if GV.use_corpus_index else None,
+                "context_max_tokens": GV.context_max_tokens if GV.use_context_packing else None,
+            },
+            "evaluation_metrics": sorted(evaluation_metrics) if evaluation_metrics else None,
+            # embedding proxies are not judge scores, and background mode caches an eval_id instead of scores
+            "evaluation": {
+                "mode": GV.evaluation_mode,
+                "scoring_mode": GV.evaluation_scoring_mode,
+            } if evaluation_metrics else None,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest(), version
+
+    def get_many(self, keys: dict) -> dict:
+        """
+        Look up several papers at once.
+
+        Args:
+            keys (dict): pdf_file -> (key, paper_version) as returned by make_key.
+
+        Returns:
+            dict: pdf_file -> cached result ({pdf_file: {"answer", "context", "evaluation"}}).
+        """
+        by_key = {key[0]: pdf_file for pdf_file, key in keys.items() if key is not None}
+        found = {}
+        if by_key:
+            placeholders = ",".join("?" * len(by_key))
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM answers WHERE key IN ({placeholders})", list(by_key)).fetchall()
+            for key, value in rows:
+                found[by_key[key]] = json.loads(value)
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, pdf_file: str, key: tuple, data: dict):
+        """
+        Store a paper's result and drop the entries of its older versions.
+        """
+        if key is None or data is None:
+            return
+        key, version = key
+        with self.lock:
+            self.conn.execute("DELETE FROM answers WHERE pdf_file = ? AND paper_version != ?", (pdf_file, version))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO answers (key, pdf_file, paper_version, value, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, pdf_file, version, json.dumps(data), time.time()))
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            requests = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else None,
+            }
+
+
+class AnswerStructureCache(object):
+    def __init__(self, max_entries: int = 1024, path: str = None, prompt_version: int = 1):
+        """
+        Args:
+            max_entries (int, optional): Capacity of the in-memory LRU.
+            path (str, optional): SQLite database file for persistence across restarts. None keeps
+                the cache in memory only.
+            prompt_version (int, optional): Version of the answer-structure prompt; part of the key.
+        """
+        self.max_entries = max_entries
+        self.prompt_version = prompt_version
+        self.entries = OrderedDict()  # key -> ans_format, least recently used first
+        self.lock = threading.Lock()
+        self.conn = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.lock:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS answer_structures ("
+                    " key TEXT PRIMARY KEY,"
+                    " question TEXT NOT NULL,"
+                    " ans_format TEXT NOT NULL,"
+                    " created_at REAL NOT NULL)"
+                )
+                self.conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, question: str) -> str:
+        payload = json.dumps({
+            "question": normalize_question(question),
+            "deployment": GV.azure_openai_deployment,
+            "prompt_version": self.prompt_version,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, question: str):
+        """
+        Cached answer structure (JSON string) of `question`, or None.
+        """
+        key = self.make_key(question)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            row = None
+            if self.conn is not None:
+                row = self.conn.execute("SELECT ans_format FROM answer_structures WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember_(key, row[0])
+            return row[0]
+
+    def put(self, question: str, ans_format: str):
+        key = self.make_key(question)
+        with self.lock:
+            self._remember_(key, ans_format)
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO answer_structures (key, question, ans_format, created_at) VALUES (?, ?, ?, ?)",
+                    (key, normalize_question(question), ans_format, time.time()))
+                self.conn.commit()
+
+    def _remember_(self, key: str, ans_format: str):
+        self.entries[key] = ans_format
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "resident": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else None,
+            }
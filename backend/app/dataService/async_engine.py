@@ -0,0 +1,92 @@
+"""
+async_engine.py - Shared asyncio Event Loop for the Async RAG Pipeline
+
+The Flask routes are synchronous (served by gevent's WSGIServer), so the async RAG
+pipeline runs on one long-lived event loop in a background thread. Synchronous callers
+submit coroutines to it and wait for their results, or iterate async generators through
+a blocking bridge. Thousands of in-flight LLM requests then share one loop and one OS
+thread instead of one thread each.
+
+Main Components:
+- AsyncEngine: Owns the background loop and the process-wide concurrency semaphore.
+- get_async_engine: Returns the process-wide AsyncEngine.
+"""
+
+import asyncio
+import threading
+
+try:
+    import globalVariable as GV
+except:
+    import app.dataService.globalVariable as GV
+
+
+class AsyncEngine(object):
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop_, name="rag-async-engine", daemon=True)
+        self.thread.start()
+        # the semaphore must be created on the loop that uses it
+        self.semaphore = self.run(self._create_semaphore_())
+
+    def _run_loop_(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _create_semaphore_(self):
+        return asyncio.Semaphore(self.concurrency)
+
+    def run(self, coro):
+        """
+        Run a coroutine on the engine loop and block until it returns.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def cancel_on(self, cancel_event, tasks: list):
+        """
+        Start a watcher task that cancels `tasks` as soon as `cancel_event` (a threading.Event,
+        set from another thread) is set. Must be called on the engine loop; cancel the returned
+        watcher once the tasks are done. Returns None without an event.
+        """
+        if cancel_event is None:
+            return None
+        return asyncio.ensure_future(self._watch_cancel_(cancel_event, tasks))
+
+    async def _watch_cancel_(self, cancel_event, tasks: list, poll_interval: float = 0.05):
+        # a threading.Event cannot be awaited, poll it instead of parking a worker thread on it
+        while not cancel_event.is_set():
+            await asyncio.sleep(poll_interval)
+        for task in tasks:
+            task.cancel()
+
+    def iterate(self, agen):
+        """
+        Consume an async generator from synchronous code, one item at a time.
+
+        Closing the returned generator (e.g. when a streaming client disconnects) closes
+        the async generator on the engine loop, which cancels its pending work.
+        """
+        try:
+            while True:
+                try:
+                    item = self.run(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            self.run(agen.aclose())
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_async_engine() -> AsyncEngine:
+    """
+    Return the process-wide async engine, limited to `qa.async_concurrency` in-flight papers.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine(max(1, GV.qa_async_concurrency))
+        return _engine
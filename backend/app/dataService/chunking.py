@@ -0,0 +1,279 @@
+"""
+chunking.py - Text Chunking for PDF Ingestion
+
+Splits a paper's text into the chunks that are summarized and indexed by preprocess.py.
+Sections are given as (start, end) symbol offsets and excluded ranges (e.g. the
+bibliography) are subtracted from them with sorted-interval arithmetic, so a section is
+assembled from a few slices instead of symbol by symbol.
+
+Two chunkers are available (preprocess.py --chunker):
+- chars: split_into_chunks / preprocess.process_text_chunks, sized in characters (default).
+- tokens: TokenChunker, sized in tokens of the model's tokenizer, so chunks fit the summary
+  and answer prompts predictably whatever the language or table density.
+
+Main Components:
+- merge_intervals: Sort and merge (start, end) ranges.
+- section_spans: The kept (start, end) spans of every section.
+- extract_sections: The text of every section without the excluded ranges.
+- split_into_chunks: Character-sized chunks of the sections (used by the papermage path).
+- TokenChunker: Streaming, section-aware chunker with token targets and overlap.
+"""
+
+import re
+from bisect import bisect_right
+from functools import lru_cache
+
+import tiktoken
+
+
+def merge_intervals(ranges) -> list:
+    """
+    Sort (start, end) ranges and merge overlapping or touching ones; empty ranges are dropped.
+    """
+    merged = []
+    for start, end in sorted((start, end) for start, end in ranges if start < end):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def section_spans(section_boundaries, excluded_ranges) -> list:
+    """
+    Subtract the excluded ranges from every section.
+
+    Args:
+        section_boundaries (list): (start, end) offsets of the sections, in output order.
+        excluded_ranges (list): (start, end) offsets to leave out, in any order; may overlap.
+
+    Returns:
+        list: For every section, the list of its kept (start, end) spans in order.
+    """
+    excluded = merge_intervals(excluded_ranges)
+    excluded_starts = [start for start, _ in excluded]
+    spans = []
+    for start, end in section_boundaries:
+        kept = []
+        position = start
+        # the last excluded range starting at or before `start` may still cover it
+        index = max(bisect_right(excluded_starts, start) - 1, 0)
+        while position < end and index < len(excluded):
+            excluded_start, excluded_end = excluded[index]
+            if excluded_end <= position:
+                index += 1
+                continue
+            if excluded_start >= end:
+                break
+            if excluded_start > position:
+                kept.append((position, excluded_start))
+            position = max(position, excluded_end)
+            index += 1
+        if position < end:
+            kept.append((position, end))
+        spans.append(kept)
+    return spans
+
+
+def extract_sections(text, section_boundaries, excluded_ranges) -> list:
+    """
+    The text of every section with the excluded ranges removed.
+
+    `text` may be a string or a sequence of strings (e.g. symbols).
+    """
+    if isinstance(text, str):
+        return ["".join(text[start:end] for start, end in spans)
+                for spans in section_spans(section_boundaries, excluded_ranges)]
+    return ["".join("".join(text[start:end]) for start, end in spans)
+            for spans in section_spans(section_boundaries, excluded_ranges)]
+
+
+def merge_small_chunks(chunks, combine_text_under_n_chars = 2000) -> list:
+    """
+    Merge chunks smaller than `combine_text_under_n_chars` characters with their neighbors.
+    """
+    merged_chunks = []
+    buffer = []
+    buffer_length = 0
+
+    for chunk in chunks:
+        # a chunk joins the buffer whenever the buffer is still small (whether or not the chunk fits)
+        if buffer_length < combine_text_under_n_chars:
+            buffer.append(chunk)
+            buffer_length += len(chunk)
+        else:  # Otherwise, add the buffer as a separate chunk
+            merged_chunks.append("".join(buffer))
+            buffer = [chunk]
+            buffer_length = len(chunk)
+
+    if buffer_length:  # Add any remaining buffer
+        merged_chunks.append("".join(buffer))
+
+    return merged_chunks
+
+
+def split_into_chunks(text,
+                      section_boundaries,
+                      excluded_ranges,
+                      max_chunk_size = 4000,
+                      target_chars = 3800,
+                      combine_text_under_n_chars = 2000):
+    """
+    Split the sections of a paper into chunks of about `target_chars` characters.
+
+    Every section (with the excluded ranges removed) is cut into windows of up to
+    `max_chunk_size` characters starting every `target_chars` characters; windows not longer
+    than `combine_text_under_n_chars` are dropped unless they reach the section end. Chunks
+    under `combine_text_under_n_chars` are then merged with their neighbors.
+
+    Args:
+        text (str or list): The paper's symbols.
+        section_boundaries (list): (start, end) offsets of the sections.
+        excluded_ranges (list): (start, end) offsets to leave out (e.g. bibliography entries).
+
+    Returns:
+        list: The chunks.
+    """
+    sections = extract_sections(text, section_boundaries, excluded_ranges)
+
+    # Split each section into chunks of approximately target_chars characters
+    chunks = []
+    for section in sections:
+        for i in range(0, len(section), target_chars):
+            chunk = section[i:i + max_chunk_size]  # Ensure chunk is no more than max_chunk_size chars
+            if len(chunk) > combine_text_under_n_chars or (len(chunk) > 0 and i + max_chunk_size >= len(section)):
+                chunks.append(chunk)
+
+    # Merge chunks smaller than 2000 characters
+    return merge_small_chunks(chunks, combine_text_under_n_chars)
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding_name: str = "cl100k_base"):
+    """
+    The shared tiktoken encoder, or None if it cannot be loaded (e.g. the BPE file cannot be
+    downloaded), in which case token counts are estimated from the text length.
+    """
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        print(f"tiktoken encoding {encoding_name} unavailable, estimating token counts: {e}")
+        return None
+
+
+# sentence or line, with its trailing punctuation and whitespace; the units of a section concatenate back to it
+UNIT_PATTERN = re.compile(r"[^.!?\n]*(?:[.!?]+\s*|\n+\s*|$)")
+
+CHARS_PER_TOKEN = 4  # estimate used without a tokenizer
+
+
+class TokenChunker(object):
+    def __init__(self, chunk_tokens: int = 900, overlap_tokens: int = 64, min_tokens: int = None,
+                 respect_sections: bool = True, encoding_name: str = "cl100k_base"):
+        """
+        Args:
+            chunk_tokens (int, optional): Maximum number of tokens per chunk.
+            overlap_tokens (int, optional): Tokens of trailing sentences repeated at the start of
+                the next chunk of the same section.
+            min_tokens (int, optional): With `respect_sections`, a chunk is only closed at a
+                section boundary once it has this many tokens, so short sections are merged with
+                the next one. Defaults to half of `chunk_tokens`.
+            respect_sections (bool, optional): Start a new chunk at section boundaries.
+            encoding_name (str, optional): tiktoken encoding of the downstream models.
+        """
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.chunk_tokens // 2))
+        self.min_tokens = self.chunk_tokens // 2 if min_tokens is None else min_tokens
+        self.respect_sections = respect_sections
+        self.encoding_name = encoding_name
+        self.encoder = get_encoder(encoding_name)
+
+    def __getstate__(self):
+        # sent to parser processes without the encoder, which is loaded again from the local cache there
+        state = self.__dict__.copy()
+        state["encoder"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.encoder = get_encoder(self.encoding_name)
+
+    def settings(self) -> dict:
+        """
+        What the chunks depend on, including whether they were sized with the tokenizer or with
+        the length estimate (e.g. for the vectorstore fingerprint of the ingestion manifest).
+        """
+        return {
+            "chunk_tokens": self.chunk_tokens,
+            "overlap_tokens": self.overlap_tokens,
+            "min_tokens": self.min_tokens,
+            "respect_sections": self.respect_sections,
+            "tokenizer": self.encoding_name if self.encoder is not None else f"{CHARS_PER_TOKEN} chars per token estimate",
+        }
+
+    def count_tokens(self, texts: list) -> list:
+        """
+        Token counts of `texts`, encoded in one batch.
+        """
+        if self.encoder is None:
+            return [(len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN for text in texts]
+        return [len(tokens) for tokens in self.encoder.encode_batch(texts, disallowed_special=())]
+
+    def split_long(self, text: str) -> list:
+        """
+        Split a sentence longer than `chunk_tokens` at token boundaries (with overlap).
+        """
+        step = self.chunk_tokens - self.overlap_tokens
+        if self.encoder is None:
+            size, stride = self.chunk_tokens * CHARS_PER_TOKEN, step * CHARS_PER_TOKEN
+            return [text[i:i + size] for i in range(0, max(len(text) - self.overlap_tokens * CHARS_PER_TOKEN, 1), stride)]
+        tokens = self.encoder.encode(text, disallowed_special=())
+        return [self.encoder.decode(tokens[i:i + self.chunk_tokens])
+                for i in range(0, max(len(tokens) - self.overlap_tokens, 1), step)]
+
+    def iter_chunks(self, sections):
+        """
+        Yield chunks of at most `chunk_tokens` tokens (approximately: counts are summed per
+        sentence) from an iterable of section texts, one section at a time.
+        """
+        units, counts, total = [], [], 0
+
+        def flush():
+            return "".join(units)
+
+        for section in sections:
+            if self.respect_sections and total >= self.min_tokens:
+                yield flush()
+                units, counts, total = [], [], 0
+            section_units = [unit for unit in UNIT_PATTERN.findall(section) if unit]
+            for unit, count in zip(section_units, self.count_tokens(section_units)):
+                if count > self.chunk_tokens:
+                    if units:
+                        yield flush()
+                    pieces = self.split_long(unit)
+                    for piece in pieces[:-1]:
+                        yield piece
+                    units, counts = [pieces[-1]], self.count_tokens(pieces[-1:])
+                    total = counts[0]
+                    continue
+                if total + count > self.chunk_tokens:
+                    yield flush()
+                    # carry the trailing sentences over as overlap, if the new sentence still fits
+                    keep = 0
+                    overlap = 0
+                    while keep < len(units) and overlap + counts[-1 - keep] <= self.overlap_tokens:
+                        overlap += counts[-1 - keep]
+                        keep += 1
+                    if overlap + count > self.chunk_tokens:
+                        keep, overlap = 0, 0
+                    units, counts = (units[-keep:], counts[-keep:]) if keep else ([], [])
+                    total = overlap
+                units.append(unit)
+                counts.append(count)
+                total += count
+        if units:
+            yield flush()
+
+    def chunk(self, sections) -> list:
+        return [chunk for chunk in self.iter_chunks(sections) if chunk.strip()]
@@ -0,0 +1,143 @@
+"""
+chunking_benchmark.py - Equivalence Check and Microbenchmark of split_into_chunks
+
+Compares chunking.split_into_chunks with the original symbol-by-symbol implementation on
+synthetic papers (random sections and bibliography ranges) of 10k to 2M symbols: the
+chunks must be identical, and the run time of both is reported. The original
+implementation is O(symbols x references), so it only runs up to `--reference_max_symbols`.
+
+Usage:
+    python chunking_benchmark.py [--sizes 10000 100000 2000000] [--references 300] [--seed 0]
+"""
+
+import argparse
+import random
+import time
+
+try:
+    from chunking import split_into_chunks
+except:
+    from app.dataService.chunking import split_into_chunks
+
+
+def reference_split_into_chunks(text,
+                                section_boundaries,
+                                excluded_ranges,
+                                max_chunk_size = 4000,
+                                target_chars = 3800,
+                                combine_text_under_n_chars = 2000):
+    # The original implementation, kept verbatim as the reference output
+    def is_excluded(index):
+        for start, end in excluded_ranges:
+            if start <= index < end:
+                return True
+        return False
+
+    def merge_small_chunks(chunks):
+        merged_chunks = []
+        buffer = ""
+
+        for chunk in chunks:
+            if len(buffer) + len(chunk) < combine_text_under_n_chars:
+                buffer += chunk
+            else:
+                if len(buffer) < combine_text_under_n_chars:
+                    buffer += chunk
+                else:
+                    merged_chunks.append(buffer)
+                    buffer = chunk
+
+        if buffer:
+            merged_chunks.append(buffer)
+
+        return merged_chunks
+
+    sections = []
+    for start, end in section_boundaries:
+        section_text = ""
+        for i in range(start, end):
+            if not is_excluded(i):
+                section_text += text[i]
+        sections.append(section_text)
+
+    chunks = []
+    for section in sections:
+        for i in range(0, len(section), target_chars):
+            chunk = section[i:i + max_chunk_size]
+            if len(chunk) > combine_text_under_n_chars or (len(chunk) > 0 and i + max_chunk_size >= len(section)):
+                chunks.append(chunk)
+
+    chunks = merge_small_chunks(chunks)
+
+    return chunks
+
+
+def synthetic_paper(num_symbols: int, num_references: int, rng: random.Random) -> tuple:
+    """
+    Random text with papermage-like section boundaries (consecutive, covering the text) and
+    bibliography ranges clustered near the end, plus a few overlapping or empty ones.
+    """
+    words = ["model", "data", "results", "table", "figure", "training", "loss", "accuracy", "the", "of", "we"]
+    parts = []
+    length = 0
+    while length < num_symbols:
+        word = rng.choice(words) + rng.choice([" ", " ", " ", ". ", ", ", "\n"])
+        parts.append(word)
+        length += len(word)
+    text = "".join(parts)[:num_symbols]
+
+    cuts = sorted(rng.sample(range(1, num_symbols), min(num_symbols - 1, max(1, num_symbols // 5000))))
+    section_idxs = [0] + cuts + [num_symbols]
+    section_boundaries = [(section_idxs[i], section_idxs[i + 1]) for i in range(len(section_idxs) - 1)]
+
+    excluded_ranges = []
+    bibliography_start = int(num_symbols * 0.85)
+    for _ in range(num_references):
+        start = rng.randrange(bibliography_start, num_symbols)
+        excluded_ranges.append((start, min(num_symbols, start + rng.randrange(0, 400))))
+    for _ in range(max(1, num_references // 20)):
+        start = rng.randrange(0, num_symbols)
+        excluded_ranges.append((start, min(num_symbols, start + rng.randrange(0, 200))))
+    rng.shuffle(excluded_ranges)
+    return text, section_boundaries, excluded_ranges
+
+
+def run_benchmark(sizes: list, num_references: int, reference_max_symbols: int, seed: int = 0) -> bool:
+    rng = random.Random(seed)
+    all_equal = True
+    print(f"{'symbols':>10} {'sections':>9} {'excluded':>9} {'chunks':>7} {'interval (s)':>13} {'reference (s)':>14} {'equal':>6}")
+    for size in sizes:
+        text, section_boundaries, excluded_ranges = synthetic_paper(size, num_references, rng)
+
+        time0 = time.perf_counter()
+        chunks = split_into_chunks(text, section_boundaries, excluded_ranges)
+        interval_time = time.perf_counter() - time0
+
+        reference_time, equal = None, None
+        if size <= reference_max_symbols:
+            time0 = time.perf_counter()
+            reference = reference_split_into_chunks(text, section_boundaries, excluded_ranges)
+            reference_time = time.perf_counter() - time0
+            equal = chunks == reference
+            all_equal = all_equal and equal
+        # the symbol-list form used by some papermage versions must give the same chunks
+        if size <= 100000:
+            all_equal = all_equal and split_into_chunks(list(text), section_boundaries, excluded_ranges) == chunks
+
+        print(f"{size:>10} {len(section_boundaries):>9} {len(excluded_ranges):>9} {len(chunks):>7} {interval_time:>13.4f} "
+              f"{reference_time if reference_time is not None else float('nan'):>14.4f} {str(equal):>6}")
+    return all_equal
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark split_into_chunks against the original implementation.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 200000, 500000, 2000000], help='Synthetic paper sizes in symbols.')
+    parser.add_argument('--references', type=int, default=300, help='Number of bibliography ranges per paper.')
+    parser.add_argument('--reference_max_symbols', type=int, default=200000, help='Largest paper the original implementation is run on.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    equivalent = run_benchmark(args.sizes, args.references, args.reference_max_symbols, args.seed)
+    print("identical output" if equivalent else "OUTPUT DIFFERS")
+    if not equivalent:
+        raise SystemExit(1)
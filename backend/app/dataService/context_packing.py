@@ -0,0 +1,168 @@
+"""
+context_packing.py - Token-Budgeted Context Packing for the Answer Prompt
+
+The retriever returns a paper's parent chunks (2-4k characters of text, or whole serialized
+tables) in similarity order. Sending them unchanged makes prompt size, latency and cost vary
+widely per paper. pack_context turns them into the context actually sent to the answer LLM:
+
+1. Chunks whose word shingles are (almost) all contained in a chunk kept before are dropped
+   as duplicates.
+2. Chunks are kept in similarity order while they fit the per-paper token budget.
+3. A table chunk that does not fit is trimmed to the rows sharing the most terms with the
+   question; a text chunk that does not fit is dropped, unless nothing was kept yet, in which
+   case it is truncated to the budget.
+
+Main Components:
+- pack_context: Dedup and trim a paper's chunks to a token budget, returning token statistics.
+"""
+
+import json
+import re
+from functools import lru_cache
+
+try:
+    from rate_limiter import estimate_tokens
+except:
+    from app.dataService.rate_limiter import estimate_tokens
+
+# serialized tables, as written by preprocess: "<name>: <caption>; table content: [<records>]"
+TABLE_CHUNK_PATTERN = re.compile(r"^(?P<header>.*?table content: )(?P<rows>\[.*\])(?P<tail>\s*)$", re.DOTALL)
+
+STOPWORDS = {
+    "the", "and", "for", "are", "was", "were", "what", "which", "who", "whom", "whose", "how", "why",
+    "when", "where", "does", "did", "with", "from", "that", "this", "these", "those", "there", "their",
+    "into", "about", "than", "then", "them", "they", "have", "has", "had", "can", "could", "would",
+    "should", "paper", "papers", "study", "studies", "used", "use", "using",
+}
+
+SHINGLE_SIZE = 5
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    return estimate_tokens(text)
+
+
+def question_terms(question: str) -> set:
+    return set(word for word in re.findall(r"[a-z0-9]+", question.lower())
+               if len(word) > 2 and word not in STOPWORDS)
+
+
+def _shingles_(text: str) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)} if words else set()
+    return set(tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1))
+
+
+def _truncate_(text: str, max_tokens: int) -> str:
+    # binary search on characters keeps this independent of the tokenizer
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def trim_table_chunk(chunk: str, terms: set, max_tokens: int):
+    """
+    Keep the rows of a serialized table that share the most terms with the question,
+    in their original order, within `max_tokens`.
+
+    Returns:
+        tuple or None: (trimmed chunk, kept rows, total rows), or None if the chunk is not a
+            parsable table or not even its header fits.
+    """
+    match = TABLE_CHUNK_PATTERN.match(chunk)
+    if match is None:
+        return None
+    try:
+        rows = json.loads(match.group("rows"))
+    except ValueError:
+        return None
+    if not isinstance(rows, list):
+        return None
+
+    header = match.group("header")
+
+    def render(kept):
+        text = header + json.dumps([rows[i] for i in kept])
+        if len(kept) < len(rows):
+            text += f" ({len(rows) - len(kept)} of {len(rows)} rows omitted)"
+        return text
+
+    def score(index):
+        # column names repeat in every row, so only the values are matched
+        row = rows[index]
+        row_text = json.dumps(list(row.values()) if isinstance(row, dict) else row).lower()
+        return sum(1 for term in terms if term in row_text)
+
+    # rows are budgeted by their own token counts (+1 for the separator), the omission note is reserved up front
+    used = count_tokens(render([])) + 12
+    if used > max_tokens:
+        return None
+    kept = []
+    for index in sorted(range(len(rows)), key=lambda i: (-score(i), i)):
+        row_tokens = count_tokens(json.dumps(rows[index])) + 1
+        if used + row_tokens > max_tokens:
+            continue
+        kept.append(index)
+        used += row_tokens
+    kept.sort()
+    return render(kept), len(kept), len(rows)
+
+
+def pack_context(chunks: list, question: str, max_tokens: int, overlap_threshold: float = 0.8) -> tuple:
+    """
+    Dedup and trim a paper's retrieved chunks to a token budget.
+
+    Args:
+        chunks (list): Parent chunks in similarity order (best first).
+        question (str): The question; its terms rank table rows.
+        max_tokens (int): Token budget of the paper's context.
+        overlap_threshold (float, optional): Fraction of a chunk's shingles already covered by
+            kept chunks from which it counts as a duplicate. Defaults to 0.8.
+
+    Returns:
+        tuple: (packed chunks, stats) where stats holds "chunks_in", "chunks_out",
+            "tokens_in", "tokens_out", "duplicates", "dropped" and "trimmed_tables".
+    """
+    terms = question_terms(question)
+    packed = []
+    seen = set()
+    used = 0
+    stats = {
+        "chunks_in": len(chunks),
+        "tokens_in": sum(count_tokens(str(chunk)) for chunk in chunks),
+        "duplicates": 0,
+        "dropped": 0,
+        "trimmed_tables": 0,
+    }
+    for chunk in chunks:
+        chunk = str(chunk)
+        shingles = _shingles_(chunk)
+        if shingles and len(shingles & seen) >= overlap_threshold * len(shingles):
+            stats["duplicates"] += 1
+            continue
+        tokens = count_tokens(chunk)
+        if used + tokens > max_tokens:
+            remaining = max_tokens - used
+            trimmed = trim_table_chunk(chunk, terms, remaining)
+            if trimmed is not None and trimmed[1] > 0:
+                chunk = trimmed[0]
+                stats["trimmed_tables"] += 1
+            elif not packed and remaining > 0:
+                chunk = _truncate_(chunk, remaining)
+            else:
+                stats["dropped"] += 1
+                continue
+            tokens = count_tokens(chunk)
+        packed.append(chunk)
+        seen |= shingles
+        used += tokens
+    stats["chunks_out"] = len(packed)
+    stats["tokens_out"] = used
+    return packed, stats
@@ -0,0 +1,249 @@
+"""
+corpus_index.py - Corpus-wide Vector Index for RAG Retrieval
+
+This module merges the per-paper vectorstores written by preprocess.py into a single
+FAISS index whose summary vectors are tagged with their source PDF. A question is then
+embedded once and searched once, and the top-k chunks of every selected paper are read
+from the result, instead of running one MultiVectorRetriever per paper.
+
+Papers that are not in the index (added after it was built) or whose vectorstore changed
+since are left out of a search, and DataService retrieves them with their own retriever.
+
+Main Components:
+- CorpusIndex: Builds, persists, loads and searches the merged index.
+
+Usage:
+    python corpus_index.py    # (re)build the corpus index from GV.vectorstore_dir
+"""
+
+import json
+import os
+import pickle
+import time
+from collections import Counter
+
+import numpy as np
+from langchain.storage import InMemoryStore
+from langchain_community.vectorstores import FAISS
+
+try:
+    import globalVariable as GV
+    import utils
+except:
+    import app.dataService.globalVariable as GV
+    import app.dataService.utils as utils
+
+CORPUS_INDEX_DIRNAME = "_corpus_index"
+
+
+def paper_vectorstore_paths(vectorstore_dir: str, pdf_file: str) -> tuple:
+    """
+    Paths of the vector index folder and docstore pickle of one paper, as written by preprocess.py.
+    """
+    pdf_name = pdf_file.split(".")[0]
+    vectorstore_path = os.path.join(vectorstore_dir, pdf_name, "vector_index")
+    db_path = os.path.join(vectorstore_dir, pdf_name, pdf_name + ".pickle")
+    return vectorstore_path, db_path
+
+
+def paper_fingerprint(vectorstore_dir: str, pdf_file: str):
+    """
+    Cheap fingerprint (size and mtime of the saved files) used to detect changed vectorstores.
+    Returns None if the paper has no vectorstore.
+    """
+    vectorstore_path, db_path = paper_vectorstore_paths(vectorstore_dir, pdf_file)
+    fingerprint = []
+    for path in [os.path.join(vectorstore_path, "index.faiss"), os.path.join(vectorstore_path, "index.pkl"), db_path]:
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        fingerprint.append([stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+class CorpusIndex(object):
+    def __init__(self, vectorstore, docstore, fingerprints: dict, id_key: str = "doc_id", vectorstore_dir: str = None):
+        """
+        Args:
+            vectorstore (FAISS): Merged index of all summary vectors; each document's metadata
+                holds its `id_key` and the source "pdf_file".
+            docstore (InMemoryStore): Merged parent chunks of all papers, keyed by `id_key`.
+            fingerprints (dict): pdf_file -> fingerprint of the per-paper files it was built from.
+            vectorstore_dir (str, optional): Folder of the per-paper vectorstores; if given,
+                papers whose vectorstore changed since the index was built are not searched.
+        """
+        self.vectorstore = vectorstore
+        self.docstore = docstore
+        self.fingerprints = fingerprints
+        self.id_key = id_key
+        self.vectorstore_dir = vectorstore_dir
+
+        # row of the FAISS index -> (pdf_file, doc_id), so a search needs no docstore lookups
+        self.row_pdf_file = []
+        self.row_doc_id = []
+        for row in range(len(vectorstore.index_to_docstore_id)):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[row])
+            self.row_pdf_file.append(doc.metadata.get("pdf_file"))
+            self.row_doc_id.append(doc.metadata.get(id_key))
+        self.paper_rows = Counter(self.row_pdf_file)  # pdf_file -> number of summary vectors
+
+    def __contains__(self, pdf_file):
+        return pdf_file in self.fingerprints
+
+    def is_current(self, pdf_file: str) -> bool:
+        """
+        Whether the index holds the paper's current vectorstore.
+        """
+        if pdf_file not in self.fingerprints:
+            return False
+        if self.vectorstore_dir is None:
+            return True
+        return paper_fingerprint(self.vectorstore_dir, pdf_file) == self.fingerprints[pdf_file]
+
+    @classmethod
+    def build(cls, vectorstore_dir: str, pdf_files: list, id_key: str = "doc_id"):
+        """
+        Merge the per-paper vector indexes and docstores of `pdf_files` into one index.
+        Papers without a saved vectorstore are skipped.
+        """
+        merged_vectorstore = None
+        merged_docstore = InMemoryStore()
+        fingerprints = {}
+        for pdf_file in pdf_files:
+            fingerprint = paper_fingerprint(vectorstore_dir, pdf_file)
+            if fingerprint is None:
+                continue
+            vectorstore_path, db_path = paper_vectorstore_paths(vectorstore_dir, pdf_file)
+            try:
+                vectorstore, docstore, _ = utils.load_local_document_vector_store(
+                    vectorstore_path, db_path, embedding_model=utils.get_embedding_model())
+            except Exception as e:
+                print(f"Failed to add {pdf_file} to the corpus index: {e}")
+                continue
+            for doc in vectorstore.docstore._dict.values():
+                doc.metadata["pdf_file"] = pdf_file
+            if merged_vectorstore is None:
+                merged_vectorstore = vectorstore
+            else:
+                merged_vectorstore.merge_from(vectorstore)
+            merged_docstore.mset(list(docstore.store.items()))
+            fingerprints[pdf_file] = fingerprint
+        if merged_vectorstore is None:
+            return None
+        return cls(merged_vectorstore, merged_docstore, fingerprints, id_key=id_key, vectorstore_dir=vectorstore_dir)
+
+    def save(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        self.vectorstore.save_local(os.path.join(index_dir, "vector_index"))
+        with open(os.path.join(index_dir, "docstore.pickle"), "wb") as f:
+            pickle.dump(self.docstore, f)
+        with open(os.path.join(index_dir, "manifest.json"), "w") as f:
+            json.dump({"id_key": self.id_key, "fingerprints": self.fingerprints}, f)
+
+    @classmethod
+    def load(cls, index_dir: str):
+        with open(os.path.join(index_dir, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        vectorstore, docstore, _ = utils.load_local_document_vector_store(
+            os.path.join(index_dir, "vector_index"),
+            os.path.join(index_dir, "docstore.pickle"),
+            embedding_model=utils.get_embedding_model(),
+        )
+        return cls(vectorstore, docstore, manifest["fingerprints"], id_key=manifest["id_key"])
+
+    @classmethod
+    def load_or_build(cls, vectorstore_dir: str, pdf_files: list, id_key: str = "doc_id"):
+        """
+        Load the persisted corpus index if it matches the current per-paper vectorstores,
+        otherwise rebuild and persist it.
+        """
+        index_dir = os.path.join(vectorstore_dir, CORPUS_INDEX_DIRNAME)
+        current = {}
+        for pdf_file in pdf_files:
+            fingerprint = paper_fingerprint(vectorstore_dir, pdf_file)
+            if fingerprint is not None:
+                current[pdf_file] = fingerprint
+        if os.path.exists(os.path.join(index_dir, "manifest.json")):
+            try:
+                corpus_index = cls.load(index_dir)
+                if corpus_index.fingerprints == current:
+                    corpus_index.vectorstore_dir = vectorstore_dir
+                    return corpus_index
+                print("corpus index is stale, rebuilding...")
+            except Exception as e:
+                print(f"Failed to load the corpus index, rebuilding: {e}")
+        time0 = time.time()
+        corpus_index = cls.build(vectorstore_dir, sorted(current), id_key=id_key)
+        if corpus_index is not None:
+            corpus_index.save(index_dir)
+            print(f"built corpus index over {len(corpus_index.fingerprints)} papers in {time.time() - time0:.1f} seconds")
+        return corpus_index
+
+    def search(self, query_vector, pdf_files: list, k: int = 4, return_relevance: bool = False):
+        """
+        Return the parent chunks of the top-k summary vectors of every selected paper.
+
+        Mirrors MultiVectorRetriever: the k nearest summaries of a paper are mapped to their
+        (deduplicated) parent chunks in similarity order.
+
+        Args:
+            query_vector (list): Embedding of the question.
+            pdf_files (list): Selected PDF filenames; papers missing from the index or changed
+                since it was built are left out.
+            k (int, optional): Number of summary vectors per paper. Defaults to 4.
+            return_relevance (bool, optional): Also return every paper's best relevance
+                (see utils.relevance_from_score). Defaults to False.
+
+        Returns:
+            dict: pdf_file -> list of parent chunks, or (that dict, pdf_file -> relevance)
+                with `return_relevance`.
+        """
+        selected = set(pdf_file for pdf_file in pdf_files if self.is_current(pdf_file))
+        if not selected:
+            return ({}, {}) if return_relevance else {}
+        index = self.vectorstore.index
+        query = np.array([query_vector], dtype=np.float32)
+        needed = {pdf_file: min(k, self.paper_rows[pdf_file]) for pdf_file in selected}
+        # search the nearest rows only, and widen the search while a selected paper has fewer
+        # than k of its summaries among them (rows of unselected papers are interleaved)
+        fetch = min(index.ntotal, max(4 * k * len(selected), 64))
+        while True:
+            scores, rows = index.search(query, fetch)
+            doc_ids, relevance = self._collect_rows_(scores[0], rows[0], selected, k)
+            if fetch >= index.ntotal or all(len(doc_ids[pdf_file]) >= needed[pdf_file] for pdf_file in selected):
+                break
+            fetch = min(index.ntotal, fetch * 4)
+        contexts = {pdf_file: utils.collect_parent_documents(self.docstore, ids) for pdf_file, ids in doc_ids.items()}
+        if return_relevance:
+            return contexts, relevance
+        return contexts
+
+    def _collect_rows_(self, scores, rows, selected: set, k: int) -> tuple:
+        # the first k doc ids of every selected paper, and its best relevance, from rows ranked best first
+        doc_ids = {pdf_file: [] for pdf_file in selected}
+        relevance = {}
+        remaining = len(selected)
+        for score, row in zip(scores, rows):
+            if row < 0:
+                break
+            pdf_file = self.row_pdf_file[row]
+            if pdf_file not in selected or len(doc_ids[pdf_file]) >= k:
+                continue
+            if not doc_ids[pdf_file]:
+                # rows come best first, so a paper's first row is its best summary
+                relevance[pdf_file] = utils.relevance_from_score(self.vectorstore, score)
+            doc_ids[pdf_file].append(self.row_doc_id[row])
+            if len(doc_ids[pdf_file]) == k:
+                remaining -= 1
+                if remaining == 0:
+                    break
+        return doc_ids, relevance
+
+
+if __name__ == "__main__":
+    pdf_files = [pf for pf in os.listdir(GV.data_dir) if pf.endswith(".pdf")]
+    corpus_index = CorpusIndex.load_or_build(GV.vectorstore_dir, pdf_files)
+    if corpus_index is None:
+        print("No vectorstores found.")
+    else:
+        print(f"corpus index covers {len(corpus_index.fingerprints)} papers")
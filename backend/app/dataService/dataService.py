@@ -13,25 +13,31 @@ DataService Class:
 
 Main methods of DataService class:
 - __init__: Initialize the DataService, loading necessary vector stores
-- _load_vectorstores_: Load or create vector stores for document retrieval
+- _load_vectorstores_: Load or create vector stores for document retrieval (eagerly or lazily)
 - run_rag_qa: Execute RAG-based question answering on multiple PDF files
+- arun_rag_qa: asyncio-native variant of run_rag_qa (used when `qa.engine` is "async")
+- stream_rag_qa: Same as run_rag_qa, but yields each paper's result as soon as it completes
 - process_rag_retriever: Process a single retriever for RAG-based QA
+- aprocess_rag_retriever: Async variant of process_rag_retriever
 
 Main Components:
 - DataService class: The core class that orchestrates the RAG process.
 - Vector Store Loading: Efficient loading and management of precomputed vector stores.
 - RAG Chain: Implementation of the Retrieval Augmented Generation chain for question answering.
-- Parallel Batch Processing: Efficient handling of multiple PDF files concurrently.
+- Parallel Processing: Multiple PDF files are processed concurrently on a worker pool shared by all requests.
+- Answer Cache: Per-paper results of repeated questions are served from a persistent cache (answer_cache.py).
 """
 
 import os
 import sys
 import json
+import asyncio
 import numpy as np
 import pandas as pd
 import pickle
 import uuid
 import re
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain_core.output_parsers import StrOutputParser
@@ -46,13 +52,39 @@ try:
     import utils
     import preprocess as preprocess
     import llm_eval as llmeval    
+    from qa_jobs import QAJobManager
+    from retriever_cache import RetrieverCache
+    from corpus_index import CorpusIndex
+    from scheduler import get_scheduler
+    from async_engine import get_async_engine
+    from answer_cache import AnswerCache, AnswerStructureCache
+    from paper_artifacts import get_paper_artifacts, register_chunk_annotations, drop_paper_artifacts
+    from context_packing import pack_context
+    from result_store import ResultStore
+    from evaluation_queue import EvaluationQueue
 except:
     import app.dataService.globalVariable as GV
     import app.dataService.utils as utils
     import app.dataService.llm_eval as llmeval
     import app.dataService.preprocess as preprocess
+    from app.dataService.qa_jobs import QAJobManager
+    from app.dataService.retriever_cache import RetrieverCache
+    from app.dataService.corpus_index import CorpusIndex
+    from app.dataService.scheduler import get_scheduler
+    from app.dataService.async_engine import get_async_engine
+    from app.dataService.answer_cache import AnswerCache, AnswerStructureCache
+    from app.dataService.paper_artifacts import get_paper_artifacts, register_chunk_annotations, drop_paper_artifacts
+    from app.dataService.context_packing import pack_context
+    from app.dataService.result_store import ResultStore
+    from app.dataService.evaluation_queue import EvaluationQueue
 
 ans_key = "answer_structure"
+# bump whenever the answer structure prompt changes, so cached structures are not reused
+ANSWER_STRUCTURE_PROMPT_VERSION = 1
+# per-paper result key carrying the context chunks sent to the LLM, moved to the result store before results are returned
+context_chunks_key = "_context_chunks"
+# per-paper result key carrying the seconds spent in each answer stage, summed into the request metadata
+stage_seconds_key = "_stage_seconds"
 
 class DataService(object):
     def __init__(self):
@@ -69,6 +101,19 @@ class DataService(object):
         print("loading vectorstores...")
         self._load_vectorstores_(load_flag=self.load_flag)
         print("finished loading vectorstores")
+        self.answer_cache = AnswerCache(GV.answer_cache_path) if GV.use_answer_cache else None
+        self.answer_structures = None
+        if GV.use_answer_structure_cache:
+            self.answer_structures = AnswerStructureCache(
+                max_entries=GV.answer_structure_cache_size,
+                path=GV.answer_cache_path if GV.answer_structure_cache_persistent else None,
+                prompt_version=ANSWER_STRUCTURE_PROMPT_VERSION,
+            )
+        self.result_store = ResultStore(GV.result_store_path, GV.result_store_ttl) if GV.use_result_store else None
+        self.evaluations = EvaluationQueue(GV.evaluation_cache_path, batch_size=GV.evaluation_batch_size,
+                                           batch_wait=GV.evaluation_batch_wait, workers=GV.evaluation_workers)
+        self.answer_latency = None  # moving average of the answer LLM call, in seconds
+        self.jobs = QAJobManager(self)
         # Environment variables are configured in globalVariable
 
     def _load_vectorstores_(self, load_flag=True):
@@ -79,66 +124,424 @@ class DataService(object):
             load_flag (bool): If True, load pre-computed vectorstores. Otherwise, process PDFs and create new vectorstores.
 
         This method initializes retrievers for each PDF, which are used for efficient document retrieval.
+        With `retriever_cache.mode: lazy` in config.yml, retrievers are only loaded on first access and
+        kept within `retriever_cache.memory_budget_mb`; otherwise all of them are loaded up front,
+        using `retriever_cache.load_workers` threads.
         """
         if self.vectorstore_loaded:
             return
+        pdf_files = [pdf_file for pdf_file in os.listdir(self.paper_folder) if pdf_file.endswith(".pdf")]
+        lazy = GV.retriever_load_mode == "lazy"
+        memory_budget = None
+        if lazy and GV.retriever_memory_budget_mb is not None:
+            memory_budget = int(GV.retriever_memory_budget_mb * 1024 * 1024)
+
+        self.load_timings = {"io_read": 0.0, "index_deserialize": 0.0, "docstore_deserialize": 0.0, "retriever_build": 0.0}
+        self.load_timings_lock = threading.Lock()
+        self.io_semaphore = threading.BoundedSemaphore(max(1, GV.retriever_io_concurrency))
+
+        self.retrievers = RetrieverCache(
+            lambda pdf_file: self._load_retriever_(pdf_file, load_flag),
+            keys=pdf_files,
+            memory_budget=memory_budget,
+            # chunk annotations of an evicted paper are registered again when it is reloaded
+            on_evict=drop_paper_artifacts,
+        )
+        self.corpus_index = None
+        if GV.use_corpus_index and lazy:
+            # merging the index loads every paper's vectorstore, which lazy mode is meant to avoid
+            print("corpus_index is not used with retriever_cache.mode: lazy, papers are searched with their own retrievers")
+        elif GV.use_corpus_index:
+            # papers missing from the index or changed since are retrieved per paper (see corpus_index.py)
+            self.corpus_index = CorpusIndex.load_or_build(self.vectorstore_folder, pdf_files)
+        if not lazy:
+            time0 = time.time()
+            utils.get_embedding_model()
+            self.load_timings["embedding_client"] = time.time() - time0
+            startup = self.retrievers.preload(workers=max(1, GV.retriever_load_workers))
+            self.load_timings["wall_time"] = startup["wall_time"] + self.load_timings["embedding_client"]
+            self.load_timings["loaded"] = startup["loaded"]
+            self.load_timings["failed"] = len(startup["failed"])
+            print("vectorstore loading breakdown (seconds, summed over workers except wall_time): ",
+                  {k: round(v, 3) if isinstance(v, float) else v for k, v in self.load_timings.items()})
+
+    def _load_retriever_(self, pdf_file, load_flag=True):
+        """
+        Load (or build, if load_flag is False) the multi-vector retriever of a single PDF file.
+        """
         data_folder = self.paper_folder
         table_folder = self.table_folder
         id_key = "doc_id"
 
-        retrievers = {}
-        for pdf_file in os.listdir(data_folder):
-            if pdf_file.endswith(".pdf"):
-                vectorstore_path = os.path.join(self.vectorstore_folder, pdf_file.split(".")[0], "vector_index")
-                db_path = os.path.join(self.vectorstore_folder, pdf_file.split(".")[0], pdf_file.split(".")[0] + ".pickle")
-                if load_flag:
-                    embedding_model = AzureOpenAIEmbeddings(
-                        azure_endpoint=GV.azure_openai_endpoint,
-                        azure_deployment=GV.azure_embedding_deployment,
-                        api_version=GV.azure_openai_version,
-                        api_key=GV.azure_openai_key,
-                    )
-                    vectorstore = FAISS.load_local(
-                        vectorstore_path,
-                        embeddings=embedding_model,
-                        allow_dangerous_deserialization=True,
-                    )
-                    docstore = pickle.load(open(db_path, "rb"))
-                else:
-                    # if no precomputed vectorstores, process pdfs then
-                    pdf_path = os.path.join(data_folder, pdf_file)
-                    table_path = os.path.join(table_folder, pdf_file.split(".")[0] + ".json")
-                    all_text = preprocess.process_one_pdf_papermage(pdf_path, table_path)
-                    vectorstore, docstore = utils.build_local_document_vector_store(all_text)
-                retriever = utils.build_multivector_retriever(vectorstore, docstore, id_key=id_key)
-                retrievers[pdf_file] = retriever
-        self.retrievers = retrievers
-
-    def run_rag_qa(self, pdf_files: list, question: str, batch_size: int = 5, evaluation_metrics = None) -> tuple:
+        vectorstore_path = os.path.join(self.vectorstore_folder, pdf_file.split(".")[0], "vector_index")
+        db_path = os.path.join(self.vectorstore_folder, pdf_file.split(".")[0], pdf_file.split(".")[0] + ".pickle")
+        if load_flag:
+            # one shared embedding client; file reads are bounded by the I/O semaphore
+            vectorstore, docstore, timings = utils.load_local_document_vector_store(
+                vectorstore_path, db_path,
+                embedding_model=utils.get_embedding_model(),
+                io_semaphore=self.io_semaphore,
+            )
+        else:
+            # if no precomputed vectorstores, process pdfs then
+            pdf_path = os.path.join(data_folder, pdf_file)
+            table_path = os.path.join(table_folder, pdf_file.split(".")[0] + ".json")
+            all_text = preprocess.process_one_pdf_papermage(pdf_path, table_path)
+            vectorstore, docstore = utils.build_local_document_vector_store(all_text)
+            timings = {}
+        time0 = time.time()
+        retriever = utils.build_multivector_retriever(vectorstore, docstore, id_key=id_key)
+        timings["retriever_build"] = time.time() - time0
+        # index the paper's tables/figures and ingest-time chunk types once, for context classification
+        time0 = time.time()
+        register_chunk_annotations(pdf_file, vectorstore, docstore, id_key=id_key)
+        get_paper_artifacts(pdf_file)
+        timings["artifacts_index"] = time.time() - time0
+        with self.load_timings_lock:
+            for stage, seconds in timings.items():
+                self.load_timings[stage] = self.load_timings.get(stage, 0.0) + seconds
+        return retriever
+
+    def get_retriever_stats(self) -> dict:
+        """
+        Retriever cache statistics plus the cumulative vectorstore loading breakdown.
+        """
+        stats = self.retrievers.stats()
+        with self.load_timings_lock:
+            stats["load_timings"] = dict(self.load_timings)
+        return stats
+
+    def run_rag_qa(self, pdf_files: list, question: str, batch_size: int = 5, evaluation_metrics = None,
+                   return_metadata: bool = False, ans_format = None) -> tuple:
         """
         Run Retrieval Augmented Generation (RAG) for question answering on multiple PDF files.
 
-        This method processes the given PDF files in parallel batches, retrieves relevant
-        information, and generates answers using a language model.
+        This method processes the given PDF files in parallel on the shared worker pool, retrieves
+        relevant information, and generates answers using a language model.
 
         Args:
             pdf_files (list): List of PDF filenames to process.
             question (str): The question to be answered.
-            batch_size (int, optional): Number of PDF files to process in parallel. Defaults to 5.
+            batch_size (int, optional): Maximum number of this request's PDF files in flight at once,
+                bounded by the shared pool size (`qa.max_workers`). Defaults to 5.
             evaluation_metrics (list, optional): Metrics to use for evaluating answers. Defaults to None.
+            return_metadata (bool, optional): Also return request metadata (answer cache hits). Defaults to False.
+            ans_format (dict or str, optional): Precomputed answer structure (e.g. from a previous
+                response); skips designing it with the LLM. Defaults to None.
 
         Returns:
             tuple: A tuple containing:
                 - rag_summary (str): A concise summary of answers from different papers.
                 - results (dict): Detailed results for each PDF file, including answers and contexts.
+                - metadata (dict): Only with `return_metadata`; see _lookup_cached_answers_.
 
         Raises:
             Exception: If there's an error processing any of the PDF files.
         """
-        #######################
-        # decide the answer strcuture
-        #######################
-        # decide the answer strcuture
+        if GV.qa_engine == "async":
+            return get_async_engine().run(self.arun_rag_qa(pdf_files, question, evaluation_metrics, return_metadata, ans_format))
+
+        ans_format = self._resolve_answer_structure_(question, ans_format)
+
+        print("running rag retriever...")
+        results = {}
+        metadata = {}
+        for pdf_file, data in self._iter_rag_results_(pdf_files, question, ans_format, batch_size, evaluation_metrics,
+                                                      metadata=metadata):
+            if data is not None:
+                results.update(data)
+
+        print("running rag summary...")
+        rag_summary = self._summarize_rag_results_(question, results)
+        if return_metadata:
+            metadata["ans_format"] = json.loads(ans_format)
+            return rag_summary, results, metadata
+        return rag_summary, results
+
+    async def arun_rag_qa(self, pdf_files: list, question: str, evaluation_metrics = None,
+                          return_metadata: bool = False, ans_format = None) -> tuple:
+        """
+        asyncio-native variant of run_rag_qa.
+
+        The answer structure, the per-paper answer chains and the summary are awaited with
+        ainvoke; papers are gated by the async engine's semaphore (`qa.async_concurrency`)
+        instead of worker threads. Must run on the async engine loop (see async_engine.py).
+
+        Returns:
+            tuple: (rag_summary, results) or (rag_summary, results, metadata), as returned by run_rag_qa.
+        """
+        if ans_format is not None:
+            ans_format = self._resolve_answer_structure_(question, ans_format)
+        else:
+            ans_format = await self._agenerate_answer_structure_(question)
+
+        print("running async rag retriever...")
+        results = {}
+        metadata = {}
+        async for pdf_file, data in self._aiter_rag_results_(pdf_files, question, ans_format, evaluation_metrics,
+                                                             metadata=metadata):
+            if data is not None:
+                results.update(data)
+
+        print("running async rag summary...")
+        rag_summary = await self._asummarize_rag_results_(question, results)
+        if return_metadata:
+            metadata["ans_format"] = json.loads(ans_format)
+            return rag_summary, results, metadata
+        return rag_summary, results
+
+    def stream_rag_qa(self, pdf_files: list, question: str, batch_size: int = 5, evaluation_metrics = None, ans_format = None):
+        """
+        Streaming variant of run_rag_qa that yields events as soon as they are available.
+
+        Events are dictionaries with a "type" key, emitted in the following order:
+            - {"type": "ans_format", "ans_format": dict}: the designed answer structure
+            - {"type": "paper", "pdf_file": str, "result": dict}: one per paper, in completion order
+            - {"type": "error", "pdf_file": str, "message": str}: a paper that failed
+            - {"type": "metadata", "metadata": dict}: request metadata (answer cache hits)
+            - {"type": "summary", "summary": str}: the summary over all answered papers
+
+        Args:
+            pdf_files (list): List of PDF filenames to process.
+            question (str): The question to be answered.
+            batch_size (int, optional): Maximum number of this request's PDF files in flight at once,
+                bounded by the shared pool size (`qa.max_workers`). Defaults to 5.
+            evaluation_metrics (list, optional): Metrics to use for evaluating answers. Defaults to None.
+            ans_format (dict or str, optional): Precomputed answer structure. Defaults to None.
+
+        Yields:
+            dict: Stream events as described above.
+        """
+        ans_format = self._resolve_answer_structure_(question, ans_format)
+        yield {"type": "ans_format", "ans_format": json.loads(ans_format)}
+
+        results = {}
+        errors = {}
+        metadata = {}
+        for pdf_file, data in self._iter_rag_results_(pdf_files, question, ans_format, batch_size, evaluation_metrics,
+                                                      errors=errors, metadata=metadata):
+            if data is None:
+                yield {"type": "error", "pdf_file": pdf_file, "message": errors[pdf_file]}
+                continue
+            results.update(data)
+            yield {"type": "paper", "pdf_file": pdf_file, "result": data[pdf_file]}
+
+        yield {"type": "metadata", "metadata": metadata}
+        yield {"type": "summary", "summary": self._summarize_rag_results_(question, results)}
+
+    def run_multi_rag_qa(self, pdf_files: list, questions: list, batch_size: int = 5, evaluation_metrics = None,
+                         ans_formats: list = None) -> tuple:
+        """
+        Answer several questions over the same PDF files with one retrieval pass and one LLM call per paper.
+
+        Every question keeps its own answer structure (cached or designed as in run_rag_qa). The
+        structures are merged into one, with a key per question ("question_1", ...). All questions
+        are embedded in a single call, each paper is searched with every question vector, and the
+        union of the retrieved chunks is packed into one context. One answer call per paper fills
+        the merged structure, which is then split back per question. With N questions this replaces
+        N answer calls per paper with one.
+
+        Relevance gating applies `min_relevance` to a paper's best chunk over all questions; the
+        answer cache and the `top_n_papers` cut are not used here.
+
+        Args:
+            pdf_files (list): List of PDF filenames to process.
+            questions (list): The questions to be answered.
+            batch_size (int, optional): Maximum number of this request's PDF files in flight at once,
+                bounded by the shared pool size (`qa.max_workers`). Defaults to 5.
+            evaluation_metrics (list, optional): Metrics to use for evaluating each answer. Defaults to None.
+            ans_formats (list, optional): Precomputed answer structure per question; None entries are
+                designed with the LLM. Defaults to None.
+
+        Returns:
+            tuple: A tuple containing:
+                - results (list): One entry per question, in order: {"question": str, "summary": str,
+                  "answer": dict (pdf_file -> result, as in run_rag_qa), "ans_format": dict}.
+                - metadata (dict): "papers", "questions", "answer_calls", "answer_calls_saved",
+                  "skipped_papers" and "errors" (pdf_file -> message).
+        """
+        scheduler = get_scheduler()
+        ans_formats = list(ans_formats or [])
+        ans_formats += [None] * (len(questions) - len(ans_formats))
+
+        print("designing answer structures...")
+        resolved = [None] * len(questions)
+        for index, ans_format, exc in scheduler.imap_unordered(
+                lambda index: self._resolve_answer_structure_(questions[index], ans_formats[index]), range(len(questions))):
+            if exc is not None:
+                raise exc
+            resolved[index] = ans_format
+
+        # one embedding request for all questions
+        time0 = time.time()
+        query_vectors = utils.get_embedding_model().embed_documents(list(questions))
+        print("Time taken for question embeddings: ", time.time() - time0, " seconds")
+        searches = []
+        if self.corpus_index is not None:
+            searches = [self.corpus_index.search(query_vector, pdf_files, k=GV.corpus_index_k, return_relevance=True)
+                        for query_vector in query_vectors]
+
+        def process_paper(pdf_file):
+            if searches and all(pdf_file in contexts for contexts, _ in searches):
+                retrieved = [(contexts[pdf_file], relevance.get(pdf_file)) for contexts, relevance in searches]
+            else:
+                retriever = self.retrievers[pdf_file]
+                retrieved = [utils.retrieve_by_vector(retriever, query_vector, return_relevance=True)
+                             for query_vector in query_vectors]
+            return self.process_multi_rag_retriever(pdf_file, questions, resolved, retrieved, evaluation_metrics)
+
+        print("running multi-question rag retriever...")
+        time0 = time.time()
+        results = [{} for _ in questions]
+        metadata = {"papers": len(pdf_files), "questions": len(questions), "answer_calls": 0, "skipped_papers": 0, "errors": {}}
+        for pdf_file, data, exc in scheduler.imap_unordered(process_paper, list(pdf_files), max_in_flight=batch_size):
+            if exc is not None:
+                print('%r generated an exception: %s' % (pdf_file, exc))
+                metadata["errors"][pdf_file] = str(exc)
+                continue
+            for index, paper_result in enumerate(data):
+                results[index].update(paper_result)
+            if data[0][pdf_file]["skipped"]:
+                metadata["skipped_papers"] += 1
+            else:
+                metadata["answer_calls"] += 1
+        metadata["answer_calls_saved"] = metadata["answer_calls"] * (len(questions) - 1)
+        print("Time taken for multi-question rag retriever: ", time.time() - time0, " seconds")
+
+        print("running rag summaries...")
+        summaries = [None] * len(questions)
+        for index, summary, exc in scheduler.imap_unordered(
+                lambda index: self._summarize_rag_results_(questions[index], results[index]), range(len(questions))):
+            if exc is not None:
+                raise exc
+            summaries[index] = summary
+
+        return [{
+            "question": question,
+            "summary": summaries[index],
+            "answer": results[index],
+            "ans_format": json.loads(resolved[index])
+        } for index, question in enumerate(questions)], metadata
+
+    def extend_rag_qa(self, result_id: str, columns: dict, batch_size: int = 5):
+        """
+        Add columns to a stored result, reusing each paper's context and asking only for the new fields.
+
+        Each paper keeps the context chunks its answer was generated from (see result_store.py).
+        Retrieval is extended with one search per new column, only chunks not already in the
+        context are added (packed into their own `context_packing` budget), and one LLM call
+        per paper fills the new fields of the existing rows, which are merged in place by row.
+        The stored result is updated, so it can be extended again.
+
+        Args:
+            result_id (str): Result id from the metadata of a previous QA request.
+            columns (dict): New column name -> description of the expected values. Columns the
+                answer structure already has are ignored.
+            batch_size (int, optional): Maximum number of papers in flight at once. Defaults to 5.
+
+        Returns:
+            tuple or None: (results, ans_format, metadata), with results pdf_file -> result as in
+                run_rag_qa (context holds the chunks of the extended context), the extended
+                answer structure as a dict, and metadata with "result_id", "columns", "answer_calls",
+                "missing_papers" and "errors". None if the result is unknown or expired.
+        """
+        if self.result_store is None:
+            return None
+        stored = self.result_store.get(result_id)
+        if stored is None:
+            return None
+        question = stored["question"]
+        structure = json.loads(stored["ans_format"])[ans_key]
+        existing = structure[0] if isinstance(structure, list) and structure else structure
+        columns = {name: description for name, description in columns.items()
+                   if not isinstance(existing, dict) or name not in existing}
+        metadata = {"result_id": result_id, "columns": list(columns), "answer_calls": 0,
+                    "missing_papers": [pdf_file for pdf_file in stored["pdf_files"] if pdf_file not in stored["papers"]],
+                    "errors": {}}
+        if isinstance(existing, dict):
+            extended = dict(existing, **columns)
+            structure = [extended] if isinstance(structure, list) else extended
+        ans_format = json.dumps({ans_key: structure})
+        if not columns:
+            return {}, json.loads(ans_format), metadata
+
+        # one search per new column, all columns embedded in one request
+        column_queries = [f"{question} {name}: {description}" for name, description in columns.items()]
+        query_vectors = utils.get_embedding_model().embed_documents(column_queries)
+        column_format = json.dumps({ans_key: [columns]})
+
+        def process_paper(pdf_file):
+            paper = stored["papers"][pdf_file]
+            retriever = self.retrievers[pdf_file]
+            retrieved = [utils.retrieve_by_vector(retriever, query_vector, return_relevance=True)
+                         for query_vector in query_vectors]
+            return self.process_rag_extension(pdf_file, question, paper["answer"], paper["context"], columns,
+                                              column_format, retrieved)
+
+        print("running rag column extension...")
+        time0 = time.time()
+        results = {}
+        for pdf_file, data, exc in get_scheduler().imap_unordered(process_paper, list(stored["papers"]),
+                                                                  max_in_flight=batch_size):
+            if exc is not None:
+                print('%r generated an exception: %s' % (pdf_file, exc))
+                metadata["errors"][pdf_file] = str(exc)
+                continue
+            if not data[pdf_file]["skipped"]:
+                metadata["answer_calls"] += 1
+            chunks = data[pdf_file].pop(context_chunks_key)
+            self.result_store.put_paper(result_id, pdf_file, data[pdf_file]["answer"], chunks)
+            results.update(data)
+        self.result_store.set_ans_format(result_id, ans_format)
+        print("Time taken for rag column extension: ", time.time() - time0, " seconds")
+        return results, json.loads(ans_format), metadata
+
+    def _generate_answer_structure_(self, question: str) -> str:
+        """
+        Ask the LLM to design the JSON answer structure for a question.
+
+        Returns:
+            str: The answer structure serialized as a JSON string.
+
+        Structures are cached per normalized question (see AnswerStructureCache), so a repeated
+        question skips the LLM call.
+        """
+        if self.answer_structures is not None:
+            cached = self.answer_structures.get(question)
+            if cached is not None:
+                return cached
+        model = utils.get_chat_model(json_mode=True)
+        ans_format = json.dumps(json.loads(model.invoke(self._answer_structure_prompt_(question)).content))
+        if self.answer_structures is not None:
+            self.answer_structures.put(question, ans_format)
+        return ans_format
+
+    async def _agenerate_answer_structure_(self, question: str) -> str:
+        if self.answer_structures is not None:
+            cached = await asyncio.to_thread(self.answer_structures.get, question)
+            if cached is not None:
+                return cached
+        model = utils.get_chat_model(json_mode=True)
+        response = await model.ainvoke(self._answer_structure_prompt_(question))
+        ans_format = json.dumps(json.loads(response.content))
+        if self.answer_structures is not None:
+            await asyncio.to_thread(self.answer_structures.put, question, ans_format)
+        return ans_format
+
+    def _resolve_answer_structure_(self, question: str, ans_format = None) -> str:
+        """
+        Use the caller's precomputed answer structure (dict or JSON string) if given,
+        otherwise generate (or fetch the cached) one.
+        """
+        if ans_format is None:
+            return self._generate_answer_structure_(question)
+        if isinstance(ans_format, str):
+            ans_format = json.loads(ans_format)
+        if not isinstance(ans_format, dict):
+            raise ValueError("ans_format must be a JSON object")
+        return json.dumps(ans_format)
+
+    def _answer_structure_prompt_(self, question: str) -> str:
         answer_structure_prompt = f"""
         Given the following question, design a structured data format to represent ONLY the information explicitly requested:
 
@@ -191,77 +594,390 @@ class DataService(object):
         Ensure your structure capture all relevant information from the question, while also being flexible enough to accommodate various possible answers.
         """
 
-        model = AzureChatOpenAI(
-            temperature=0,
-            azure_endpoint=GV.azure_openai_endpoint,
-            azure_deployment=GV.azure_openai_deployment,
-            api_version=GV.azure_openai_version,
-            api_key=GV.azure_openai_key,
-            model_kwargs={"response_format": {"type": "json_object"}},
-        )
-        ans_format = json.dumps(json.loads(model.invoke(answer_structure_prompt).content))
-        # print("ans_format: \n", ans_format)
-        #######################
+        return answer_structure_prompt
 
+    def _iter_rag_results_(self, pdf_files: list, question: str, ans_format: str, batch_size: int = 5,
+                           evaluation_metrics = None, errors: dict = None, cancel_event = None, metadata: dict = None):
+        """
+        Run process_rag_retriever over the given PDF files and yield results as they complete.
 
-        retrievers = {}
-        for pdf_file in pdf_files:
-            retrievers[pdf_file] = self.retrievers[pdf_file]
+        Papers found in the answer cache are yielded first. The others run on the process-wide
+        scheduler shared by all requests; at most `batch_size` papers of this request are in flight
+        at once. If `cancel_event` (a threading.Event) is set, or the consumer closes the generator,
+        papers that have not started yet are dropped. Cache and relevance gating statistics, and the
+        id of the result in the result store ("result_id"), are stored in `metadata` when provided.
 
-        # Function to divide retrievers into batches for parallel processing
-        def batched_retrievers(retriever_items, batch_size):
-            for i in range(0, len(retriever_items), batch_size):
-                yield retriever_items[i:i + batch_size]
-        
-        # Function to process each batch in parallel
-        print("running rag retriever...")
-        results = {}
-        for batch in batched_retrievers(list(retrievers.items()), batch_size):
+        With `relevance_gating.top_n_papers`, every paper is retrieved before the first answer call
+        and papers outside the top N by best chunk relevance are yielded at once as skipped; the
+        `min_relevance` cut is applied per paper in process_rag_retriever. Cached papers are not
+        counted towards the top N.
+
+        Yields:
+            tuple: (pdf_file, data) where data is the dict returned by process_rag_retriever,
+                or None if processing this paper raised an exception (the message is stored
+                in `errors` when provided).
+        """
+        if GV.qa_engine == "async":
+            yield from get_async_engine().iterate(
+                self._aiter_rag_results_(pdf_files, question, ans_format, evaluation_metrics, errors, cancel_event, metadata))
+            return
+
+        cache_keys, cached = self._lookup_cached_answers_(pdf_files, question, ans_format, evaluation_metrics, metadata)
+        self._record_skipped_(metadata, None)
+        result_id = self._create_result_(question, ans_format, pdf_files, metadata)
+        for pdf_file, data in cached.items():
+            self._record_result_(result_id, pdf_file, data)
+            yield pdf_file, data
+        pdf_files = [pdf_file for pdf_file in pdf_files if pdf_file not in cached]
+        if not pdf_files:
+            return
+
+        # Embed the question once per request and reuse the vector for every paper
+        query_vector = None
+        if self.corpus_index is not None or GV.embed_query_once or GV.use_relevance_gating:
             time0 = time.time()
-            with ThreadPoolExecutor() as executor:
-                future_to_retriever = {executor.submit(self.process_rag_retriever, retriever_tuple, question, ans_format, evaluation_metrics): retriever_tuple for retriever_tuple in batch}
-                for future in as_completed(future_to_retriever):
-                    retriever_tuple = future_to_retriever[future]
-                    # print(f"Processing {retriever_tuple[0]}, {retriever_tuple[1]}")
-                    data = future.result()
-                    # print(f"data: {data}")
-                    results.update(data)
-                    try:
-                        data = future.result()
-                        # print(f"data: {data}")
-                        results.update(data)
-                        # Process the data here
-                    except Exception as exc:
-                        print('%r generated an exception: %s' % (retriever_tuple[0], exc))
-            time1 = time.time()
-            print("Time taken for this batch: ", time1 - time0, " seconds")
-            
-        # Functions to summarize RAG results
-        print("running rag summary...")
+            query_vector = utils.get_embedding_model().embed_query(question)
+            print("Time taken for question embedding: ", time.time() - time0, " seconds")
+
+        # With the corpus index, all selected papers are searched together
+        contexts, relevance = {}, {}
+        if self.corpus_index is not None:
+            time0 = time.time()
+            contexts, relevance = self.corpus_index.search(query_vector, pdf_files, k=GV.corpus_index_k, return_relevance=True)
+            self._record_stage_seconds_(metadata, {"retrieval": time.time() - time0})
+            print("Time taken for corpus index retrieval: ", time.time() - time0, " seconds")
+        elif GV.use_relevance_gating and GV.relevance_top_n:
+            # the top-N cut needs every paper's relevance before the first answer call
+            def retrieve_paper(pdf_file):
+                return utils.retrieve_by_vector(self.retrievers[pdf_file], query_vector, return_relevance=True)
+            time0 = time.time()
+            # bounded like the answer loop, so one request does not queue all its papers on the shared pool
+            for pdf_file, retrieved, exc in get_scheduler().imap_unordered(retrieve_paper, list(pdf_files),
+                                                                           max_in_flight=batch_size,
+                                                                           cancel_event=cancel_event):
+                # failed papers are retried (and reported) by process_paper
+                if exc is None:
+                    contexts[pdf_file], relevance[pdf_file] = retrieved
+            self._record_stage_seconds_(metadata, {"retrieval": time.time() - time0})
+            print("Time taken for relevance retrieval: ", time.time() - time0, " seconds")
+
+        skipped = self._gate_top_n_(pdf_files, relevance)
+        for pdf_file in skipped:
+            data = self._skipped_result_(pdf_file, ans_format, relevance[pdf_file])
+            self._record_skipped_(metadata, data)
+            self._record_result_(result_id, pdf_file, data)
+            yield pdf_file, data
+        pdf_files = [pdf_file for pdf_file in pdf_files if pdf_file not in skipped]
+
+        # Retrievers are fetched inside the workers, so lazily loaded ones are materialized in parallel
+        def process_paper(pdf_file):
+            if pdf_file in contexts:
+                return self.process_rag_retriever((pdf_file, None), question, ans_format, evaluation_metrics,
+                                                  context=contexts[pdf_file], relevance=relevance.get(pdf_file))
+            time0 = time.time()
+            retriever = self.retrievers[pdf_file]
+            context, paper_relevance = None, None
+            if query_vector is not None:
+                context, paper_relevance = utils.retrieve_by_vector(retriever, query_vector, return_relevance=True)
+            return self.process_rag_retriever((pdf_file, retriever), question, ans_format, evaluation_metrics,
+                                              context=context, relevance=paper_relevance,
+                                              retrieval_seconds=time.time() - time0)
+
+        # Papers run on the shared worker pool; a new paper is admitted as soon as one finishes
+        time0 = time.time()
+        scheduler = get_scheduler()
+        for pdf_file, data, exc in scheduler.imap_unordered(process_paper, list(pdf_files),
+                                                            max_in_flight=batch_size, cancel_event=cancel_event):
+            if exc is not None:
+                print('%r generated an exception: %s' % (pdf_file, exc))
+                if errors is not None:
+                    errors[pdf_file] = str(exc)
+            self._store_answer_(pdf_file, cache_keys, data)
+            self._record_skipped_(metadata, data)
+            self._record_stage_seconds_(metadata, data[pdf_file].pop(stage_seconds_key, None) if data else None)
+            self._record_result_(result_id, pdf_file, data)
+            yield pdf_file, data
+        if cancel_event is not None and cancel_event.is_set():
+            print("rag retriever cancelled")
+        print("Time taken for rag retriever: ", time.time() - time0, " seconds")
+
+    async def _aiter_rag_results_(self, pdf_files: list, question: str, ans_format: str, evaluation_metrics = None,
+                                  errors: dict = None, cancel_event = None, metadata: dict = None):
+        """
+        Async variant of _iter_rag_results_, yielding (pdf_file, data) as papers complete.
+
+        Every paper becomes a task; at most `qa.async_concurrency` papers (across all requests)
+        hold the engine semaphore at once. Setting `cancel_event` or closing the generator
+        cancels the papers that are still pending, including those being retrieved for the
+        top-N relevance cut.
+        """
+        engine = get_async_engine()
+
+        cache_keys, cached = await asyncio.to_thread(
+            self._lookup_cached_answers_, pdf_files, question, ans_format, evaluation_metrics, metadata)
+        self._record_skipped_(metadata, None)
+        result_id = await asyncio.to_thread(self._create_result_, question, ans_format, pdf_files, metadata)
+        for pdf_file, data in cached.items():
+            await asyncio.to_thread(self._record_result_, result_id, pdf_file, data)
+            yield pdf_file, data
+        pdf_files = [pdf_file for pdf_file in pdf_files if pdf_file not in cached]
+        if not pdf_files:
+            return
+
+        query_vector = None
+        if self.corpus_index is not None or GV.embed_query_once or GV.use_relevance_gating:
+            query_vector = await utils.get_embedding_model().aembed_query(question)
+        contexts, relevance = {}, {}
+        time0 = time.time()
+        if self.corpus_index is not None:
+            contexts, relevance = await asyncio.to_thread(self.corpus_index.search, query_vector, pdf_files,
+                                                          GV.corpus_index_k, True)
+            self._record_stage_seconds_(metadata, {"retrieval": time.time() - time0})
+        elif GV.use_relevance_gating and GV.relevance_top_n:
+            async def retrieve_paper(pdf_file):
+                async with engine.semaphore:
+                    retriever = await asyncio.to_thread(self.retrievers.__getitem__, pdf_file)
+                    return await utils.aretrieve_by_vector(retriever, query_vector, return_relevance=True)
+            retrievals = [asyncio.ensure_future(retrieve_paper(pdf_file)) for pdf_file in pdf_files]
+            watcher = engine.cancel_on(cancel_event, retrievals)
+            try:
+                retrieved = await asyncio.gather(*retrievals, return_exceptions=True)
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+            if cancel_event is not None and cancel_event.is_set():
+                print("async rag retriever cancelled")
+                return
+            for pdf_file, item in zip(pdf_files, retrieved):
+                # failed papers are retried (and reported) by process_paper
+                if not isinstance(item, BaseException):
+                    contexts[pdf_file], relevance[pdf_file] = item
+            self._record_stage_seconds_(metadata, {"retrieval": time.time() - time0})
+
+        skipped = self._gate_top_n_(pdf_files, relevance)
+        for pdf_file in skipped:
+            data = self._skipped_result_(pdf_file, ans_format, relevance[pdf_file])
+            self._record_skipped_(metadata, data)
+            await asyncio.to_thread(self._record_result_, result_id, pdf_file, data)
+            yield pdf_file, data
+        pdf_files = [pdf_file for pdf_file in pdf_files if pdf_file not in skipped]
+
+        async def process_paper(pdf_file):
+            async with engine.semaphore:
+                try:
+                    if pdf_file in contexts:
+                        data = await self.aprocess_rag_retriever((pdf_file, None), question, ans_format, evaluation_metrics,
+                                                                 context=contexts[pdf_file], relevance=relevance.get(pdf_file))
+                        return pdf_file, data, None
+                    time0 = time.time()
+                    # loading a retriever may hit the disk, keep it off the event loop
+                    retriever = await asyncio.to_thread(self.retrievers.__getitem__, pdf_file)
+                    context, paper_relevance = None, None
+                    if query_vector is not None:
+                        context, paper_relevance = await utils.aretrieve_by_vector(retriever, query_vector, return_relevance=True)
+                    data = await self.aprocess_rag_retriever((pdf_file, retriever), question, ans_format, evaluation_metrics,
+                                                             context=context, relevance=paper_relevance,
+                                                             retrieval_seconds=time.time() - time0)
+                    return pdf_file, data, None
+                except Exception as exc:
+                    return pdf_file, None, exc
+
+        time0 = time.time()
+        tasks = [asyncio.ensure_future(process_paper(pdf_file)) for pdf_file in pdf_files]
+        # cancels the pending papers (including those waiting for the semaphore) as soon as the event is set
+        watcher = engine.cancel_on(cancel_event, tasks)
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    pdf_file, data, exc = await next_done
+                except asyncio.CancelledError:
+                    if cancel_event is not None and cancel_event.is_set():
+                        print("async rag retriever cancelled")
+                        return
+                    raise
+                if exc is not None:
+                    print('%r generated an exception: %s' % (pdf_file, exc))
+                    if errors is not None:
+                        errors[pdf_file] = str(exc)
+                await asyncio.to_thread(self._store_answer_, pdf_file, cache_keys, data)
+                self._record_skipped_(metadata, data)
+                self._record_stage_seconds_(metadata, data[pdf_file].pop(stage_seconds_key, None) if data else None)
+                await asyncio.to_thread(self._record_result_, result_id, pdf_file, data)
+                yield pdf_file, data
+                if cancel_event is not None and cancel_event.is_set():
+                    print("async rag retriever cancelled")
+                    return
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            print("Time taken for async rag retriever: ", time.time() - time0, " seconds")
+
+    def _lookup_cached_answers_(self, pdf_files: list, question: str, ans_format: str, evaluation_metrics = None,
+                                metadata: dict = None) -> tuple:
+        """
+        Look up the papers' results in the answer cache.
+
+        Fills `metadata` (if given) with "papers", "cache_hits", "cache_misses" and "cache_hit_rate".
+
+        Returns:
+            tuple: (cache_keys, cached) where cache_keys maps pdf_file -> cache key (to store new
+                results) and cached maps pdf_file -> cached result.
+        """
+        cache_keys, cached = {}, {}
+        if self.answer_cache is not None:
+            try:
+                cache_keys = {pdf_file: self.answer_cache.make_key(pdf_file, question, ans_format, evaluation_metrics)
+                              for pdf_file in pdf_files}
+                cached = self.answer_cache.get_many(cache_keys)
+                for pdf_file, data in cached.items():
+                    # entries cached before the internal keys were stripped
+                    data[pdf_file].pop(stage_seconds_key, None)
+                    # background evaluations may have finished since the answer was cached
+                    evaluation = data[pdf_file].get("evaluation")
+                    if isinstance(evaluation, dict) and evaluation.get("status") == "pending":
+                        data[pdf_file]["evaluation"] = self.evaluations.status(evaluation["eval_id"])
+            except Exception as e:
+                print(f"answer cache lookup failed: {e}")
+                cache_keys, cached = {}, {}
+        if metadata is not None:
+            metadata["papers"] = len(pdf_files)
+            metadata["cache_hits"] = len(cached)
+            metadata["cache_misses"] = len(pdf_files) - len(cached)
+            metadata["cache_hit_rate"] = len(cached) / len(pdf_files) if pdf_files else None
+        return cache_keys, cached
+
+    def _store_answer_(self, pdf_file: str, cache_keys: dict, data: dict):
+        # skipped papers cost no LLM call and depend on the gating settings, so they are not cached
+        if self.answer_cache is None or data is None or data[pdf_file].get("skipped"):
+            return
+        # the internal keys are per request; the chunks go to the result store, not the cache
+        stored = {key: value for key, value in data[pdf_file].items() if key not in (context_chunks_key, stage_seconds_key)}
+        try:
+            self.answer_cache.put(pdf_file, cache_keys.get(pdf_file), {pdf_file: stored})
+        except Exception as e:
+            print(f"answer cache store failed for {pdf_file}: {e}")
+
+    def _create_result_(self, question: str, ans_format: str, pdf_files: list, metadata: dict):
+        """
+        Register the request's result in the result store, so columns can be added later
+        (see extend_rag_qa). Returns the result id, also stored in `metadata`, or None.
+        """
+        if self.result_store is None or metadata is None:
+            return None
+        try:
+            result_id = self.result_store.create(question, ans_format, pdf_files)
+        except Exception as e:
+            print(f"result store create failed: {e}")
+            return None
+        metadata["result_id"] = result_id
+        return result_id
+
+    def _record_result_(self, result_id: str, pdf_file: str, data: dict):
+        """
+        Move a paper's context chunks out of its result and into the result store.
+        """
+        if data is None:
+            return
+        chunks = data[pdf_file].pop(context_chunks_key, None)
+        if result_id is None:
+            return
+        try:
+            self.result_store.put_paper(result_id, pdf_file, data[pdf_file]["answer"], chunks)
+        except Exception as e:
+            print(f"result store update failed for {pdf_file}: {e}")
+
+    def _gate_top_n_(self, pdf_files: list, relevance: dict) -> list:
+        """
+        Papers outside the `relevance_gating.top_n_papers` best by relevance. Papers without a
+        relevance (not retrieved yet) are never skipped here.
+        """
+        if not GV.use_relevance_gating or not GV.relevance_top_n:
+            return []
+        ranked = sorted((pdf_file for pdf_file in pdf_files if relevance.get(pdf_file) is not None),
+                        key=lambda pdf_file: relevance[pdf_file], reverse=True)
+        return ranked[GV.relevance_top_n:]
+
+    def _below_min_relevance_(self, relevance) -> bool:
+        return (GV.use_relevance_gating and GV.relevance_min_score is not None
+                and relevance is not None and relevance < GV.relevance_min_score)
+
+    def _skipped_result_(self, pdf_file: str, answer_format: str, relevance: float) -> dict:
+        """
+        Result of a paper skipped by relevance gating: every answer field is "Empty", as the RAG
+        prompt would answer for a paper without relevant information, and no LLM is called.
+        """
+        answer = utils.empty_answer(json.loads(answer_format)[ans_key])
+        return self._paper_result_(pdf_file, answer, [], None, relevance=relevance, skipped=True)
+
+    def _observe_answer_latency_(self, seconds: float):
+        if self.answer_latency is None:
+            self.answer_latency = seconds
+        else:
+            self.answer_latency = 0.9 * self.answer_latency + 0.1 * seconds
+
+    def _record_skipped_(self, metadata: dict, data: dict):
+        """
+        Count a skipped paper in `metadata` ("skipped_papers", and "estimated_latency_saved": the
+        average answer call latency, in seconds, summed over the skipped papers). With data None,
+        only initializes the counters.
+        """
+        if metadata is None:
+            return
+        metadata.setdefault("skipped_papers", 0)
+        metadata.setdefault("estimated_latency_saved", 0.0)
+        if data is None or not next(iter(data.values())).get("skipped"):
+            return
+        metadata["skipped_papers"] += 1
+        metadata["estimated_latency_saved"] += self.answer_latency or 0.0
+
+    def _record_stage_seconds_(self, metadata: dict, seconds: dict):
+        """
+        Add the seconds spent per stage ("retrieval", "packing", "answer", "evaluation") to
+        `metadata["stage_seconds"]`. Per-paper stages run concurrently, so the sums can exceed
+        the request's wall-clock time.
+        """
+        if metadata is None or not seconds:
+            return
+        stage_seconds = metadata.setdefault("stage_seconds", {})
+        for stage, elapsed in seconds.items():
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + elapsed
+
+    def _summarize_rag_results_(self, question: str, results: dict) -> str:
+        """
+        Summarize the per-paper answers into a concise overview.
+        """
+        rag_summary_chain, summary_input = self._summary_chain_input_(question, results)
+        rag_summary = rag_summary_chain.invoke(summary_input)
+        return rag_summary
+
+    async def _asummarize_rag_results_(self, question: str, results: dict) -> str:
+        rag_summary_chain, summary_input = self._summary_chain_input_(question, results)
+        return await rag_summary_chain.ainvoke(summary_input)
+
+    def _summary_chain_input_(self, question: str, results: dict) -> tuple:
         summary_template = """
         Given the question: {question}, provide a very concise summary of the answers from different papers:
         {answer}
         """
-        summary_prompt = ChatPromptTemplate.from_template(summary_template)
-        summary_model = AzureChatOpenAI(
-            temperature=0,
-            azure_endpoint=GV.azure_openai_endpoint,
-            azure_deployment=GV.azure_openai_deployment,
-            api_version=GV.azure_openai_version,
-            api_key=GV.azure_openai_key,
-        )
-        rag_summary_chain = summary_prompt | summary_model | StrOutputParser()
-        rag_sum_text = utils.cut_string_to_token_length(str([str(r["answer"]) for r in list(results.values())]))
-        
-        rag_summary = rag_summary_chain.invoke({
+
+        def build_summary_chain():
+            summary_prompt = ChatPromptTemplate.from_template(summary_template)
+            return summary_prompt | utils.get_chat_model() | StrOutputParser()
+        rag_summary_chain = utils.get_cached_chain("rag_summary", build_summary_chain)
+        # skipped papers only hold "Empty" answers
+        rag_sum_text = utils.cut_string_to_token_length(
+            str([str(r["answer"]) for r in list(results.values()) if not r.get("skipped")]))
+        return rag_summary_chain, {
             "question": question,
             "answer": rag_sum_text
-        })
-        return rag_summary, results
+        }
 
-    
     def process_rag_retriever(self, retriever_item: tuple, 
-                              question: str, answer_format: str, evaluation_metrics = None) -> dict:
+                              question: str, answer_format: str, evaluation_metrics = None, context: list = None,
+                              relevance: float = None, retrieval_seconds: float = 0.0) -> dict:
         """
         Process a single retriever for RAG-based question answering.
 
@@ -274,6 +990,13 @@ class DataService(object):
             answer_format (str): The desired format for the answer, typically in JSON.
             evaluation_metrics (list, optional): List of metrics to evaluate the answer quality.
                 Defaults to None.
+            context (list, optional): Already retrieved parent chunks (e.g. from the corpus index or
+                a search with the request's precomputed question embedding).
+                If given, the retriever is not queried. Defaults to None.
+            relevance (float, optional): Relevance of the best retrieved chunk, returned with `context`
+                (see utils.relevance_from_score). Defaults to None.
+            retrieval_seconds (float, optional): Seconds the caller spent retrieving `context`,
+                reported with this paper's stage timings. Defaults to 0.0.
 
         Returns:
             dict: A dictionary containing the results for the processed PDF file. Structure:
@@ -285,7 +1008,15 @@ class DataService(object):
                             "tables": list,  # List of relevant tables
                             "figures": list  # List of relevant figures
                         },
-                        "evaluation": dict  # Evaluation results (if metrics provided)
+                        "evaluation": dict,  # Evaluation results (if metrics provided), or their
+                                             # {"eval_id", "status", ...} in background evaluation mode
+                        "context_tokens": dict,  # Context packing statistics (None if packing is disabled)
+                        "relevance": float,  # Relevance of the best retrieved chunk (None if unknown)
+                        "skipped": bool,  # True if relevance gating skipped the answer call
+                        "_context_chunks": list,  # Chunks sent to the LLM; moved to the result store
+                                                  # by _iter_rag_results_ before results are returned
+                        "_stage_seconds": dict  # Seconds per stage (retrieval, packing, answer, evaluation);
+                                                # moved to the request metadata by _iter_rag_results_
                     }
                 }
 
@@ -294,77 +1025,267 @@ class DataService(object):
 
         Note:
             This method performs several steps:
-            1. Retrieves relevant information using the provided retriever.
-            2. Generates an answer using a language model.
-            3. Classifies and processes the context (text, tables, figures).
-            4. Optionally evaluates the answer quality.
+            1. Retrieves relevant information using the provided retriever. With relevance gating,
+               a paper whose best chunk is below `relevance_gating.min_relevance` gets an "Empty"
+               answer without an LLM call.
+            2. Packs the retrieved chunks into the per-paper token budget (see context_packing.py).
+            3. Generates an answer using a language model.
+            4. Classifies and processes the context (text, tables, figures).
+            5. Optionally evaluates the answer quality.
         """
         pdf_file = retriever_item[0]
         retriever = retriever_item[1]
-        chain = utils.build_rag_chain(retriever)
-
-        response = chain.invoke({
-                "question": question,
-                "ans_format": answer_format
-            },)
+        seconds = {"retrieval": retrieval_seconds}
+        time0 = time.time()
+        if GV.use_relevance_gating and context is None:
+            context, relevance = utils.retrieve_with_relevance(retriever, question)
+        if self._below_min_relevance_(relevance):
+            result = self._skipped_result_(pdf_file, answer_format, relevance)
+            seconds["retrieval"] += time.time() - time0
+            result[pdf_file][stage_seconds_key] = seconds
+            return result
+        packing = None
+        if GV.use_context_packing and context is None:
+            context = retriever.invoke(question)
+        seconds["retrieval"] += time.time() - time0
+        if GV.use_context_packing:
+            time0 = time.time()
+            context, packing = self._pack_context_(context, question)
+            seconds["packing"] = time.time() - time0
+        # without packing or a given context, the chain retrieves itself and that counts as answer time
+        chain, chain_input = self._rag_chain_input_(retriever, question, answer_format, context)
+        time0 = time.time()
+        response = chain.invoke(chain_input)
+        seconds["answer"] = time.time() - time0
+        self._observe_answer_latency_(seconds["answer"])
         answer = json.loads(response["answer"])[ans_key]
         context = response["context"]
 
         # LLM evaluation result according to the hyperparameter
-        time1 = time.time()
-        if evaluation_metrics != None:
-            evaluation = llmeval.llm_evaluate_deepeval(metrics=evaluation_metrics, question=str(question), answer=str(answer), contexts=str(context))
+        time0 = time.time()
+        evaluation = self._evaluate_(evaluation_metrics, question, answer, context)
+        seconds["evaluation"] = time.time() - time0
+        result = self._paper_result_(pdf_file, answer, context, evaluation, packing, relevance=relevance)
+        result[pdf_file][context_chunks_key] = context
+        result[pdf_file][stage_seconds_key] = seconds
+        return result
+
+    async def aprocess_rag_retriever(self, retriever_item: tuple,
+                                     question: str, answer_format: str, evaluation_metrics = None, context: list = None,
+                                     relevance: float = None, retrieval_seconds: float = 0.0) -> dict:
+        """
+        Async variant of process_rag_retriever: the answer chain runs with ainvoke and the
+        (blocking) evaluation is moved to a worker thread. Takes the same arguments and
+        returns the same structure.
+        """
+        pdf_file = retriever_item[0]
+        retriever = retriever_item[1]
+        seconds = {"retrieval": retrieval_seconds}
+        time0 = time.time()
+        if GV.use_relevance_gating and context is None:
+            context, relevance = await utils.aretrieve_with_relevance(retriever, question)
+        if self._below_min_relevance_(relevance):
+            result = await asyncio.to_thread(self._skipped_result_, pdf_file, answer_format, relevance)
+            seconds["retrieval"] += time.time() - time0
+            result[pdf_file][stage_seconds_key] = seconds
+            return result
+        packing = None
+        if GV.use_context_packing and context is None:
+            context = await retriever.ainvoke(question)
+        seconds["retrieval"] += time.time() - time0
+        if GV.use_context_packing:
+            time0 = time.time()
+            context, packing = await asyncio.to_thread(self._pack_context_, context, question)
+            seconds["packing"] = time.time() - time0
+        chain, chain_input = self._rag_chain_input_(retriever, question, answer_format, context)
+        time0 = time.time()
+        response = await chain.ainvoke(chain_input)
+        seconds["answer"] = time.time() - time0
+        self._observe_answer_latency_(seconds["answer"])
+        answer = json.loads(response["answer"])[ans_key]
+        context = response["context"]
+
+        time0 = time.time()
+        evaluation = await asyncio.to_thread(self._evaluate_, evaluation_metrics, question, answer, context)
+        seconds["evaluation"] = time.time() - time0
+        # classification reads the paper's table/figure files, keep it off the event loop
+        result = await asyncio.to_thread(self._paper_result_, pdf_file, answer, context, evaluation, packing, relevance)
+        result[pdf_file][context_chunks_key] = context
+        result[pdf_file][stage_seconds_key] = seconds
+        return result
+
+    def process_multi_rag_retriever(self, pdf_file: str, questions: list, answer_formats: list, retrieved: list,
+                                    evaluation_metrics = None) -> list:
+        """
+        Answer several questions about one paper with a single LLM call (see run_multi_rag_qa).
+
+        Args:
+            pdf_file (str): The paper.
+            questions (list): The questions.
+            answer_formats (list): Answer structure (JSON string) of every question.
+            retrieved (list): (parent chunks, relevance) retrieved for every question.
+            evaluation_metrics (list, optional): Metrics to evaluate each answer. Defaults to None.
+
+        Returns:
+            list: One result per question, each structured as returned by process_rag_retriever.
+        """
+        keys = ["question_%d" % (index + 1) for index in range(len(questions))]
+        structures = [json.loads(answer_format)[ans_key] for answer_format in answer_formats]
+        relevances = [relevance for _, relevance in retrieved if relevance is not None]
+        relevance = max(relevances) if relevances else None
+
+        # interleave the questions' chunks by rank, so every question's best chunks survive packing
+        context = []
+        for rank in range(max((len(chunks) for chunks, _ in retrieved), default=0)):
+            for chunks, _ in retrieved:
+                if rank < len(chunks) and chunks[rank] not in context:
+                    context.append(chunks[rank])
+
+        if self._below_min_relevance_(relevance):
+            answers = [utils.empty_answer(structure) for structure in structures]
+            base = self._paper_result_(pdf_file, None, [], None, relevance=relevance, skipped=True)[pdf_file]
         else:
+            merged_question = "Answer each of the following questions under its key in the answer structure:\n" + \
+                "\n".join(f"{key}: {question}" for key, question in zip(keys, questions))
+            merged_format = json.dumps({ans_key: dict(zip(keys, structures))})
+            packing = None
+            if GV.use_context_packing:
+                context, packing = self._pack_context_(context, " ".join(questions))
+            time0 = time.time()
+            response = utils.get_rag_chain().invoke({
+                "question": merged_question,
+                "ans_format": merged_format,
+                "context": context
+            })
+            self._observe_answer_latency_(time.time() - time0)
+            answer = json.loads(response["answer"])[ans_key]
+            answers = [answer.get(key, utils.empty_answer(structure)) if isinstance(answer, dict) else utils.empty_answer(structure)
+                       for key, structure in zip(keys, structures)]
+            base = self._paper_result_(pdf_file, None, response["context"], None, packing, relevance=relevance)[pdf_file]
+
+        results = []
+        for question, answer in zip(questions, answers):
             evaluation = None
-        time2 = time.time()
-        # print("****evaluation time****", time2-time1)
-
-        # -----add two functions: judge the context type and retireve the table-----
-        def check_type(context):
-            # judge the context type
-            table_pattern = r"(Table \d+).*"
-            figure_pattern = r"(Figure \d+).*"
-
-            table_match = re.search(table_pattern, context)
-            figure_match = re.search(figure_pattern, context)
-
-            if table_match:
-                return {"value": "table", "content": table_match.group(1)}
-            elif figure_match:
-                return {"value": "figure", "content": figure_match.group(1)}
-            else:
-                return {"value": "text", "content": context}
-
-        def find_matching_table(file_path, table_name):
-            # retrieve the table from the table database
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-                matching_tables = {}
-                for item in data:
-                    if 'table_name' in item and item['table_name'] == table_name:
-                        if 'table_caption' in item and 'table_content' in item:
-                            matching_tables['table_caption'] = item['table_caption']
-                            matching_tables['table_content'] = item['table_content']
-                            return matching_tables
-                matching_tables['table_caption'] = ""
-                matching_tables['table_content'] = ""
-            return matching_tables
-        
-        def find_matching_figure(file_path, figure_name):
-            # retrieve the figure from the figure database
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-                matching_figures = {}
-                for item in data:
-                    if 'figure_name' in item and item['figure_name'] == figure_name:
-                        if 'figure_caption' in item and 'figure_content' in item:
-                            matching_figures['figure_caption'] = item['figure_caption']
-                            matching_figures['figure_content'] = item['figure_content']
-                            return matching_figures
-                matching_figures['figure_caption'] = ""
-                matching_figures['figure_content'] = ""
-            return matching_figures
-        
+            if not base["skipped"]:
+                evaluation = self._evaluate_(evaluation_metrics, question, answer, response["context"])
+            results.append({pdf_file: dict(base, answer=answer, evaluation=evaluation)})
+        return results
+
+    def process_rag_extension(self, pdf_file: str, question: str, rows, context: list, columns: dict,
+                              column_format: str, retrieved: list) -> dict:
+        """
+        Fill new columns into a paper's existing answer rows with a single LLM call (see extend_rag_qa).
+
+        Args:
+            pdf_file (str): The paper.
+            question (str): The original question.
+            rows (list or dict): The paper's existing answer.
+            context (list): Chunks the existing answer was generated from (None if unknown).
+            columns (dict): New column name -> description.
+            column_format (str): JSON answer structure holding only the new columns.
+            retrieved (list): (parent chunks, relevance) retrieved for every new column.
+
+        Returns:
+            dict: The paper's result as returned by process_rag_retriever, with the merged rows
+                as answer and the extended context under "_context_chunks".
+        """
+        context = list(context or [])
+        new_chunks = []
+        for rank in range(max((len(chunks) for chunks, _ in retrieved), default=0)):
+            for chunks, _ in retrieved:
+                if rank < len(chunks) and chunks[rank] not in context and chunks[rank] not in new_chunks:
+                    new_chunks.append(chunks[rank])
+        relevances = [relevance for _, relevance in retrieved if relevance is not None]
+        relevance = max(relevances) if relevances else None
+
+        packing = None
+        if GV.use_context_packing:
+            new_chunks, packing = self._pack_context_(new_chunks, " ".join([question] + list(columns.values())))
+        context = context + new_chunks
+
+        empty_row = {name: "Empty" for name in columns}
+        if self._below_min_relevance_(relevance) or not context:
+            new_rows, skipped = [], True
+        else:
+            time0 = time.time()
+            response = utils.get_rag_extension_chain().invoke({
+                "question": question,
+                "rows": json.dumps(rows),
+                "ans_format": column_format,
+                "context": context
+            })
+            self._observe_answer_latency_(time.time() - time0)
+            new_rows = json.loads(response)[ans_key]
+            if isinstance(new_rows, dict):
+                new_rows = [new_rows]
+            skipped = False
+
+        def merged(row, index):
+            new_row = new_rows[index] if index < len(new_rows) and isinstance(new_rows[index], dict) else {}
+            return dict(row, **{name: new_row.get(name, "Empty") for name in columns})
+
+        if isinstance(rows, list) and rows:
+            answer = [merged(row, index) if isinstance(row, dict) else row for index, row in enumerate(rows)]
+        elif isinstance(rows, dict):
+            answer = merged(rows, 0)
+        else:
+            answer = [merged({}, index) for index in range(len(new_rows))] or [empty_row]
+
+        result = self._paper_result_(pdf_file, answer, context, None, packing, relevance=relevance, skipped=skipped)
+        result[pdf_file][context_chunks_key] = context
+        return result
+
+    def _evaluate_(self, evaluation_metrics, question: str, answer, context: list):
+        """
+        Score an answer with deepeval, reusing cached scores (see evaluation_queue.py).
+
+        Returns:
+            dict or None: The scores (metric name -> score) in inline mode; in background mode the
+                evaluation status ({"eval_id", "status", "scores", "error"}), whose scores can be
+                fetched later by eval_id. None without metrics.
+        """
+        if evaluation_metrics == None:
+            return None
+        if GV.evaluation_mode == "background":
+            return self.evaluations.submit(evaluation_metrics, str(question), str(answer), str(context),
+                                           mode=GV.evaluation_scoring_mode)
+        return self.evaluations.evaluate(evaluation_metrics, str(question), str(answer), str(context),
+                                         mode=GV.evaluation_scoring_mode)
+
+    def _pack_context_(self, context: list, question: str) -> tuple:
+        """
+        Dedup and trim a paper's retrieved chunks to `context_packing.max_tokens_per_paper`.
+
+        Returns:
+            tuple: (packed chunks, packing statistics), see context_packing.pack_context.
+        """
+        return pack_context(context, question, GV.context_max_tokens, GV.context_overlap_threshold)
+
+    def _rag_chain_input_(self, retriever, question: str, answer_format: str, context: list = None) -> tuple:
+        """
+        Pick the RAG chain for a paper and build its input.
+
+        Returns:
+            tuple: (chain, chain_input). With precomputed `context` the shared prebuilt chain is used,
+                otherwise a chain that queries `retriever` with the question.
+        """
+        if context is not None:
+            return utils.get_rag_chain(), {
+                "question": question,
+                "ans_format": answer_format,
+                "context": context
+            }
+        return utils.build_rag_chain(retriever), {
+            "question": question,
+            "ans_format": answer_format
+        }
+
+    def _paper_result_(self, pdf_file: str, answer, context: list, evaluation, packing: dict = None,
+                       relevance: float = None, skipped: bool = False) -> dict:
+        """
+        Classify the retrieved context of a paper into text, tables and figures and
+        assemble the per-paper result returned by process_rag_retriever.
+        """
         def extract_table_and_text(context, table_pattern=r"(Table \d+)"):
             # Split the context into parts before, during, and after the table
             parts = re.split(table_pattern, context, maxsplit=1)
@@ -372,59 +1293,61 @@ class DataService(object):
             table_text = parts[1].strip() if len(parts) > 1 else ""
             non_table_text_after = parts[2].strip() if len(parts) > 2 else ""
             return non_table_text_before, table_text, non_table_text_after
-        # ----------------------------------end------------------------------------
+
+        # chunk types and the paper's tables/figures are indexed in memory (see paper_artifacts.py)
+        artifacts = get_paper_artifacts(pdf_file)
         context_classification = {"text": [], "tables": [], "figures": []}
         added_figures = set()
-        added_tables = set()    
+        added_tables = set()
         for c in context:
-            type = check_type(c)
+            type = artifacts.classify(c)
             if type["value"] == "text":
                 context_classification["text"].append({
                     "content": type["content"]
                 })
             elif type["value"] == "table":
-                try:
-                    retrieved_table = find_matching_table(os.path.join(GV.table_dir, retriever_item[0].split('.')[0] + '.json'), type["content"])
-                    if retrieved_table and type["content"] not in added_tables:
-                        # cover non-table string before and after the table string, and add them into the CONTEXTS
-                        non_table_text, table_text, non_table_text_after = extract_table_and_text(c)
-                        context_classification["text"].append({
-                            "content": non_table_text + "\n ...\n" + non_table_text_after
-                        })
-                        # print("non_table_text", non_table_text, "\n ... \n", non_table_text_after)
-                        context_classification["tables"].append({
-                            "content": retrieved_table['table_content'],
-                            "name": type["content"],
-                            "caption": retrieved_table['table_caption']
-                        })
-                        added_tables.add(type["content"])
-                except:
+                retrieved_table = artifacts.find_table(type["content"])
+                if retrieved_table is None:
+                    # no table file for this paper
                     context_classification["text"].append({
                         "content": c
                     })
+                elif type["content"] not in added_tables:
+                    # cover non-table string before and after the table string, and add them into the CONTEXTS
+                    non_table_text, table_text, non_table_text_after = extract_table_and_text(c)
+                    context_classification["text"].append({
+                        "content": non_table_text + "\n ...\n" + non_table_text_after
+                    })
+                    context_classification["tables"].append({
+                        "content": retrieved_table['table_content'],
+                        "name": type["content"],
+                        "caption": retrieved_table['table_caption']
+                    })
+                    added_tables.add(type["content"])
             elif type["value"] == "figure":
-                try:
-                    retrieved_figure = find_matching_figure(os.path.join(GV.figure_dir, retriever_item[0].split('.')[0] + '.json'), type["content"])
-                    if retrieved_figure and type["content"] not in added_figures:
-                        context_classification["figures"].append({
-                            "content": retrieved_figure['figure_content'],
-                            "name": type["content"],
-                            "caption": retrieved_figure['figure_caption']
-                        })
-                        added_figures.add(type["content"])
-                except:
+                retrieved_figure = artifacts.find_figure(type["content"])
+                if retrieved_figure is None:
+                    # no figure file for this paper
                     context_classification["text"].append({
                         "content": c
                     })
+                elif type["content"] not in added_figures:
+                    context_classification["figures"].append({
+                        "content": retrieved_figure['figure_content'],
+                        "name": type["content"],
+                        "caption": retrieved_figure['figure_caption']
+                    })
+                    added_figures.add(type["content"])
         return { 
             pdf_file: {
                 "answer": answer,
                 "context": context_classification,
-                "evaluation": evaluation
+                "evaluation": evaluation,
+                "context_tokens": packing,
+                "relevance": relevance,
+                "skipped": skipped
             }
         }
-    
-    
 
 
 if __name__ == "__main__":
@@ -0,0 +1,304 @@
+"""
+evaluation_queue.py - Cached, Batched deepeval Scoring off the Answer Path
+
+Scoring an answer with deepeval takes several LLM calls, which used to be added to the
+latency of every paper. This module caches scores by (metrics, question, answer, context
+hash, scoring mode) and, in background mode, returns an evaluation id at once while worker threads score
+the queued answers in batches: one deepeval.evaluate() call over many LLMTestCases.
+
+Queued and finished evaluations are kept in SQLite, so an evaluation id stays valid across
+restarts (pending ones are queued again at startup) and clients can fetch or stream the
+scores later.
+
+Main Components:
+- evaluation_id: Cache key of an evaluation.
+- EvaluationQueue: Cache, background batch workers and status lookups.
+
+Scoring modes (see llm_eval.llm_evaluate_deepeval): "llm" for the deepeval LLM judge,
+"embedding" for the fast cosine-similarity proxies.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import llm_eval as llmeval
+except:
+    import app.dataService.llm_eval as llmeval
+
+EVAL_PENDING = "pending"
+EVAL_DONE = "done"
+EVAL_FAILED = "failed"
+EVAL_UNKNOWN = "unknown"
+
+
+def evaluation_id(metrics: list, question: str, answer: str, context: str, mode: str = "llm") -> str:
+    payload = json.dumps({
+        "metrics": sorted(metrics),
+        "mode": mode,
+        "question": question,
+        "answer": answer,
+        "context": hashlib.sha256(context.encode("utf-8")).hexdigest(),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EvaluationQueue(object):
+    def __init__(self, path: str, batch_size: int = 16, batch_wait: float = 0.5, workers: int = 2):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            batch_size (int, optional): Maximum number of test cases per deepeval.evaluate() call.
+            batch_wait (float, optional): Seconds a worker waits for a batch to fill up.
+            workers (int, optional): Number of background scoring threads.
+        """
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.num_workers = max(1, workers)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.db_lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS evaluations ("
+                " eval_id TEXT PRIMARY KEY,"
+                " metrics TEXT NOT NULL,"
+                " question TEXT NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " context TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " scores TEXT,"
+                " error TEXT,"
+                " updated_at REAL NOT NULL,"
+                " mode TEXT NOT NULL DEFAULT 'llm')"
+            )
+            # databases created before scoring modes existed
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(evaluations)").fetchall()]
+            if "mode" not in columns:
+                self.conn.execute("ALTER TABLE evaluations ADD COLUMN mode TEXT NOT NULL DEFAULT 'llm'")
+            self.conn.commit()
+            pending = self.conn.execute(
+                "SELECT eval_id, metrics, question, answer, context, mode FROM evaluations WHERE status = ?",
+                (EVAL_PENDING,)).fetchall()
+
+        self.cond = threading.Condition()
+        self.queue = []  # eval_id, oldest first
+        self.cases = {}  # eval_id -> (metrics, question, answer, context, mode) of queued and running cases
+        for eval_id, metrics, question, answer, context, mode in pending:
+            self.queue.append(eval_id)
+            self.cases[eval_id] = (json.loads(metrics), question, answer, context, mode)
+        self.workers = []
+
+        # updated by request threads and workers alike
+        self.stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        if self.queue:
+            with self.cond:
+                self._start_workers_()
+
+    def _start_workers_(self):
+        # called with self.cond held
+        if self.workers:
+            return
+        for index in range(self.num_workers):
+            worker = threading.Thread(target=self._work_, name=f"evaluation-worker-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def evaluate(self, metrics: list, question: str, answer: str, context: str, mode: str = "llm") -> dict:
+        """
+        Score an answer now (inline evaluation), reusing cached scores.
+
+        Returns:
+            dict: metric name -> score.
+        """
+        eval_id = evaluation_id(metrics, question, answer, context, mode)
+        status = self._load_(eval_id)
+        if status["status"] == EVAL_DONE:
+            self._count_(hits=1)
+            return status["scores"]
+        self._count_(misses=1)
+        scores = llmeval.llm_evaluate_deepeval(metrics=metrics, question=question, answer=answer, contexts=context, mode=mode)
+        self._save_(eval_id, metrics, question, answer, context, EVAL_DONE, scores=scores, mode=mode)
+        return scores
+
+    def evaluate_many(self, metrics: list, cases: list, max_parallel: int = 4, mode: str = "llm") -> list:
+        """
+        Score many answers now: identical cases are scored once, cached scores are reused and the
+        rest is split into batches of `batch_size`, at most `max_parallel` of them evaluated at once.
+
+        Args:
+            metrics (list): Metric names.
+            cases (list): (question, answer, context) tuples.
+            max_parallel (int, optional): Maximum number of concurrent deepeval.evaluate() calls.
+            mode (str, optional): Scoring mode, "llm" or "embedding". Defaults to "llm".
+
+        Returns:
+            list: The status ({"eval_id", "status", "scores", "error"}) of every case, in order.
+        """
+        eval_ids = [evaluation_id(metrics, *case, mode=mode) for case in cases]
+        unique = dict(zip(eval_ids, cases))
+        statuses = {eval_id: self._load_(eval_id) for eval_id in unique}
+        missing = [eval_id for eval_id, status in statuses.items() if status["status"] != EVAL_DONE]
+        self._count_(hits=len(unique) - len(missing), misses=len(missing))
+
+        def score_batch(batch):
+            outcomes = self._score_cases_(metrics, [unique[eval_id] for eval_id in batch], mode)
+            for eval_id, (status, scores, error) in zip(batch, outcomes):
+                question, answer, context = unique[eval_id]
+                self._save_(eval_id, metrics, question, answer, context, status, scores=scores, error=error, mode=mode)
+                statuses[eval_id] = {"eval_id": eval_id, "status": status, "scores": scores, "error": error}
+
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(batches)))) as executor:
+                list(executor.map(score_batch, batches))
+        return [statuses[eval_id] for eval_id in eval_ids]
+
+    def submit(self, metrics: list, question: str, answer: str, context: str, mode: str = "llm") -> dict:
+        """
+        Queue an answer for background scoring, unless its scores are cached or already queued.
+
+        Returns:
+            dict: {"eval_id", "status", "scores", "error"}, see status().
+        """
+        eval_id = evaluation_id(metrics, question, answer, context, mode)
+        status = self._load_(eval_id)
+        if status["status"] in (EVAL_DONE, EVAL_PENDING):
+            if status["status"] == EVAL_DONE:
+                self._count_(hits=1)
+            return status
+        self._count_(misses=1)
+        self._save_(eval_id, metrics, question, answer, context, EVAL_PENDING, mode=mode)
+        with self.cond:
+            if eval_id not in self.cases:
+                self.cases[eval_id] = (list(metrics), question, answer, context, mode)
+                self.queue.append(eval_id)
+            self._start_workers_()
+            self.cond.notify_all()
+        return {"eval_id": eval_id, "status": EVAL_PENDING, "scores": None, "error": None}
+
+    def status(self, eval_id: str) -> dict:
+        """
+        Returns:
+            dict: {"eval_id", "status" (pending, done, failed or unknown), "scores", "error"}.
+        """
+        return self._load_(eval_id)
+
+    def wait(self, eval_ids: list, timeout: float = None):
+        """
+        Yield the status of every evaluation once it is no longer pending, in completion order.
+        Evaluations still pending after `timeout` seconds are yielded as pending.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        remaining = list(dict.fromkeys(eval_ids))
+        while remaining:
+            with self.cond:
+                # statuses are read under the condition, so a completion cannot be missed between checks
+                statuses = [self._load_(eval_id) for eval_id in remaining]
+                finished = [status for status in statuses if status["status"] != EVAL_PENDING]
+                if not finished:
+                    wait = None if deadline is None else deadline - time.time()
+                    if wait is not None and wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                    continue
+            for status in finished:
+                remaining.remove(status["eval_id"])
+                yield status
+        for eval_id in remaining:
+            yield self._load_(eval_id)
+
+    def _work_(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                # give concurrent papers a moment to join the batch
+                deadline = time.time() + self.batch_wait
+                while len(self.queue) < self.batch_size and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                if not self.queue:
+                    continue
+                # one evaluate() call scores one set of metrics in one mode
+                group = (sorted(self.cases[self.queue[0]][0]), self.cases[self.queue[0]][4])
+                batch = [eval_id for eval_id in self.queue
+                         if (sorted(self.cases[eval_id][0]), self.cases[eval_id][4]) == group][:self.batch_size]
+                metrics, mode = group
+                self.queue = [eval_id for eval_id in self.queue if eval_id not in batch]
+                cases = [self.cases[eval_id] for eval_id in batch]
+            time0 = time.time()
+            outcomes = self._score_cases_(metrics, [(question, answer, context) for _, question, answer, context, _ in cases], mode)
+            print(f"evaluated {len(batch)} answers in {time.time() - time0:.1f} seconds")
+            for eval_id, case, (status, scores, error) in zip(batch, cases, outcomes):
+                self._save_(eval_id, case[0], case[1], case[2], case[3], status, scores=scores, error=error, mode=mode)
+            with self.cond:
+                for eval_id in batch:
+                    self.cases.pop(eval_id, None)
+                self.cond.notify_all()
+
+    def _score_cases_(self, metrics: list, cases: list, mode: str = "llm") -> list:
+        """
+        Score (question, answer, context) cases with one deepeval.evaluate() call. If the batch
+        fails, its cases are scored one by one, so a single bad case does not fail the others.
+
+        Returns:
+            list: (status, scores, error) per case.
+        """
+        try:
+            results = llmeval.llm_evaluate_deepeval_batch(metrics, cases, mode=mode)
+            self._count_(batches=1)
+            return [(EVAL_DONE, scores, None) for scores in results]
+        except Exception as e:
+            print(f"evaluation batch of {len(cases)} failed: {e}")
+            if len(cases) == 1:
+                return [(EVAL_FAILED, None, str(e))]
+            return [outcome for case in cases for outcome in self._score_cases_(metrics, [case], mode)]
+
+    def _count_(self, hits: int = 0, misses: int = 0, batches: int = 0):
+        with self.stats_lock:
+            self.hits += hits
+            self.misses += misses
+            self.batches += batches
+
+    def _load_(self, eval_id: str) -> dict:
+        with self.db_lock:
+            row = self.conn.execute("SELECT status, scores, error FROM evaluations WHERE eval_id = ?", (eval_id,)).fetchone()
+        if row is None:
+            return {"eval_id": eval_id, "status": EVAL_UNKNOWN, "scores": None, "error": None}
+        return {"eval_id": eval_id, "status": row[0], "scores": json.loads(row[1]) if row[1] else None, "error": row[2]}
+
+    def _save_(self, eval_id: str, metrics: list, question: str, answer: str, context: str, status: str,
+               scores: dict = None, error: str = None, mode: str = "llm"):
+        with self.db_lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO evaluations"
+                " (eval_id, metrics, question, answer, context, status, scores, error, updated_at, mode)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (eval_id, json.dumps(list(metrics)), question, answer, context, status,
+                 json.dumps(scores) if scores is not None else None, error, time.time(), mode))
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self.cond:
+            queued = len(self.queue)
+            running = len(self.cases) - queued
+        with self.stats_lock:
+            hits, misses, batches = self.hits, self.misses, self.batches
+        requests = hits + misses
+        return {
+            "queued": queued,
+            "running": running,
+            "batches": batches,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / requests if requests else None,
+        }
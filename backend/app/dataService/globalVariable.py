@@ -66,9 +66,96 @@ temp_dir = config.get('temp_dir', os.path.join(data_dir, 'temp'))
 table_dir = config.get('table_dir', os.path.join(data_dir, 'table'))
 figure_dir = config.get('figure_dir', os.path.join(data_dir, 'figure'))
 vectorstore_dir = config.get('vectorstore_dir', os.path.join(data_dir, 'vectorstore'))
+cache_dir = config.get('cache_dir', os.path.join(data_dir, 'cache'))
+
+# LLM client settings
+llm = config.get('llm', {})
+llm_max_connections = llm.get('max_connections', 100)  # keep-alive pool shared by all Azure OpenAI clients
+llm_request_timeout = llm.get('request_timeout', 600)  # seconds
+
+# QA concurrency settings
+qa = config.get('qa', {})
+qa_max_workers = qa.get('max_workers', 32)  # size of the worker pool shared by all QA requests
+qa_request_concurrency = qa.get('request_concurrency', qa_max_workers)  # papers of one request in flight at once
+qa_engine = qa.get('engine', 'thread')  # 'thread' (worker pool) or 'async' (asyncio event loop)
+qa_async_concurrency = qa.get('async_concurrency', 256)  # papers in flight at once on the async engine
+
+# QA job settings
+qa_jobs = config.get('qa_jobs', {})
+qa_job_ttl = qa_jobs.get('ttl_seconds', 3600)  # how long finished jobs are kept for polling
+
+# Retriever loading settings
+retriever_cache = config.get('retriever_cache', {})
+retriever_load_mode = retriever_cache.get('mode', 'eager')  # eager: load all at startup, lazy: load on first access
+retriever_memory_budget_mb = retriever_cache.get('memory_budget_mb', None)  # LRU budget for lazy mode, None = unbounded
+retriever_load_workers = retriever_cache.get('load_workers', 8)  # threads loading vectorstores at startup (eager mode)
+retriever_io_concurrency = retriever_cache.get('io_concurrency', 4)  # concurrent vectorstore file reads
+
+# Retrieval settings
+retrieval = config.get('retrieval', {})
+embed_query_once = retrieval.get('embed_query_once', True)  # one question embedding per request, reused for every paper
+
+# Corpus-wide vector index settings
+corpus_index = config.get('corpus_index', {})
+use_corpus_index = corpus_index.get('enabled', False)  # search one merged index instead of one index per paper (eager retriever mode only)
+corpus_index_k = corpus_index.get('k', 4)  # summary vectors retrieved per selected paper
+
+# Relevance gating settings
+relevance_gating = config.get('relevance_gating', {})
+use_relevance_gating = relevance_gating.get('enabled', False)  # skip the answer call for papers unlikely to contain the answer
+relevance_min_score = relevance_gating.get('min_relevance', 0.75)  # best-chunk cosine relevance below which a paper is skipped (None disables)
+relevance_top_n = relevance_gating.get('top_n_papers', None)  # answer only the N papers with the best chunk relevance (None disables)
+
+# Rate limit settings
+rate_limits = config.get('rate_limits', {})
+rate_limit_enabled = rate_limits.get('enabled', True)  # pace and retry Azure OpenAI calls per deployment
+rate_limit_max_retries = rate_limits.get('max_retries', 8)  # retries of a throttled (429) or transiently failed call
+rate_limit_backoff_base = rate_limits.get('backoff_base', 1.0)  # seconds before the first retry, doubled per retry
+rate_limit_backoff_max = rate_limits.get('backoff_max', 60.0)
+rate_limit_output_tokens = rate_limits.get('expected_output_tokens', 500)  # completion tokens reserved when max_tokens is unset
+rate_limit_default = rate_limits.get('default') or {'max_concurrency': llm_max_connections}
+rate_limit_deployments = rate_limits.get('deployments') or {}  # deployment -> tokens_per_minute, requests_per_minute, max_concurrency
+
+# Context packing settings
+context_packing = config.get('context_packing', {})
+use_context_packing = context_packing.get('enabled', True)  # dedup and trim retrieved chunks before the answer call
+context_max_tokens = context_packing.get('max_tokens_per_paper', 6000)  # token budget of one paper's context
+context_overlap_threshold = context_packing.get('overlap_threshold', 0.8)  # shingle overlap above which a chunk is a duplicate
+
+# Answer cache settings
+answer_cache = config.get('answer_cache', {})
+use_answer_cache = answer_cache.get('enabled', True)  # reuse per-paper answers of repeated questions
+answer_cache_path = answer_cache.get('path', os.path.join(cache_dir, 'answers.sqlite'))
+
+# Answer structure cache settings
+answer_structure_cache = config.get('answer_structure_cache', {})
+use_answer_structure_cache = answer_structure_cache.get('enabled', True)  # reuse the answer structure of repeated questions
+answer_structure_cache_size = answer_structure_cache.get('max_entries', 1024)  # in-memory LRU capacity
+answer_structure_cache_persistent = answer_structure_cache.get('persistent', True)  # also store them in answer_cache_path
+
+# Result store settings
+result_store = config.get('result_store', {})
+use_result_store = result_store.get('enabled', True)  # keep results and their context so columns can be added later
+result_store_path = result_store.get('path', os.path.join(cache_dir, 'results.sqlite'))
+result_store_ttl = result_store.get('ttl_seconds', 7 * 24 * 3600)  # results untouched for longer are dropped
+
+# Evaluation settings
+evaluation = config.get('evaluation', {})
+evaluation_mode = evaluation.get('mode', 'inline')  # inline: score answers before returning them, background: score them later in batches
+evaluation_scoring_mode = evaluation.get('scoring_mode', 'llm')  # llm: deepeval LLM judge, embedding: fast cosine-similarity proxies
+evaluation_batch_size = evaluation.get('batch_size', 16)  # answers per deepeval evaluate() call
+evaluation_batch_wait = evaluation.get('batch_wait_seconds', 0.5)  # how long a batch may wait to fill up
+evaluation_workers = evaluation.get('workers', 2)  # background scoring threads
+evaluation_max_parallel_batches = evaluation.get('max_parallel_batches', 4)  # concurrent evaluate() calls of one batch request
+evaluation_cache_path = evaluation.get('path', os.path.join(cache_dir, 'evaluations.sqlite'))
+
+# Ingestion manifest settings
+ingest_manifest = config.get('ingest_manifest', {})
+ingest_manifest_path = ingest_manifest.get('path', os.path.join(cache_dir, 'ingest_manifest.sqlite'))  # per-PDF content hashes and completed stages
+summary_cache_path = ingest_manifest.get('summary_cache_path', os.path.join(cache_dir, 'summaries.sqlite'))  # chunk summaries by model, prompt and text
 
 # Create directories if they don't exist
-for directory in [data_dir, meta_dir, temp_dir, table_dir, figure_dir, vectorstore_dir]:
+for directory in [data_dir, meta_dir, temp_dir, table_dir, figure_dir, vectorstore_dir, cache_dir]:
     os.makedirs(directory, exist_ok=True)
 
 # Configure OpenAI/Azure credentials for downstream modules
@@ -0,0 +1,163 @@
+"""
+ingest_pipeline.py - Per-Document Stage Scheduler for PDF Ingestion
+
+Ingestion of a folder used to run one stage over every PDF before starting the next, so a
+paper became queryable only once the whole folder was done. Here every document has its own
+small dependency graph of stages (e.g. figures, tables and meta in parallel, the vectorstore
+after the document's own tables and figures); a stage is submitted as soon as its
+dependencies are done, and each document is yielded as soon as all its stages finished.
+
+Only `max_in_flight` documents are admitted at a time, so the executors work on a few
+documents to completion instead of running the first stage of every document first.
+
+Main Components:
+- Stage: A named step, the stages it depends on, the executor it runs on and when it runs.
+- IngestPipeline: Runs the stage graph of many documents and reports per-stage wall-clock time.
+"""
+
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# function(document, inputs) -> result, where inputs maps each dependency to its result;
+# when(document) -> bool decides whether the stage runs (a stage that does not run yields None)
+Stage = namedtuple("Stage", ["name", "function", "depends_on", "executor", "when"],
+                   defaults=[(), "threads", None])
+
+
+def _timed_(function, document, inputs):
+    # runs in the executor (possibly another process), so only the stage itself is timed
+    time0 = time.perf_counter()
+    result = function(document, inputs)
+    return result, time.perf_counter() - time0
+
+
+class IngestPipeline(object):
+    def __init__(self, stages: list, executors: dict, max_in_flight: int = 16):
+        """
+        Args:
+            stages (list): Stage tuples; dependencies must come before the stages using them.
+            executors (dict): Executor name -> concurrent.futures executor. Functions of stages
+                on a process pool must be picklable (module-level functions or partials).
+            max_in_flight (int, optional): Maximum number of documents being processed at once.
+        """
+        names = set()
+        for stage in stages:
+            missing = [dependency for dependency in stage.depends_on if dependency not in names]
+            if missing:
+                raise ValueError(f"Stage {stage.name} depends on unknown or later stages: {missing}")
+            if stage.executor not in executors:
+                raise ValueError(f"Stage {stage.name} uses unknown executor {stage.executor}")
+            names.add(stage.name)
+        self.stages = stages
+        self.executors = executors
+        self.max_in_flight = max(1, max_in_flight)
+        self.stage_times = {stage.name: [] for stage in stages}
+        self.document_times = []
+        self.wall_clock = None
+
+    def run(self, documents):
+        """
+        Process the documents and yield (document, outputs, errors) for each, in completion
+        order. `outputs` maps stage name -> result; `errors` maps a failed stage (or a stage not
+        run because a dependency failed) to its error message.
+        """
+        time0 = time.perf_counter()
+        queue = list(documents)
+        states = {}  # document -> {"outputs", "errors", "running", "started"}
+        futures = {}  # future -> (document, stage name)
+
+        def schedule(document):
+            state = states[document]
+            for stage in self.stages:
+                if stage.name in state["outputs"] or stage.name in state["errors"] or stage.name in state["running"]:
+                    continue
+                failed = [dependency for dependency in stage.depends_on if dependency in state["errors"]]
+                if failed:
+                    state["errors"][stage.name] = f"skipped, {', '.join(failed)} failed"
+                    continue
+                if any(dependency not in state["outputs"] for dependency in stage.depends_on):
+                    continue
+                if stage.when is not None and not stage.when(document):
+                    state["outputs"][stage.name] = None
+                    continue
+                inputs = {dependency: state["outputs"][dependency] for dependency in stage.depends_on}
+                future = self.executors[stage.executor].submit(_timed_, stage.function, document, inputs)
+                futures[future] = (document, stage.name)
+                state["running"].add(stage.name)
+
+        def admit():
+            # returns the documents with nothing to run (every stage skipped)
+            finished = []
+            while queue and len(states) < self.max_in_flight:
+                document = queue.pop(0)
+                states[document] = {"outputs": {}, "errors": {}, "running": set(), "started": time.perf_counter()}
+                schedule(document)
+                if not states[document]["running"]:
+                    finished.append(document)
+            return finished
+
+        def finish(document):
+            state = states.pop(document)
+            self.document_times.append(time.perf_counter() - time0)
+            return document, state["outputs"], state["errors"]
+
+        finished = admit()
+        while finished or futures:
+            for document in finished:
+                yield finish(document)
+            finished = []
+            if not futures:
+                finished = admit()
+                continue
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                document, name = futures.pop(future)
+                state = states[document]
+                state["running"].discard(name)
+                try:
+                    result, elapsed = future.result()
+                    state["outputs"][name] = result
+                    self.stage_times[name].append(elapsed)
+                except Exception as e:
+                    print(f"Stage {name} failed for {document}: {e}")
+                    state["errors"][name] = str(e)
+                schedule(document)
+                if not state["running"]:
+                    finished.append(document)
+            finished += admit()
+        self.wall_clock = time.perf_counter() - time0
+
+    def timings(self) -> dict:
+        """
+        Returns:
+            dict: "stages": stage name -> {"count", "total", "mean", "max"} (seconds spent in the
+                stage function), "first_document" and "wall_clock" (seconds since the start).
+        """
+        stages = {}
+        for name, times in self.stage_times.items():
+            stages[name] = {
+                "count": len(times),
+                "total": sum(times),
+                "mean": sum(times) / len(times) if times else None,
+                "max": max(times) if times else None,
+            }
+        return {
+            "stages": stages,
+            "first_document": min(self.document_times) if self.document_times else None,
+            "wall_clock": self.wall_clock,
+        }
+
+    def report(self) -> str:
+        timings = self.timings()
+        lines = [f"{'stage':<14} {'count':>6} {'total (s)':>10} {'mean (s)':>9} {'max (s)':>9}"]
+        for name, stage in timings["stages"].items():
+            if not stage["count"]:
+                lines.append(f"{name:<14} {0:>6}")
+                continue
+            lines.append(f"{name:<14} {stage['count']:>6} {stage['total']:>10.1f} {stage['mean']:>9.1f} {stage['max']:>9.1f}")
+        if timings["first_document"] is not None:
+            lines.append(f"first document ready after {timings['first_document']:.1f} s")
+        if timings["wall_clock"] is not None:
+            lines.append(f"wall clock {timings['wall_clock']:.1f} s")
+        return "\n".join(lines)
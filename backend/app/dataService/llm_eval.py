@@ -1,17 +1,25 @@
 import os
 import logging
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Dict, Optional
+import numpy as np
 from deepeval.test_case import LLMTestCase
 from deepeval.metrics import ContextualRelevancyMetric, AnswerRelevancyMetric, FaithfulnessMetric
 from deepeval import evaluate
 
 try:
     import globalVariable as GV
+    import utils
 except:
     from app.dataService import globalVariable as GV
+    import app.dataService.utils as utils
 
 os.environ["OPENAI_API_KEY"] = GV.azure_openai_key
-def llm_evaluate_deepeval(metrics=['faithfulness', 'answer_relevancy', 'contextual_relevancy'], question=None, answer=None, contexts=None):
+def llm_evaluate_deepeval(metrics=['faithfulness', 'answer_relevancy', 'contextual_relevancy'], question=None, answer=None, contexts=None,
+                          mode="llm"):
     """
     Evaluates the LLM response using specified metrics.
 
@@ -20,6 +28,8 @@ def llm_evaluate_deepeval(metrics=['faithfulness', 'answer_relevancy', 'contextu
         question (Optional[str]): The input question.
         answer (Optional[str]): The LLM's answer.
         contexts (Optional[str]): The context provided for the answer.
+        mode (str, optional): "llm" to score with the deepeval LLM judge, "embedding" for the fast
+            cosine-similarity proxies of embedding_evaluate. Defaults to "llm".
 
     Returns:
         Dict[str, float]: A dictionary of metric names and their scores.
@@ -27,12 +37,13 @@ def llm_evaluate_deepeval(metrics=['faithfulness', 'answer_relevancy', 'contextu
     Raises:
         ValueError: If required inputs are missing or invalid metrics are provided.
     """
-    evaluate_case = LLMTestCase(
-        input=question,
-        actual_output=answer,
-        retrieval_context=[contexts]
-    )
+    return llm_evaluate_deepeval_batch(metrics, [(question, answer, contexts)], mode=mode)[0]
 
+def build_metrics(metrics: List[str]) -> list:
+    """
+    Create the deepeval metric objects for the given metric names, in the same order.
+    Unknown names are skipped.
+    """
     evaluate_metrics = []
     for metric in metrics:
         if metric == "faithfulness":
@@ -41,19 +52,156 @@ def llm_evaluate_deepeval(metrics=['faithfulness', 'answer_relevancy', 'contextu
             evaluate_metrics.append(AnswerRelevancyMetric())
         if metric == "contextual_relevancy":
             evaluate_metrics.append(ContextualRelevancyMetric())
+    return evaluate_metrics
+
+def llm_evaluate_deepeval_batch(metrics: List[str], cases: list, mode: str = "llm") -> List[Dict[str, float]]:
+    """
+    Evaluates many LLM responses with one deepeval.evaluate() call.
+
+    Args:
+        metrics (List[str]): List of metrics to evaluate.
+        cases (list): (question, answer, contexts) tuples.
+        mode (str, optional): "llm" or "embedding", see llm_evaluate_deepeval. Defaults to "llm".
+
+    Returns:
+        List[Dict[str, float]]: A dictionary of metric names and their scores per case, in order.
+    """
+    if mode == "embedding":
+        return embedding_evaluate(metrics, cases)
+    metrics = [metric for metric in metrics if metric in ("faithfulness", "answer_relevancy", "contextual_relevancy")]
+    # every case carries its index, results are matched back by it as they may arrive in completion order
+    test_cases = [LLMTestCase(
+        input=question,
+        actual_output=answer,
+        retrieval_context=[contexts],
+        additional_metadata={"case_index": index}
+    ) for index, (question, answer, contexts) in enumerate(cases)]
 
     evaluate_response = evaluate(
-        test_cases=[evaluate_case],
-        metrics=evaluate_metrics,
+        test_cases=test_cases,
+        metrics=build_metrics(metrics),
         print_results=False
     )
 
-    evaluate_result = {}
+    results_by_index = {}
+    results_by_content = {}
     for individual_result in evaluate_response:
+        evaluate_result = {}
         for i in range(0, len(individual_result.metrics_metadata)):
             evaluate_result[metrics[i]] = individual_result.metrics_metadata[i].score
-    
-    return evaluate_result
+        case_index = (getattr(individual_result, "additional_metadata", None) or {}).get("case_index")
+        if case_index is not None:
+            results_by_index[case_index] = evaluate_result
+        # deepeval versions that do not return the metadata are matched by content
+        key = (individual_result.input, individual_result.actual_output, tuple(individual_result.retrieval_context or []))
+        results_by_content[key] = evaluate_result
+
+    evaluate_results = []
+    for index, (question, answer, contexts) in enumerate(cases):
+        evaluate_result = results_by_index.get(index)
+        if evaluate_result is None:
+            evaluate_result = results_by_content.get((question, answer, (contexts,)))
+        evaluate_results.append(evaluate_result or {})
+    return evaluate_results
+
+# Embedding-similarity proxies of the LLM-judged metrics:
+#   answer_relevancy     ~ cos(question, answer)
+#   faithfulness         ~ max cos(answer, context window)
+#   contextual_relevancy ~ max cos(question, context window)
+# Long contexts are split into windows that fit the embedding model.
+CONTEXT_WINDOW_CHARS = 4000
+MAX_CONTEXT_WINDOWS = 16
+
+_embedding_cache = OrderedDict()  # sha256 of text -> unit vector, least recently used first
+_embedding_cache_lock = threading.Lock()
+EMBEDDING_CACHE_SIZE = 4096
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    Unit-length embeddings of `texts`; texts not in the in-memory cache are embedded in one request.
+    """
+    keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+    with _embedding_cache_lock:
+        vectors = {key: _embedding_cache[key] for key in keys if key in _embedding_cache}
+        for key in vectors:
+            _embedding_cache.move_to_end(key)
+    missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+    if missing:
+        texts_by_key = dict(zip(keys, texts))
+        embedded = np.array(utils.get_embedding_model().embed_documents([texts_by_key[key] for key in missing]), dtype=np.float32)
+        embedded /= np.maximum(np.linalg.norm(embedded, axis=1, keepdims=True), 1e-12)
+        with _embedding_cache_lock:
+            for key, vector in zip(missing, embedded):
+                vectors[key] = vector
+                _embedding_cache[key] = vector
+            while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+                _embedding_cache.popitem(last=False)
+    return np.stack([vectors[key] for key in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+
+def _context_windows(contexts) -> List[str]:
+    text = contexts if isinstance(contexts, str) else " ".join(str(c) for c in contexts or [])
+    windows = [text[i:i + CONTEXT_WINDOW_CHARS] for i in range(0, len(text), CONTEXT_WINDOW_CHARS)]
+    return [window for window in windows if window.strip()][:MAX_CONTEXT_WINDOWS]
+
+def embedding_evaluate(metrics: List[str], cases: list) -> List[Dict[str, float]]:
+    """
+    Fast cosine-similarity proxies of the deepeval metrics, computed from (cached) embeddings.
+    All texts of all cases are embedded in one request. Scores are clipped to [0, 1]; metrics
+    that need a context score None when the context is empty.
+
+    Args:
+        metrics (List[str]): List of metrics to evaluate.
+        cases (list): (question, answer, contexts) tuples.
+
+    Returns:
+        List[Dict[str, float]]: A dictionary of metric names and their scores per case, in order.
+    """
+    texts = []
+    layout = []
+    for question, answer, contexts in cases:
+        windows = _context_windows(contexts)
+        start = len(texts)
+        texts += [str(question) or " ", str(answer) or " "] + windows
+        layout.append((start, len(windows)))
+    vectors = embed_texts(texts)
+
+    evaluate_results = []
+    for start, num_windows in layout:
+        question_vector, answer_vector = vectors[start], vectors[start + 1]
+        context_vectors = vectors[start + 2:start + 2 + num_windows]
+        evaluate_result = {}
+        for metric in metrics:
+            if metric == "answer_relevancy":
+                score = float(question_vector @ answer_vector)
+            elif metric == "faithfulness":
+                score = float(np.max(context_vectors @ answer_vector)) if num_windows else None
+            elif metric == "contextual_relevancy":
+                score = float(np.max(context_vectors @ question_vector)) if num_windows else None
+            else:
+                continue
+            evaluate_result[metric] = min(max(score, 0.0), 1.0) if score is not None else None
+        evaluate_results.append(evaluate_result)
+    return evaluate_results
+
+def benchmark_scoring_modes(cases: list, metrics=['faithfulness', 'answer_relevancy', 'contextual_relevancy']) -> dict:
+    """
+    Score `cases` with both modes and report each mode's latency and, per metric, the Spearman
+    rank correlation of the embedding proxies with the deepeval scores.
+    """
+    from scipy.stats import spearmanr
+
+    report = {}
+    scores = {}
+    for mode in ("llm", "embedding"):
+        time0 = time.time()
+        scores[mode] = llm_evaluate_deepeval_batch(metrics, cases, mode=mode)
+        report[f"{mode}_seconds"] = time.time() - time0
+    for metric in metrics:
+        pairs = [(llm[metric], fast[metric]) for llm, fast in zip(scores["llm"], scores["embedding"])
+                 if llm.get(metric) is not None and fast.get(metric) is not None]
+        if len(pairs) >= 3:
+            report[f"{metric}_spearman"] = spearmanr([p[0] for p in pairs], [p[1] for p in pairs]).correlation
+    return report
 
 if __name__ == "__main__":
    # Test cases
@@ -71,4 +219,24 @@ if __name__ == "__main__":
                     answer=case["answer"],
                     contexts=case["contexts"]
                 )
-        print(f"evaluation result: {result}")
\ No newline at end of file
+        print(f"evaluation result: {result}")
+
+    # scoring mode benchmark: latency and rank agreement of the embedding proxies with deepeval
+    benchmark_cases = [(case["question"], case["answer"], case["contexts"]) for case in test_cases] + [
+        ("What is multi-modality in AI?",
+         "Multi-modality is when a model is trained on several GPUs.",
+         "Multi-modality in AI refers to the integration of information from multiple modalities such as text and images."),
+        ("What is multi-modality in AI?",
+         "The weather in Paris is mild in spring.",
+         "Multi-modality in AI refers to the integration of information from multiple modalities such as text and images."),
+        ("How many parameters does the model have?",
+         "The model has 7 billion parameters.",
+         "We train a 7B parameter decoder-only transformer on 1T tokens using 256 A100 GPUs."),
+        ("How many parameters does the model have?",
+         "The model was trained on 256 A100 GPUs.",
+         "We train a 7B parameter decoder-only transformer on 1T tokens using 256 A100 GPUs."),
+        ("What dataset was used for evaluation?",
+         "Empty",
+         "Table 3 reports accuracy on GSM8K and MATH for all model sizes."),
+    ]
+    print(f"benchmark: {benchmark_scoring_modes(benchmark_cases)}")
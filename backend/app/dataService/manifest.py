@@ -0,0 +1,162 @@
+"""
+manifest.py - Content-Hash Manifest for Incremental, Resumable Preprocessing
+
+preprocess.py used to rerun figure, table and meta extraction (LLM calls) for every PDF on
+every run, and only skipped vectorstores that existed, even if the PDF had changed since.
+The manifest records, per PDF and stage, the PDF's content hash, a fingerprint of the
+settings the stage output depends on (models, prompts, chunking) and the output files. A
+stage is rerun only if one of them changed, an output is missing, or a stage it depends on
+was rerun after it. Each stage is recorded in its own SQLite transaction once its outputs
+are written, so an interrupted run resumes with the stages that had not finished.
+
+Chunk summaries are cached by model, prompt and chunk text, so a vectorstore interrupted
+while summarizing, or rebuilt with a few changed chunks, does not summarize the other chunks
+again.
+
+Main Components:
+- stage_fingerprint: Hash of the settings a stage's output depends on.
+- IngestManifest: Per-PDF, per-stage content hashes, fingerprints and outputs.
+- SummaryCache: Chunk summaries keyed by model, prompt and chunk text.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def stage_fingerprint(**settings) -> str:
+    payload = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class IngestManifest(object):
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS stages ("
+                " pdf_file TEXT NOT NULL,"
+                " stage TEXT NOT NULL,"
+                " content_hash TEXT NOT NULL,"
+                " fingerprint TEXT NOT NULL,"
+                " outputs TEXT NOT NULL,"
+                " completed_at REAL NOT NULL,"
+                " PRIMARY KEY (pdf_file, stage))"
+            )
+            self.conn.commit()
+
+    def is_current(self, pdf_file: str, content_hash: str, stage: str, fingerprint: str, outputs: list, after: tuple = ()) -> bool:
+        """
+        Whether a stage's recorded outputs are up to date: same PDF content, same fingerprint,
+        same output files that all still exist, and completed after the stages in `after`.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT stage, content_hash, fingerprint, outputs, completed_at FROM stages WHERE pdf_file = ?",
+                (pdf_file,)).fetchall()
+        records = {row[0]: row[1:] for row in rows}
+        if stage not in records:
+            return False
+        recorded_hash, recorded_fingerprint, recorded_outputs, completed_at = records[stage]
+        if recorded_hash != content_hash or recorded_fingerprint != fingerprint or json.loads(recorded_outputs) != list(outputs):
+            return False
+        if not all(os.path.exists(output) for output in outputs):
+            return False
+        # a dependency rebuilt after this stage makes it stale
+        return all(records[dependency][3] <= completed_at for dependency in after if dependency in records)
+
+    def mark_done(self, pdf_file: str, content_hash: str, stage: str, fingerprint: str, outputs: list, completed_at: float = None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages (pdf_file, stage, content_hash, fingerprint, outputs, completed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (pdf_file, stage, content_hash, fingerprint, json.dumps(list(outputs)),
+                 time.time() if completed_at is None else completed_at))
+            self.conn.commit()
+
+    def adopt(self, pdf_file: str, content_hash: str, stages: dict) -> list:
+        """
+        Record outputs built before the manifest existed as up to date, so upgrading does not
+        rebuild the whole corpus. Only done for PDFs without any manifest record, and only for
+        stages whose outputs all exist.
+
+        Args:
+            stages (dict): stage -> (fingerprint, outputs).
+
+        Returns:
+            list: The adopted stages.
+        """
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM stages WHERE pdf_file = ? LIMIT 1", (pdf_file,)).fetchone():
+                return []
+            adopted = [stage for stage, (_, outputs) in stages.items() if all(os.path.exists(output) for output in outputs)]
+            completed_at = time.time()
+            self.conn.executemany(
+                "INSERT INTO stages (pdf_file, stage, content_hash, fingerprint, outputs, completed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(pdf_file, stage, content_hash, stages[stage][0], json.dumps(list(stages[stage][1])), completed_at)
+                 for stage in adopted])
+            self.conn.commit()
+        return adopted
+
+
+class SummaryCache(object):
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                " key TEXT PRIMARY KEY,"
+                " summary TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, prompt: str, text: str) -> str:
+        return stage_fingerprint(model=model, prompt=prompt, text=text)
+
+    def get_many(self, model: str, prompt: str, texts: list) -> dict:
+        """
+        Returns:
+            dict: text -> cached summary, for the texts that have one.
+        """
+        keys = {self.make_key(model, prompt, text): text for text in texts}
+        found = {}
+        with self.lock:
+            key_list = list(keys)
+            # stay below SQLite's limit of bound parameters per statement
+            for i in range(0, len(key_list), 500):
+                batch = key_list[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, summary FROM summaries WHERE key IN ({', '.join('?' * len(batch))})", batch).fetchall()
+                found.update({keys[key]: summary for key, summary in rows})
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, model: str, prompt: str, text: str, summary: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO summaries (key, summary, created_at) VALUES (?, ?, ?)",
+                              (self.make_key(model, prompt, text), summary, time.time()))
+            self.conn.commit()
@@ -0,0 +1,162 @@
+"""
+paper_artifacts.py - In-Memory Table/Figure Index and Chunk Annotations per Paper
+
+Classifying a paper's retrieved context needs its extracted tables and figures
+(`<table_dir>/<paper>.json`, `<figure_dir>/<paper>.json`) and the type of every retrieved
+chunk. This module loads each paper's table and figure records once into dicts keyed by
+normalized name and remembers the type of every chunk, so classification is a few dict
+lookups without file I/O. The index is shared by all requests and reloaded when a JSON
+file changes.
+
+Chunk types are annotated at ingest time (`chunk_type` / `chunk_name` in the summary
+metadata written by utils.save_local_document_vector_store) and registered when the
+paper's vectorstore is loaded; chunks of older vectorstores are classified on first sight.
+Annotations are keyed by a short hash of the chunk text, and a paper's entry is dropped when
+its retriever is evicted from the retriever cache, so the index does not keep chunk texts alive.
+
+Main Components:
+- PaperArtifacts: Tables, figures and chunk annotations of one paper.
+- get_paper_artifacts: Returns the shared, up-to-date PaperArtifacts of a paper.
+- drop_paper_artifacts: Forgets a paper (called when its retriever is evicted).
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import globalVariable as GV
+    import utils
+except:
+    import app.dataService.globalVariable as GV
+    import app.dataService.utils as utils
+
+
+def _file_stat_(path: str):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _load_records_(path: str, name_key: str, caption_key: str, content_key: str, normalize):
+    """
+    Index the records of a table/figure JSON file by normalized name.
+    Returns None if the file does not exist or cannot be parsed; the first complete record
+    of a name wins.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Failed to load {path}: {e}")
+        return None
+    records = {}
+    for item in data:
+        if name_key in item and caption_key in item and content_key in item:
+            records.setdefault(normalize(item[name_key]), {
+                caption_key: item[caption_key],
+                content_key: item[content_key],
+            })
+    return records
+
+
+def _chunk_key_(chunk: str) -> bytes:
+    return hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).digest()
+
+
+class PaperArtifacts(object):
+    def __init__(self, pdf_file: str):
+        pdf_name = pdf_file.split(".")[0]
+        self.pdf_file = pdf_file
+        self.table_path = os.path.join(GV.table_dir, pdf_name + ".json")
+        self.figure_path = os.path.join(GV.figure_dir, pdf_name + ".json")
+        self.version = (_file_stat_(self.table_path), _file_stat_(self.figure_path))
+        self.tables = _load_records_(self.table_path, "table_name", "table_caption", "table_content",
+                                     utils.normalize_table_name)
+        self.figures = _load_records_(self.figure_path, "figure_name", "figure_caption", "figure_content",
+                                      utils.normalize_figure_name)
+        self.chunk_types = {}  # chunk text hash -> (type, table/figure name or None)
+
+    def is_current(self) -> bool:
+        return self.version == (_file_stat_(self.table_path), _file_stat_(self.figure_path))
+
+    def classify(self, chunk: str) -> dict:
+        """
+        Type of a chunk, as returned by utils.classify_chunk; memoized per chunk.
+        """
+        key = _chunk_key_(chunk)
+        annotation = self.chunk_types.get(key)
+        if annotation is None:
+            classified = utils.classify_chunk(chunk)
+            annotation = (classified["value"], classified["content"] if classified["value"] != "text" else None)
+            self.chunk_types[key] = annotation
+        chunk_type, chunk_name = annotation
+        return {"value": chunk_type, "content": chunk_name if chunk_type != "text" else chunk}
+
+    def annotate(self, chunk: str, chunk_type: str, chunk_name: str = None):
+        self.chunk_types[_chunk_key_(chunk)] = (chunk_type, chunk_name if chunk_type != "text" else None)
+
+    def find_table(self, table_name: str):
+        """
+        Caption and content of a table, with empty strings if the paper has no such table.
+        Returns None if the paper has no table file.
+        """
+        if self.tables is None:
+            return None
+        return self.tables.get(utils.normalize_table_name(table_name), {"table_caption": "", "table_content": ""})
+
+    def find_figure(self, figure_name: str):
+        """
+        Caption and content of a figure, with empty strings if the paper has no such figure.
+        Returns None if the paper has no figure file.
+        """
+        if self.figures is None:
+            return None
+        return self.figures.get(utils.normalize_figure_name(figure_name), {"figure_caption": "", "figure_content": ""})
+
+
+_artifacts = {}
+_artifacts_lock = threading.Lock()
+
+def get_paper_artifacts(pdf_file: str) -> PaperArtifacts:
+    """
+    Return the shared PaperArtifacts of a paper, reloading it if its table or figure file changed.
+    Chunk annotations survive a reload.
+    """
+    with _artifacts_lock:
+        artifacts = _artifacts.get(pdf_file)
+        if artifacts is not None and artifacts.is_current():
+            return artifacts
+        fresh = PaperArtifacts(pdf_file)
+        if artifacts is not None:
+            fresh.chunk_types = artifacts.chunk_types
+        _artifacts[pdf_file] = fresh
+        return fresh
+
+def drop_paper_artifacts(pdf_file: str):
+    """
+    Forget a paper's tables, figures and chunk annotations; they are rebuilt on the next access.
+    """
+    with _artifacts_lock:
+        _artifacts.pop(pdf_file, None)
+
+def register_chunk_annotations(pdf_file: str, vectorstore, docstore, id_key: str = "doc_id"):
+    """
+    Record the ingest-time chunk types stored in a paper's summary metadata.
+    Vectorstores written before chunks were annotated are skipped.
+    """
+    annotations = {}
+    for doc in getattr(vectorstore.docstore, "_dict", {}).values():
+        if "chunk_type" in doc.metadata and id_key in doc.metadata:
+            annotations[doc.metadata[id_key]] = (doc.metadata["chunk_type"], doc.metadata.get("chunk_name"))
+    if not annotations:
+        return
+    doc_ids = list(annotations)
+    artifacts = get_paper_artifacts(pdf_file)
+    for doc_id, chunk in zip(doc_ids, docstore.mget(doc_ids)):
+        if isinstance(chunk, str):
+            artifacts.annotate(chunk, *annotations[doc_id])
@@ -4,73 +4,26 @@ import json
 import time
 import re
 import yaml
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 try:
     import globalVariable as GV
     import utils as utils
+    from chunking import split_into_chunks, extract_sections, TokenChunker
+    from ingest_pipeline import IngestPipeline, Stage
+    from manifest import IngestManifest, SummaryCache, stage_fingerprint
 except:
     import app.dataService.globalVariable as GV
     import app.dataService.utils as utils
+    from app.dataService.chunking import split_into_chunks, extract_sections, TokenChunker
+    from app.dataService.ingest_pipeline import IngestPipeline, Stage
+    from app.dataService.manifest import IngestManifest, SummaryCache, stage_fingerprint
 
 from unstructured.partition.pdf import partition_pdf
 from tqdm import tqdm 
 import argparse
 
-def split_into_chunks(text, 
-                      section_boundaries, 
-                      excluded_ranges, 
-                      max_chunk_size = 4000, 
-                      target_chars = 3800, 
-                      combine_text_under_n_chars = 2000):
-    # Function to check if a given index falls within any excluded ranges
-    def is_excluded(index):
-        for start, end in excluded_ranges:
-            if start <= index < end:
-                return True
-        return False
-
-    # Function to merge small chunks with their neighbors
-    def merge_small_chunks(chunks):
-        merged_chunks = []
-        buffer = ""
-    
-        for chunk in chunks:
-            if len(buffer) + len(chunk) < combine_text_under_n_chars:
-                buffer += chunk
-            else:
-                if len(buffer) < combine_text_under_n_chars:  # If buffer is small, merge it with the current chunk
-                    buffer += chunk
-                else:  # Otherwise, add the buffer as a separate chunk
-                    merged_chunks.append(buffer)
-                    buffer = chunk
-    
-        if buffer:  # Add any remaining buffer
-            merged_chunks.append(buffer)
-    
-        return merged_chunks
-
-    # Split the text into sections while excluding specified ranges
-    sections = []
-    for start, end in section_boundaries:
-        section_text = ""
-        for i in range(start, end):
-            if not is_excluded(i):
-                section_text += text[i]
-        sections.append(section_text)
-
-    # Split each section into chunks of approximately target_chars characters
-    chunks = []
-    for section in sections:
-        for i in range(0, len(section), target_chars):
-            chunk = section[i:i + max_chunk_size]  # Ensure chunk is no more than max_chunk_size chars
-            if len(chunk) > combine_text_under_n_chars or (len(chunk) > 0 and i + max_chunk_size >= len(section)):
-                chunks.append(chunk)
-
-    # Merge chunks smaller than 2000 characters
-    chunks = merge_small_chunks(chunks)
-
-    return chunks
-
-def process_one_pdf_papermage(pdf_path, table_path, figure_path, flag='all'):
+def process_one_pdf_papermage(pdf_path, table_path, figure_path, flag='all', chunker=None):
     from papermage.recipes import CoreRecipe
     recipe = CoreRecipe()
     doc = recipe.run(pdf_path)
@@ -86,32 +39,39 @@ def process_one_pdf_papermage(pdf_path, table_path, figure_path, flag='all'):
     excluded_ranges = []
     for ref in doc.bibliographies:
         excluded_ranges.append((ref.start, ref.end))
-    # --- split into chunks
-    chunks = split_into_chunks(doc.symbols, section_boundaries, excluded_ranges)
+    # --- split into chunks (by characters, or by tokens with a TokenChunker)
+    if chunker is not None:
+        chunks = chunker.chunk(extract_sections(doc.symbols, section_boundaries, excluded_ranges))
+    else:
+        chunks = split_into_chunks(doc.symbols, section_boundaries, excluded_ranges)
 
     all_text = chunks
 
+    all_text += load_table_figure_texts(table_path, figure_path, flag)
+
+    return all_text
+
+def load_table_figure_texts(table_path, figure_path, flag='all'):
+    """
+    The texts of the extracted tables and figures of a PDF, indexed next to its text chunks.
+    """
+    texts = []
     if flag in ['all', 'table']:
         # --- load the table
         table_data = json.load(open(table_path))
-        tables = []
         for table in table_data:
             table_text = f"""{table["table_name"]}: {table["table_caption"]}; table content: {table["table_content"]}
             """
-            tables.append(table_text)
-        all_text += tables
-    
+            texts.append(table_text)
+
     if flag in ['all', 'figure']:
         # --- load the figure
         figure_data = json.load(open(figure_path))
-        figures = []
         for figure in figure_data:
             figure_text = f"""{figure["figure_name"]}: {figure["figure_caption"]}; figure content: {figure["figure_content"]}
             """
-            figures.append(figure_text)
-        all_text += figures
-    
-    return all_text
+            texts.append(figure_text)
+    return texts
 
 def clean_text(text):
     # Use regex to remove (cid:xxx) patterns
@@ -175,13 +135,14 @@ def process_text_chunks(text_list, max_chunk_size=4000, target_chars=3800, combi
 
     return combined_chunks
 
-def process_one_pdf(pdf_path, table_path, figure_path, flag='all'):
+def process_one_pdf(pdf_path, table_path, figure_path, flag='all', chunker=None):
     """
     Process one pdf file and save the results to the table folder
     Input:
         pdf_path: path to the pdf file
         table_path: path to the table file
         figure_path: path to the figure file
+        chunker: TokenChunker to size the text chunks in tokens (None: process_text_chunks by characters)
     Output:
         None
     """
@@ -209,128 +170,199 @@ def process_one_pdf(pdf_path, table_path, figure_path, flag='all'):
     for ele in raw_pdf_elements:
         text = clean_text(str(ele))
         texts.append(text)
-    # Split text into chunks
-    all_text = process_text_chunks(texts)
+    # Split text into chunks (the by_title elements are the sections of the token chunker)
+    if chunker is not None:
+        all_text = chunker.chunk(texts)
+    else:
+        all_text = process_text_chunks(texts)
 
-    if flag in ['all', 'table']:
-        # Load table
-        table_data = json.load(open(table_path))
-        tables = []
-        for table in table_data:
-            table_text = f"""{table["table_name"]}: {table["table_caption"]}; table content: {table["table_content"]}
-            """
-            tables.append(table_text)
-        all_text += tables
-    
-    if flag in ['all', 'figure']:
-        # Load the figure
-        figure_data = json.load(open(figure_path))
-        figures = []
-        for figure in figure_data:
-            figure_text = f"""{figure["figure_name"]}: {figure["figure_caption"]}; figure content: {figure["figure_content"]}
-            """
-            figures.append(figure_text)
-        all_text += figures
+    # Append the extracted tables and figures
+    all_text += load_table_figure_texts(table_path, figure_path, flag)
     print("all text: ", all_text)
     print("*"*20)
     return all_text
 
-def preprocess_folder(pdf_dir, figure_dir, table_dir, meta_dir, table_model, figure_model, meta_model, mode, azure_openai_key, vectorstore_dir, flag):
+def preprocess_folder(pdf_dir, figure_dir, table_dir, meta_dir, table_model, figure_model, meta_model, mode, azure_openai_key, vectorstore_dir, flag, chunker=None,
+                      workers=1, llm_workers=8, max_tasks_per_child=10, rebuild=False):
     # Create directories if they don't exist
     for directory in [figure_dir, table_dir, meta_dir, vectorstore_dir]:
         os.makedirs(directory, exist_ok=True)
-    
-    data_folder = pdf_dir
-    table_folder = table_dir
-    figure_folder = figure_dir
-    vectorstore_dir = vectorstore_dir
-    meta_folder = meta_dir
-    mode = mode
-    
-    failed_files = []
+
+    pdf_files = sorted(filename for filename in os.listdir(pdf_dir) if filename.endswith(".pdf"))
+    failed_files = ingest_pdfs(pdf_dir, pdf_files, figure_dir, table_dir, meta_dir, table_model, figure_model, mode, azure_openai_key,
+                               vectorstore_dir, flag, chunker, workers, llm_workers, max_tasks_per_child, rebuild)
+    print(f"Failed files: {failed_files}")
+    print("Preprocessing done.")
+
+def ingest_pdfs(pdf_dir, pdf_files, figure_dir, table_dir, meta_dir, table_model, figure_model, mode, azure_openai_key, vectorstore_dir, flag, chunker=None,
+                workers=1, llm_workers=8, max_tasks_per_child=10, rebuild=False, parse=None):
+    """
+    Preprocess PDFs of a folder, each as its own graph of stages (see ingest_pipeline.py):
+    figures, tables, meta information and text parsing run concurrently, and the vectorstore of
+    a PDF is built as soon as its own text, tables and figures are ready, so papers become
+    queryable one by one instead of at the end of the folder.
+
+    PDF parsing and chunking (CPU-bound) run on `workers` processes, each replaced after
+    `max_tasks_per_child` PDFs so memory leaked by the parsers stays bounded (with workers=1,
+    on a single thread in this process). Figure, table and meta extraction and the vectorstore
+    builds (LLM and embedding calls) run on `llm_workers` threads.
+
+    Stages are tracked in the ingestion manifest (manifest.py): a stage whose outputs are up
+    to date for the PDF's content and the current settings is skipped, unless `rebuild` is set.
+
+    Args:
+        pdf_files (list): File names of the PDFs in `pdf_dir` to process.
+        parse (callable, optional): parse(filename, inputs, pdf_dir=..., chunker=...) returning the
+            text chunks of a PDF; picklable if workers > 1. Defaults to parse_pdf_text.
+
+    Returns:
+        list: The PDFs with a failed stage.
+    """
     if mode == "fast":
         table_model = "none"
         figure_model = "none"
+    parse = parse_pdf_text if parse is None else parse
+    manifest = IngestManifest(GV.ingest_manifest_path)
+    summary_cache = SummaryCache(GV.summary_cache_path)
+
+    # what each stage's outputs depend on besides the PDF content
+    fingerprints = {
+        "figures": stage_fingerprint(model=figure_model, prompt=GV.figure_describe_prompt_template("{caption}", "{image}")),
+        "tables": stage_fingerprint(model=table_model, prompts=[GV.table_extract_prompt_template, GV.table_structure_prompt_templatev2]),
+        "meta": stage_fingerprint(model=utils.META_INFO_MODEL, prompt=GV.meta_info_extract_prompt_template),
+        "vectorstore": stage_fingerprint(flag=flag, chunker=chunker.settings() if chunker is not None else "chars",
+                                         summary_model=utils.SUMMARY_MODEL, summary_prompt=utils.SUMMARY_PROMPT,
+                                         embedding=GV.azure_embedding_deployment,
+                                         # preprocess_folder and preprocess_single_pdf parse with different libraries
+                                         parser=getattr(parse, "__name__", repr(parse))),
+    }
+    artifact_stages = [stage for stage, used in [("figures", flag in ["all", "figure"]), ("tables", flag in ["all", "table"])] if used]
+
+    def content_hash(filename):
+        return utils.file_content_hash(os.path.join(pdf_dir, filename))
+
+    def stage_outputs(filename, stage):
+        table_path, figure_path, vectorstore_path, db_path = pdf_output_paths(filename, table_dir, figure_dir, vectorstore_dir)
+        return {
+            "figures": [figure_path],
+            "tables": [table_path],
+            "meta": [os.path.join(meta_dir, filename.split(".")[0] + ".json")],
+            "vectorstore": [vectorstore_path, db_path],
+        }[stage]
+
+    def is_current(filename, stage):
+        if rebuild:
+            return False
+        after = tuple(artifact_stages) if stage == "vectorstore" else ()
+        return manifest.is_current(filename, content_hash(filename), stage, fingerprints[stage], stage_outputs(filename, stage), after)
+
+    def needs_vectorstore(filename):
+        # the vectorstore is also rebuilt when its tables or figures are about to be
+        return any(not is_current(filename, stage) for stage in artifact_stages + ["vectorstore"])
+
+    def tracked(stage, function):
+        # record a stage in the manifest once it has written its outputs; False means the stage
+        # saved an error fallback (e.g. an empty table list), which is retried on the next run
+        def run(filename, inputs):
+            pdf_hash = content_hash(filename)
+            result = function(filename, inputs)
+            if result is not False:
+                manifest.mark_done(filename, pdf_hash, stage, fingerprints[stage], stage_outputs(filename, stage))
+            return result
+        return run
+
+    def build_vectorstore(filename, inputs):
+        table_path, figure_path, vectorstore_path, db_path = pdf_output_paths(filename, table_dir, figure_dir, vectorstore_dir)
+        text = inputs["parse"] if inputs["parse"] is not None else parse(filename, {}, pdf_dir=pdf_dir, chunker=chunker)
+        all_text = text + load_table_figure_texts(table_path, figure_path, flag)
+        print(f"Processing {filename}")
+        utils.save_local_document_vector_store(all_text, vectorstore_path, db_path, azure_openai_key, summary_cache=summary_cache)
+
+    if not rebuild:
+        # outputs of runs before the manifest existed are kept as they are
+        adopted = 0
+        for filename in pdf_files:
+            stages = {stage: (fingerprints[stage], stage_outputs(filename, stage)) for stage in artifact_stages + ["meta", "vectorstore"]}
+            adopted += bool(manifest.adopt(filename, content_hash(filename), stages))
+        if adopted:
+            print(f"Adopted existing outputs of {adopted} PDFs into the manifest")
+
+    stages = []
+    if "figures" in artifact_stages:
+        stages.append(Stage("figures", tracked("figures", lambda filename, inputs: extract_figures(os.path.join(pdf_dir, filename), figure_dir, figure_model, azure_openai_key)),
+                            executor="llm", when=lambda filename: not is_current(filename, "figures")))
+    if "tables" in artifact_stages:
+        stages.append(Stage("tables", tracked("tables", lambda filename, inputs: utils.process_single_pdf_table(os.path.join(pdf_dir, filename), table_dir, table_model)),
+                            executor="llm", when=lambda filename: not is_current(filename, "tables")))
+    stages.append(Stage("meta", tracked("meta", lambda filename, inputs: utils.process_single_pdf_meta_information(os.path.join(pdf_dir, filename), meta_dir)),
+                        executor="llm", when=lambda filename: not is_current(filename, "meta")))
+    stages.append(Stage("parse", partial(parse, pdf_dir=pdf_dir, chunker=chunker), executor="parse", when=needs_vectorstore))
+    stages.append(Stage("vectorstore", tracked("vectorstore", build_vectorstore), depends_on=tuple(artifact_stages) + ("parse",),
+                        executor="llm", when=lambda filename: not is_current(filename, "vectorstore")))
+
+    if workers > 1:
+        parsers = ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=max_tasks_per_child)
+    else:
+        parsers = ThreadPoolExecutor(max_workers=1)
+    failed_files = []
+    with parsers, ThreadPoolExecutor(max_workers=max(1, llm_workers)) as llm_threads:
+        pipeline = IngestPipeline(stages, {"parse": parsers, "llm": llm_threads}, max_in_flight=max(workers, llm_workers) * 2)
+        for filename, outputs, errors in tqdm(pipeline.run(pdf_files), total=len(pdf_files)):
+            if errors:
+                print(f"Failed to process {filename}: {errors}")
+                failed_files.append(filename)
+            else:
+                print(f"{filename} done")
+    print(pipeline.report())
+    return failed_files
 
-    if flag in ["all", "figure"]:
-        # process figures
-        utils.process_figures(data_folder, figure_folder, figure_model, azure_openai_key)
-
-    if flag in ["all", "table"]:
-        # process tables
-        utils.process_tables(data_folder, table_folder, table_model)
-
-    utils.process_meta_information(data_folder, meta_folder)
-
-    # start to generate vector stores
-    for filename in tqdm(os.listdir(data_folder)):
-        if not filename.endswith(".pdf"):
-            continue
-        try:
-            pdf_path = os.path.join(data_folder, filename)
-            table_path = os.path.join(table_folder, filename.split(".")[0] + ".json")
-            figure_path = os.path.join(figure_folder, filename.split(".")[0] + ".json")
-            vectorstore_path = os.path.join(vectorstore_dir, filename.split(".")[0], "vector_index")
-            db_path = os.path.join(vectorstore_dir, filename.split(".")[0], filename.split(".")[0] + ".pickle")
-            if not os.path.exists(vectorstore_path) or not os.path.exists(db_path):
-                all_text = process_one_pdf(pdf_path, table_path, figure_path, flag)
-                print(f"Processing {filename}")
-                utils.save_local_document_vector_store(all_text, vectorstore_path, db_path, azure_openai_key)
-        except Exception as e:
-            print(f"Failed to process {filename}")
-            print(e)
-            failed_files.append(filename)
-    print(f"Failed files: {failed_files}")
-    print("Preprocessing done.")
+def pdf_output_paths(filename, table_dir, figure_dir, vectorstore_dir):
+    """
+    The table JSON, figure JSON, vector index and docstore paths of a PDF file name.
+    """
+    pdf_name = filename.split(".")[0]
+    return (os.path.join(table_dir, pdf_name + ".json"),
+            os.path.join(figure_dir, pdf_name + ".json"),
+            os.path.join(vectorstore_dir, pdf_name, "vector_index"),
+            os.path.join(vectorstore_dir, pdf_name, pdf_name + ".pickle"))
+
+def parse_pdf_text(filename, inputs, pdf_dir, chunker=None):
+    # text chunks of a PDF without its tables and figures; runs in a parser process
+    return process_one_pdf(os.path.join(pdf_dir, filename), None, None, 'none', chunker)
+
+def parse_pdf_text_papermage(filename, inputs, pdf_dir, chunker=None):
+    # parse_pdf_text with papermage (section-aware, without the bibliography)
+    return process_one_pdf_papermage(os.path.join(pdf_dir, filename), None, None, 'none', chunker)
+
+def extract_figures(pdf_path, figure_dir, figure_model, azure_openai_key):
+    # like utils.process_figures, a PDF whose figures cannot be extracted or described gets an
+    # empty figure list; returns False then, so the manifest retries it on the next run
+    try:
+        return utils.process_single_pdf_figure(pdf_path, figure_dir, figure_model, azure_openai_key)
+    except Exception as e:
+        print(f"Error processing PDF file {pdf_path}: {str(e)}")
+        with open(os.path.join(figure_dir, os.path.basename(pdf_path).split(".")[0] + ".json"), "w") as f:
+            json.dump([], f)
+        return False
 
-def preprocess_single_pdf(pdf_path, figure_dir, table_dir, meta_dir, table_model, figure_model, meta_model, mode, azure_openai_key, vectorstore_dir, flag):
+def preprocess_single_pdf(pdf_path, figure_dir, table_dir, meta_dir, table_model, figure_model, meta_model, mode, azure_openai_key, vectorstore_dir, flag, chunker=None,
+                          rebuild=False):
     # Create directories if they don't exist
     for directory in [figure_dir, table_dir, meta_dir, vectorstore_dir]:
         os.makedirs(directory, exist_ok=True)
     
-    pdf_path = pdf_path
-    table_folder = table_dir
-    figure_folder = figure_dir
-    meta_folder = meta_dir
-    vectorstore_dir = vectorstore_dir
-    mode = mode
-    
     if not os.path.exists(pdf_path):
         print(f"File {pdf_path} does not exist.")
         return
     elif not pdf_path.endswith(".pdf"):
         print(f"File {pdf_path} is not a pdf file.")
         return
-    
-    if mode == "fast":
-        # if mode parameter is "fast", then set table_model to "none" to use the adobe function
-        table_model = "none"
-        figure_model = "none"
-    
-    if flag in ["all", "figure"]:
-        # process figures
-        utils.process_single_pdf_figure(pdf_path, figure_folder, figure_model, azure_openai_key)
 
-    if flag in ["all", "table"]:
-        # process tables
-        utils.process_single_pdf_table(pdf_path, table_folder, table_model)
-    
-    # process meta information
-    utils.process_single_pdf_meta_information(pdf_path, meta_folder)
-
-    # start to generate vector stores
-    try:
-        table_path = os.path.join(table_dir, os.path.basename(pdf_path).split(".")[0] + ".json")
-        figure_path = os.path.join(figure_dir, os.path.basename(pdf_path).split(".")[0] + ".json")
-        vectorstore_path = os.path.join(vectorstore_dir, os.path.basename(pdf_path).split(".")[0], "vector_index")
-        db_path = os.path.join(vectorstore_dir, os.path.basename(pdf_path).split(".")[0], os.path.basename(pdf_path).split(".")[0] + ".pickle")
-        if not os.path.exists(vectorstore_path) or not os.path.exists(db_path):
-            all_text = process_one_pdf_papermage(pdf_path, table_path, figure_path, flag)
-            print(f"Processing {os.path.basename(pdf_path)}")
-            utils.save_local_document_vector_store(all_text, vectorstore_path, db_path, azure_openai_key)
-    except Exception as e:
+    # the same stages and manifest as a folder, with the text parsed by papermage
+    failed_files = ingest_pdfs(os.path.dirname(pdf_path), [os.path.basename(pdf_path)], figure_dir, table_dir, meta_dir, table_model, figure_model,
+                               mode, azure_openai_key, vectorstore_dir, flag, chunker, rebuild=rebuild, parse=parse_pdf_text_papermage)
+    if failed_files:
         print(f"Failed to process {pdf_path}")
-        print(f"Error: {e}")
 
 
 def update_global_vars(args):
@@ -367,6 +399,13 @@ if __name__ == "__main__":
     parser.add_argument('--vectorstore_dir', type=str, required=False, help='Directory for vector store.', default=GV.vectorstore_dir)
     parser.add_argument('--pdf_path', type=str, required=False, help='Path to a single PDF file to process.')
     parser.add_argument('--flag', type=str, choices=['all', 'table', 'figure', "none"], default='all', help='Specify which elements to process: all, table, figure, none (using text only)')
+    parser.add_argument('--chunker', type=str, choices=['chars', 'tokens'], default='chars', help='Size text chunks by characters (4000/3800/2000) or by tokens of the LLM tokenizer.')
+    parser.add_argument('--chunk_tokens', type=int, default=900, help='Maximum tokens per chunk with --chunker tokens.')
+    parser.add_argument('--chunk_overlap_tokens', type=int, default=64, help='Tokens repeated between consecutive chunks of a section with --chunker tokens.')
+    parser.add_argument('--workers', type=int, default=1, help='Processes parsing PDFs in parallel when processing a folder (1: parse on one thread of the main process).')
+    parser.add_argument('--llm_workers', type=int, default=8, help='Threads for the figure, table, meta and vectorstore (LLM and embedding) stages when processing a folder.')
+    parser.add_argument('--max_tasks_per_child', type=int, default=10, help='PDFs a parser process handles before it is replaced, bounding parser memory leaks.')
+    parser.add_argument('--rebuild', action='store_true', default=False, help='Rebuild every stage of the PDF(s), ignoring the ingestion manifest.')
 
     args = parser.parse_args()
     if args.fast:
@@ -374,6 +413,7 @@ if __name__ == "__main__":
     else:
         mode = "normal"
     # print(mode)
+    chunker = TokenChunker(args.chunk_tokens, args.chunk_overlap_tokens) if args.chunker == "tokens" else None
 
     # Add after parsing arguments:
     update_global_vars(args)
@@ -391,7 +431,13 @@ if __name__ == "__main__":
         'mode': mode,
         'azure_openai_key': args.openai_key,
         'vectorstore_dir': args.vectorstore_dir,
-        'flag': args.flag
+        'flag': args.flag,
+        'chunker': args.chunker,
+        'chunk_tokens': args.chunk_tokens,
+        'chunk_overlap_tokens': args.chunk_overlap_tokens,
+        'workers': args.workers,
+        'llm_workers': args.llm_workers,
+        'max_tasks_per_child': args.max_tasks_per_child
     }
 
     # create or update the config file
@@ -418,7 +464,9 @@ if __name__ == "__main__":
             mode=mode,
             azure_openai_key=args.openai_key,
             vectorstore_dir=args.vectorstore_dir,
-            flag=args.flag
+            flag=args.flag,
+            chunker=chunker,
+            rebuild=args.rebuild
         )
     else:
         preprocess_folder(
@@ -432,5 +480,10 @@ if __name__ == "__main__":
             mode=mode,
             azure_openai_key=args.openai_key,
             vectorstore_dir=args.vectorstore_dir,
-            flag=args.flag
+            flag=args.flag,
+            chunker=chunker,
+            workers=args.workers,
+            llm_workers=args.llm_workers,
+            max_tasks_per_child=args.max_tasks_per_child,
+            rebuild=args.rebuild
         )
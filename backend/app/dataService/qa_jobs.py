@@ -0,0 +1,223 @@
+"""
+qa_jobs.py - Background Job Management for RAG-based Question Answering
+
+This module runs DataService.run_rag_qa style workloads as background jobs, so that a
+long multi-paper question does not depend on a single open HTTP request.
+
+Main Components:
+- QAJob: State of one question over a set of papers (status, progress, per-stage timings,
+  partial results, summary).
+- QAJobManager: Submits jobs to background threads, deduplicates identical requests over
+  unchanged papers, supports cancellation and expires finished jobs.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+try:
+    import globalVariable as GV
+    from answer_cache import paper_version
+except:
+    import app.dataService.globalVariable as GV
+    from app.dataService.answer_cache import paper_version
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+FINISHED_STATES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+
+def job_key(pdf_files: list, question: str, evaluation_metrics = None, ans_format = None) -> str:
+    """
+    Build a key identifying the work of a job, used to reuse an existing job for an identical request.
+    The papers' versions (see answer_cache.paper_version) are part of the key, so a job is not reused
+    after a paper was re-processed.
+    """
+    payload = json.dumps({
+        "papers": {pdf_file: paper_version(pdf_file) for pdf_file in pdf_files},
+        "question": " ".join(question.split()),
+        "evaluation_metrics": sorted(evaluation_metrics) if evaluation_metrics else None,
+        "ans_format": ans_format,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class QAJob(object):
+    def __init__(self, pdf_files: list, question: str, batch_size: int = 5, evaluation_metrics = None, ans_format = None,
+                 key: str = None):
+        self.job_id = uuid.uuid4().hex
+        self.key = key if key is not None else job_key(pdf_files, question, evaluation_metrics, ans_format)
+        self.pdf_files = list(pdf_files)
+        self.question = question
+        self.batch_size = batch_size
+        self.evaluation_metrics = evaluation_metrics
+        self.requested_ans_format = ans_format  # precomputed by the caller, if any
+
+        self.status = JOB_QUEUED
+        self.error = None
+        self.ans_format = None
+        self.summary = None
+        self.results = {}
+        self.errors = {}
+        self.completed_order = []  # pdf files in the order their results arrived
+        self.timings = {}
+        self.metadata = {}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def is_finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def progress(self) -> dict:
+        total = len(self.pdf_files)
+        done = len(self.results)
+        failed = len(self.errors)
+        return {
+            "done": done,
+            "failed": failed,
+            "total": total,
+            "fraction": (done + failed) / total if total else 1.0,
+        }
+
+    def to_dict(self) -> dict:
+        """
+        Status view of the job, without the per-paper results.
+        """
+        with self.lock:
+            return {
+                "job_id": self.job_id,
+                "status": self.status,
+                "error": self.error,
+                "question": self.question,
+                "progress": self.progress(),
+                "timings": dict(self.timings),
+                "metadata": dict(self.metadata),
+                "errors": dict(self.errors),
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+    def partial_results(self, since: int = 0) -> dict:
+        """
+        Results that arrived after the first `since` papers, so clients can poll incrementally.
+        """
+        with self.lock:
+            new_files = self.completed_order[since:]
+            return {
+                "job_id": self.job_id,
+                "status": self.status,
+                "ans_format": json.loads(self.ans_format) if self.ans_format else None,
+                "answer": {pdf_file: self.results[pdf_file] for pdf_file in new_files},
+                "next": since + len(new_files),
+                "summary": self.summary,
+            }
+
+
+class QAJobManager(object):
+    def __init__(self, data_service, job_ttl: float = None):
+        self.data_service = data_service
+        self.job_ttl = job_ttl if job_ttl is not None else GV.qa_job_ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, pdf_files: list, question: str, batch_size: int = 5, evaluation_metrics = None,
+               ans_format = None) -> QAJob:
+        """
+        Start a background job, or return the live/completed job for an identical request.
+        `ans_format` is an optional precomputed answer structure.
+        """
+        key = job_key(pdf_files, question, evaluation_metrics, ans_format)
+        with self.lock:
+            self._expire_jobs_()
+            for job in self.jobs.values():
+                if job.key == key and job.status not in (JOB_FAILED, JOB_CANCELLED):
+                    return job
+            job = QAJob(pdf_files, question, batch_size, evaluation_metrics, ans_format, key=key)
+            self.jobs[job.job_id] = job
+
+        thread = threading.Thread(target=self._run_job_, args=(job,), name=f"qa-job-{job.job_id}", daemon=True)
+        thread.start()
+        return job
+
+    def get(self, job_id: str) -> QAJob:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> QAJob:
+        """
+        Request cancellation; papers that have not started are not sent to the LLM.
+        """
+        job = self.get(job_id)
+        if job is not None and not job.is_finished():
+            job.cancel_event.set()
+        return job
+
+    def _expire_jobs_(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.is_finished() and now - job.finished_at > self.job_ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _run_job_(self, job: QAJob):
+        ds = self.data_service
+        with job.lock:
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+        try:
+            time0 = time.time()
+            ans_format = ds._resolve_answer_structure_(job.question, job.requested_ans_format)
+            with job.lock:
+                job.ans_format = ans_format
+                job.timings["answer_structure"] = time.time() - time0
+
+            time0 = time.time()
+            errors = {}
+            metadata = {}
+            for pdf_file, data in ds._iter_rag_results_(job.pdf_files, job.question, ans_format, job.batch_size,
+                                                        job.evaluation_metrics, errors=errors,
+                                                        cancel_event=job.cancel_event, metadata=metadata):
+                with job.lock:
+                    job.metadata = dict(metadata)
+                    if data is None:
+                        job.errors[pdf_file] = errors[pdf_file]
+                    else:
+                        job.results.update(data)
+                        job.completed_order.append(pdf_file)
+                    job.timings["papers"] = time.time() - time0
+                    job.timings["paper_stages"] = dict(metadata.get("stage_seconds", {}))
+            with job.lock:
+                job.metadata = dict(metadata)
+                job.timings["papers"] = time.time() - time0
+                job.timings["paper_stages"] = dict(metadata.get("stage_seconds", {}))
+
+            if job.cancel_event.is_set():
+                with job.lock:
+                    job.status = JOB_CANCELLED
+                    job.finished_at = time.time()
+                return
+
+            time0 = time.time()
+            summary = ds._summarize_rag_results_(job.question, job.results)
+            with job.lock:
+                job.summary = summary
+                job.timings["summary"] = time.time() - time0
+                job.status = JOB_COMPLETED
+                job.finished_at = time.time()
+        except Exception as e:
+            print(f"QA job {job.job_id} failed: {e}")
+            with job.lock:
+                job.status = JOB_FAILED
+                job.error = str(e)
+                job.finished_at = time.time()
@@ -0,0 +1,435 @@
+"""
+rate_limiter.py - Adaptive Rate Limiting for Azure OpenAI Calls
+
+Azure OpenAI deployments are limited in tokens per minute (TPM) and requests per minute
+(RPM). This module puts every LLM and embedding call behind a per-deployment limiter, so
+large batches are paced to the quota instead of failing with 429s:
+
+- Each call reserves its estimated token count (tiktoken) from a token bucket and one
+  request from a request bucket before it is sent. The estimate is reconciled with the
+  reported usage afterwards.
+- Throttled (429) and transient errors are retried with jittered exponential backoff,
+  honouring the Retry-After header when the service sends one.
+- The number of concurrent calls per deployment adapts to observed throttling: it grows
+  additively while calls succeed and is halved on a 429 (AIMD).
+
+Main Components:
+- DeploymentLimiter: Token/request buckets, adaptive concurrency and retry for one deployment.
+- get_limiter: Returns the shared limiter of a deployment, configured from `rate_limits` in config.yml.
+- call_with_rate_limit / acall_with_rate_limit: Run any sync/async call through a limiter.
+- RateLimitedAzureChatOpenAI / RateLimitedAzureOpenAIEmbeddings: LangChain clients whose
+  requests go through the limiter of their deployment.
+- estimate_tokens: tiktoken-based token estimate of a text.
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+import openai
+import requests
+import tiktoken
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+
+try:
+    import globalVariable as GV
+except:
+    import app.dataService.globalVariable as GV
+
+TRANSIENT_STATUS_CODES = {408, 409, 500, 502, 503, 504}
+
+_encoding = None
+
+def estimate_tokens(text: str) -> int:
+    """
+    Number of cl100k_base tokens in `text`.
+
+    Falls back to ~4 characters per token if the encoding cannot be loaded (tiktoken
+    downloads it on first use), so an estimate never makes a call fail.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"[rate limit] tiktoken unavailable, estimating tokens from length: {e}")
+            _encoding = False
+    if _encoding is False:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def classify_error(exc: Exception) -> tuple:
+    """
+    Decide whether a failed call should be retried.
+
+    Returns:
+        tuple: (kind, retry_after) where kind is "throttle" (429), "transient" (timeouts,
+            connection errors, 5xx) or None (not retryable), and retry_after is the delay in
+            seconds requested by the service, if any.
+    """
+    response = getattr(exc, "response", None)
+    status_code = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+    retry_after = None
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            if headers.get("retry-after-ms") is not None:
+                retry_after = float(headers.get("retry-after-ms")) / 1000
+            elif headers.get("retry-after") is not None:
+                retry_after = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+    if status_code == 429:
+        return "throttle", retry_after
+    if status_code in TRANSIENT_STATUS_CODES:
+        return "transient", retry_after
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError,
+                        requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return "transient", None
+    return None, None
+
+
+class TokenBucket(object):
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill_(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        # a single request larger than the bucket only has to wait for a full bucket
+        self._refill_(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        # may go below zero when the reported usage exceeds the estimate
+        self.level -= amount
+
+
+class DeploymentLimiter(object):
+    def __init__(self, name: str, tokens_per_minute: int = None, requests_per_minute: int = None,
+                 max_concurrency: int = 16, min_concurrency: int = 1, max_retries: int = 8,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0):
+        """
+        Args:
+            name (str): Deployment name, used in logs and stats.
+            tokens_per_minute (int, optional): TPM quota. None disables token pacing.
+            requests_per_minute (int, optional): RPM quota. None disables request pacing.
+            max_concurrency (int, optional): Upper bound of concurrent calls.
+            min_concurrency (int, optional): Lower bound the concurrency shrinks to under throttling.
+            max_retries (int, optional): Retries of a throttled or transiently failed call.
+            backoff_base (float, optional): Backoff of the first retry in seconds, doubled per retry.
+            backoff_max (float, optional): Maximum backoff in seconds.
+        """
+        self.name = name
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency = float(self.max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failures = 0
+        self.tokens = 0
+        self.wait_time = 0.0
+
+    def _reserve_(self, tokens: int):
+        """
+        Try to reserve a slot for a call of `tokens` tokens.
+
+        Returns:
+            float or None: 0 if the call may start, otherwise the seconds to wait before trying
+                again (None: wait until a running call finishes).
+        """
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.concurrency):
+            return None
+        wait = 0.0
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens, now))
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.wait_time(1, now))
+        if wait > 0:
+            return wait
+        if self.token_bucket is not None:
+            self.token_bucket.consume(tokens)
+        if self.request_bucket is not None:
+            self.request_bucket.consume(1)
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self, tokens: int):
+        time0 = time.monotonic()
+        with self.cond:
+            while True:
+                wait = self._reserve_(tokens)
+                if wait == 0:
+                    break
+                self.cond.wait(timeout=wait if wait is not None else 1.0)
+            self.wait_time += time.monotonic() - time0
+
+    async def aacquire(self, tokens: int):
+        # the condition would block the event loop, so async callers poll instead
+        time0 = time.monotonic()
+        while True:
+            with self.cond:
+                wait = self._reserve_(tokens)
+                if wait == 0:
+                    self.wait_time += time.monotonic() - time0
+                    return
+            await asyncio.sleep(min(wait, 1.0) if wait is not None else 0.05)
+
+    def release(self, tokens: int, used_tokens: int = None, error_kind: str = None, retry_after: float = None):
+        """
+        Return the slot of a finished call and adapt the concurrency window.
+
+        Args:
+            tokens (int): Tokens reserved for the call.
+            used_tokens (int, optional): Tokens reported by the service; corrects the reservation.
+            error_kind (str, optional): Result of classify_error if the call failed.
+            retry_after (float, optional): Delay requested by the service.
+        """
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if error_kind == "throttle":
+                self.throttled += 1
+                # many calls of one burst fail together, shrink once per burst
+                if now - self.last_decrease > 1.0:
+                    self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                    self.last_decrease = now
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif error_kind is None:
+                self.calls += 1
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+                if used_tokens is not None and self.token_bucket is not None:
+                    self.token_bucket.consume(used_tokens - tokens)
+                self.tokens += used_tokens if used_tokens is not None else tokens
+            self.cond.notify_all()
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after:
+            return retry_after + random.uniform(0, self.backoff_base)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def call(self, fn, tokens: int, usage_fn=None):
+        """
+        Run `fn()` once a slot is free, retrying throttled and transient failures.
+
+        Args:
+            fn (callable): The request.
+            tokens (int): Estimated tokens of the request (prompt and expected completion).
+            usage_fn (callable, optional): Maps the result to the tokens actually used.
+        """
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                kind, retry_after = classify_error(e)
+                self.release(tokens, error_kind=kind or "error", retry_after=retry_after)
+                if kind is None or attempt >= self.max_retries:
+                    self._record_failure_()
+                    raise
+                delay = self.backoff(attempt, retry_after)
+                self._record_retry_(e, kind, delay)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.release(tokens, used_tokens=usage_fn(result) if usage_fn is not None else None)
+            return result
+
+    async def acall(self, fn, tokens: int, usage_fn=None):
+        """
+        Async variant of call; `fn()` returns an awaitable.
+        """
+        attempt = 0
+        while True:
+            await self.aacquire(tokens)
+            try:
+                result = await fn()
+            except Exception as e:
+                kind, retry_after = classify_error(e)
+                self.release(tokens, error_kind=kind or "error", retry_after=retry_after)
+                if kind is None or attempt >= self.max_retries:
+                    self._record_failure_()
+                    raise
+                delay = self.backoff(attempt, retry_after)
+                self._record_retry_(e, kind, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.release(tokens, used_tokens=usage_fn(result) if usage_fn is not None else None)
+            return result
+
+    def _record_retry_(self, exc, kind, delay):
+        with self.cond:
+            self.retries += 1
+        print(f"[rate limit] {self.name}: {kind} error ({exc.__class__.__name__}), retrying in {delay:.1f}s "
+              f"(concurrency {int(self.concurrency)})")
+
+    def _record_failure_(self):
+        with self.cond:
+            self.failures += 1
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "tokens_per_minute": self.token_bucket.capacity if self.token_bucket is not None else None,
+                "requests_per_minute": self.request_bucket.capacity if self.request_bucket is not None else None,
+                "concurrency": int(self.concurrency),
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "tokens": self.tokens,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "failures": self.failures,
+                "wait_time": self.wait_time,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(deployment: str):
+    """
+    Return the shared limiter of `deployment`, or None if rate limiting is disabled.
+
+    Limits come from `rate_limits.deployments.<deployment>` in config.yml, falling back to
+    `rate_limits.default`.
+    """
+    if not GV.rate_limit_enabled:
+        return None
+    deployment = deployment or GV.azure_openai_deployment
+    with _limiters_lock:
+        if deployment not in _limiters:
+            settings = dict(GV.rate_limit_default)
+            settings.update(GV.rate_limit_deployments.get(deployment) or {})
+            _limiters[deployment] = DeploymentLimiter(
+                deployment,
+                tokens_per_minute=settings.get("tokens_per_minute"),
+                requests_per_minute=settings.get("requests_per_minute"),
+                max_concurrency=settings.get("max_concurrency", 16),
+                min_concurrency=settings.get("min_concurrency", 1),
+                max_retries=GV.rate_limit_max_retries,
+                backoff_base=GV.rate_limit_backoff_base,
+                backoff_max=GV.rate_limit_backoff_max,
+            )
+        return _limiters[deployment]
+
+def get_rate_limit_stats() -> dict:
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {deployment: limiter.stats() for deployment, limiter in limiters.items()}
+
+def call_with_rate_limit(deployment: str, fn, tokens: int, usage_fn=None):
+    """
+    Run `fn()` through the limiter of `deployment` (directly if rate limiting is disabled).
+    """
+    limiter = get_limiter(deployment)
+    if limiter is None:
+        return fn()
+    return limiter.call(fn, tokens, usage_fn)
+
+async def acall_with_rate_limit(deployment: str, fn, tokens: int, usage_fn=None):
+    limiter = get_limiter(deployment)
+    if limiter is None:
+        return await fn()
+    return await limiter.acall(fn, tokens, usage_fn)
+
+
+def _message_tokens_(messages) -> int:
+    tokens = 0
+    for message in messages:
+        content = message.content
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+        else:
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "text":
+                    tokens += estimate_tokens(part.get("text", ""))
+                else:
+                    # image parts are billed by resolution, assume a low-detail image
+                    tokens += 85
+        tokens += 4  # per-message overhead
+    return tokens
+
+def _chat_usage_(result) -> int:
+    usage = (result.llm_output or {}).get("token_usage") or {}
+    return usage.get("total_tokens")
+
+
+class RateLimitedAzureChatOpenAI(AzureChatOpenAI):
+    """
+    AzureChatOpenAI whose requests are paced and retried by the limiter of its deployment.
+    """
+
+    def _estimate_tokens_(self, messages, kwargs) -> int:
+        max_tokens = kwargs.get("max_tokens") or self.max_tokens or GV.rate_limit_output_tokens
+        return _message_tokens_(messages) + max_tokens
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        generate = super()._generate
+        return call_with_rate_limit(
+            self.deployment_name,
+            lambda: generate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            self._estimate_tokens_(messages, kwargs),
+            _chat_usage_,
+        )
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        agenerate = super()._agenerate
+        return await acall_with_rate_limit(
+            self.deployment_name,
+            lambda: agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            self._estimate_tokens_(messages, kwargs),
+            _chat_usage_,
+        )
+
+
+class RateLimitedAzureOpenAIEmbeddings(AzureOpenAIEmbeddings):
+    """
+    AzureOpenAIEmbeddings whose requests are paced and retried by the limiter of its deployment.
+    """
+
+    def embed_documents(self, texts, chunk_size=0):
+        embed = super().embed_documents
+        return call_with_rate_limit(
+            self.deployment,
+            lambda: embed(texts, chunk_size=chunk_size),
+            sum(estimate_tokens(text) for text in texts),
+        )
+
+    async def aembed_documents(self, texts, chunk_size=0):
+        aembed = super().aembed_documents
+        return await acall_with_rate_limit(
+            self.deployment,
+            lambda: aembed(texts, chunk_size=chunk_size),
+            sum(estimate_tokens(text) for text in texts),
+        )
@@ -0,0 +1,119 @@
+"""
+result_store.py - Persistent Store of QA Results for Incremental Column Extension
+
+Every QA request gets a result id. The store keeps, per result, the question, the answer
+structure and, per paper, the answer rows and the context chunks actually sent to the
+answer LLM. Adding columns to an existing result table (DataService.extend_rag_qa) then
+reuses that context and asks the LLM only for the new fields, instead of rerunning the
+question from scratch.
+
+Main Components:
+- ResultStore: SQLite-backed results with per-paper answers and context chunks, expired after a TTL.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class ResultStore(object):
+    def __init__(self, path: str, ttl: float = None):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            ttl (float, optional): Seconds after its last update a result is dropped. None keeps
+                results forever.
+        """
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " result_id TEXT PRIMARY KEY,"
+                " question TEXT NOT NULL,"
+                " ans_format TEXT NOT NULL,"
+                " pdf_files TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS result_papers ("
+                " result_id TEXT NOT NULL,"
+                " pdf_file TEXT NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " context TEXT,"
+                " PRIMARY KEY (result_id, pdf_file))"
+            )
+            self.conn.commit()
+
+    def create(self, question: str, ans_format: str, pdf_files: list) -> str:
+        """
+        Register a new result and return its id.
+        """
+        result_id = uuid.uuid4().hex
+        with self.lock:
+            self._expire_()
+            self.conn.execute(
+                "INSERT INTO results (result_id, question, ans_format, pdf_files, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (result_id, question, ans_format, json.dumps(list(pdf_files)), time.time()))
+            self.conn.commit()
+        return result_id
+
+    def put_paper(self, result_id: str, pdf_file: str, answer, context: list = None):
+        """
+        Store a paper's answer and the context chunks it was answered from (None if unknown).
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO result_papers (result_id, pdf_file, answer, context) VALUES (?, ?, ?, ?)",
+                (result_id, pdf_file, json.dumps(answer), json.dumps(context) if context is not None else None))
+            self.conn.execute("UPDATE results SET updated_at = ? WHERE result_id = ?", (time.time(), result_id))
+            self.conn.commit()
+
+    def set_ans_format(self, result_id: str, ans_format: str):
+        with self.lock:
+            self.conn.execute("UPDATE results SET ans_format = ?, updated_at = ? WHERE result_id = ?",
+                              (ans_format, time.time(), result_id))
+            self.conn.commit()
+
+    def get(self, result_id: str):
+        """
+        A stored result, or None if it is unknown or expired.
+
+        Returns:
+            dict: {"result_id", "question", "ans_format" (JSON string), "pdf_files",
+                "papers": pdf_file -> {"answer", "context"}}.
+        """
+        with self.lock:
+            self._expire_()
+            row = self.conn.execute(
+                "SELECT question, ans_format, pdf_files FROM results WHERE result_id = ?", (result_id,)).fetchone()
+            if row is None:
+                return None
+            papers = self.conn.execute(
+                "SELECT pdf_file, answer, context FROM result_papers WHERE result_id = ?", (result_id,)).fetchall()
+        return {
+            "result_id": result_id,
+            "question": row[0],
+            "ans_format": row[1],
+            "pdf_files": json.loads(row[2]),
+            "papers": {pdf_file: {"answer": json.loads(answer), "context": json.loads(context) if context else None}
+                       for pdf_file, answer, context in papers},
+        }
+
+    def _expire_(self):
+        if self.ttl is None:
+            return
+        expired = [row[0] for row in self.conn.execute(
+            "SELECT result_id FROM results WHERE updated_at < ?", (time.time() - self.ttl,)).fetchall()]
+        for result_id in expired:
+            self.conn.execute("DELETE FROM result_papers WHERE result_id = ?", (result_id,))
+            self.conn.execute("DELETE FROM results WHERE result_id = ?", (result_id,))
+        if expired:
+            self.conn.commit()
@@ -0,0 +1,198 @@
+"""
+retriever_cache.py - Lazy, Memory-Budgeted Retriever Cache
+
+This module provides RetrieverCache, a dict-like container that maps PDF filenames to
+their retrievers. Retrievers are materialized on first access through a loader function
+and kept in an LRU order; when the estimated resident size exceeds the configured memory
+budget, the least recently used retrievers are evicted and reloaded on their next access.
+
+Main Components:
+- RetrieverCache: Thread-safe LRU cache of retrievers with hit/miss/latency statistics.
+- estimate_retriever_bytes: Rough in-memory size of a retriever (FAISS vectors + docstore).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def estimate_retriever_bytes(retriever) -> int:
+    """
+    Estimate the resident size of a MultiVectorRetriever.
+
+    Counts the float32 vectors of the FAISS index, the summary documents held by the
+    vectorstore and the parent chunks held in the docstore. Python object overhead is ignored.
+    """
+    size = 0
+    vectorstore = retriever.vectorstore
+    index = getattr(vectorstore, "index", None)
+    if index is not None:
+        size += index.ntotal * index.d * 4
+    inner_docstore = getattr(vectorstore, "docstore", None)
+    for doc in getattr(inner_docstore, "_dict", {}).values():
+        size += len(doc.page_content.encode("utf-8"))
+    for value in getattr(retriever.docstore, "store", {}).values():
+        if isinstance(value, str):
+            size += len(value.encode("utf-8"))
+        elif hasattr(value, "page_content"):
+            size += len(value.page_content.encode("utf-8"))
+    return size
+
+
+class RetrieverCache(object):
+    def __init__(self, loader, keys=None, memory_budget: int = None, size_fn=estimate_retriever_bytes, on_evict=None):
+        """
+        Args:
+            loader (callable): Function mapping a PDF filename to its retriever.
+                It should raise an exception if the PDF has no vectorstore.
+            keys (iterable, optional): PDF filenames known to be loadable.
+            memory_budget (int, optional): Maximum estimated resident bytes. None means unbounded.
+            size_fn (callable, optional): Function estimating the size of a retriever in bytes.
+            on_evict (callable, optional): Called with the PDF filename of every evicted retriever,
+                to release per-paper state kept elsewhere.
+        """
+        self.loader = loader
+        self.known_keys = set(keys or [])
+        self.memory_budget = memory_budget
+        self.size_fn = size_fn
+        self.on_evict = on_evict
+
+        self.entries = OrderedDict()  # pdf_file -> (retriever, size), least recently used first
+        self.loading = {}  # pdf_file -> lock held while the retriever is being loaded
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.total_load_time = 0.0
+        self.max_load_time = 0.0
+        self.resident_bytes = 0
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            key_lock = self.loading.setdefault(key, threading.Lock())
+
+        # load outside the global lock so that other papers can be served meanwhile
+        with key_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key][0]
+            time0 = time.time()
+            try:
+                retriever = self.loader(key)
+            except Exception as e:
+                with self.lock:
+                    self.loading.pop(key, None)
+                raise KeyError(f"Failed to load retriever for {key}: {e}")
+            load_time = time.time() - time0
+            size = self.size_fn(retriever)
+            with self.lock:
+                self.entries[key] = (retriever, size)
+                self.known_keys.add(key)
+                self.resident_bytes += size
+                self.loads += 1
+                self.total_load_time += load_time
+                self.max_load_time = max(self.max_load_time, load_time)
+                self.loading.pop(key, None)
+                evicted = self._evict_()
+        self._notify_evicted_(evicted)
+        return retriever
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.known_keys or key in self.entries
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return sorted(self.known_keys)
+
+    def preload(self, keys=None, workers: int = 1) -> dict:
+        """
+        Materialize the given retrievers (all known ones by default).
+
+        Args:
+            keys (iterable, optional): PDF filenames to load. Defaults to all known keys.
+            workers (int, optional): Number of threads loading retrievers concurrently.
+
+        Returns:
+            dict: {"loaded": int, "failed": list, "wall_time": float}
+        """
+        keys = list(keys if keys is not None else self.keys())
+        failed = []
+
+        def load(key):
+            try:
+                self[key]
+            except KeyError as e:
+                print(e)
+                failed.append(key)
+
+        time0 = time.time()
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(load, keys))
+        else:
+            for key in keys:
+                load(key)
+        return {"loaded": len(keys) - len(failed), "failed": failed, "wall_time": time.time() - time0}
+
+    def evict(self, key):
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                _, size = self.entries.pop(key)
+                self.resident_bytes -= size
+                self.evictions += 1
+                evicted.append(key)
+        self._notify_evicted_(evicted)
+
+    def _evict_(self):
+        # keep the most recently used retriever even if it alone exceeds the budget
+        evicted = []
+        if self.memory_budget is None:
+            return evicted
+        while self.resident_bytes > self.memory_budget and len(self.entries) > 1:
+            key, (_, size) = self.entries.popitem(last=False)
+            self.resident_bytes -= size
+            self.evictions += 1
+            evicted.append(key)
+        return evicted
+
+    def _notify_evicted_(self, keys):
+        # called without holding self.lock
+        if self.on_evict is None:
+            return
+        for key in keys:
+            self.on_evict(key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "known": len(self.known_keys),
+                "resident": len(self.entries),
+                "resident_bytes": self.resident_bytes,
+                "memory_budget": self.memory_budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else None,
+                "evictions": self.evictions,
+                "loads": self.loads,
+                "avg_load_time": self.total_load_time / self.loads if self.loads else None,
+                "max_load_time": self.max_load_time,
+                "total_load_time": self.total_load_time,
+            }
@@ -0,0 +1,95 @@
+"""
+scheduler.py - Shared Bounded-Concurrency Scheduler for Per-Paper RAG Work
+
+This module provides one fixed-size worker pool per process. All QA requests submit
+their per-paper work to it, so concurrent requests share `qa.max_workers` threads
+instead of each spawning its own pool.
+
+Main Components:
+- PaperScheduler: Continuous work queue that admits a request's next paper as soon as
+  one of its in-flight papers completes, with per-request in-flight limits and cancellation.
+- get_scheduler: Returns the process-wide PaperScheduler.
+"""
+
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+try:
+    import globalVariable as GV
+except:
+    import app.dataService.globalVariable as GV
+
+
+class PaperScheduler(object):
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-worker")
+
+    def imap_unordered(self, fn, items, max_in_flight: int = None, cancel_event = None):
+        """
+        Apply `fn` to every item on the shared pool and yield results in completion order.
+
+        At most `max_in_flight` items of this call are queued or running at a time; the next
+        item is admitted as soon as any of them completes, so one slow paper never holds back
+        the others. Keeping each request's share of the queue bounded also lets concurrent
+        requests interleave on the pool.
+
+        Args:
+            fn (callable): Function called with one item.
+            items (iterable): Items to process.
+            max_in_flight (int, optional): Per-call concurrency limit. Defaults to the pool size.
+            cancel_event (threading.Event, optional): When set, no further items are admitted
+                and queued items that have not started are cancelled.
+
+        Yields:
+            tuple: (item, result, exception), where exception is None on success.
+        """
+        items = iter(items)
+        limit = min(max_in_flight or self.max_workers, self.max_workers)
+        in_flight = {}
+
+        def cancelled():
+            return cancel_event is not None and cancel_event.is_set()
+
+        def admit():
+            while len(in_flight) < limit and not cancelled():
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                in_flight[self.executor.submit(fn, item)] = item
+
+        try:
+            admit()
+            while in_flight:
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight.pop(future)
+                    if future.cancelled():
+                        continue
+                    try:
+                        result, exc = future.result(), None
+                    except Exception as e:
+                        result, exc = None, e
+                    yield item, result, exc
+                    if cancelled():
+                        return
+                admit()
+        finally:
+            # cancellation or the consumer went away: drop our papers that have not started yet
+            for future in in_flight:
+                future.cancel()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> PaperScheduler:
+    """
+    Return the process-wide scheduler, sized by `qa.max_workers` in config.yml.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PaperScheduler(max(1, GV.qa_max_workers))
+        return _scheduler
@@ -10,8 +10,10 @@ from langchain_core.output_parsers import StrOutputParser
 
 try:
     import globalVariable as GV
+    import utils
 except:
     import app.dataService.globalVariable as GV
+    import app.dataService.utils as utils
 
 def summarize_docs(docs, openai_key=GV.azure_openai_key):
     """
@@ -28,20 +30,12 @@ def summarize_docs(docs, openai_key=GV.azure_openai_key):
         str: A coherent summary of all input documents.
 
     Process:
-    1. Initialize the language model (LLM) with specific parameters.
+    1. Get the shared language model (LLM) client with specific parameters.
     2. Define a chain to summarize individual documents (map step).
     3. Define a chain to collapse multiple summaries (reduce step).
     4. Apply the map-reduce process to generate the final summary.
     """
-    llm = AzureChatOpenAI(
-        model="gpt-3.5-turbo-0125",
-        temperature=0,
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_openai_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-        model_kwargs={"seed": 42},
-    )
+    llm = utils.get_chat_model(model="gpt-3.5-turbo-0125", seed=42)
 
     # Define prompt and method for converting Document to string
     document_prompt = PromptTemplate.from_template("{page_content}")
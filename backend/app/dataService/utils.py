@@ -30,6 +30,7 @@ Main Functions:
 - process_single_pdf_meta_information: Process meta information from a single PDF
 - build_local_document_vector_store: Build a vector store from documents
 - save_local_document_vector_store: Save a vector store to disk
+- load_local_document_vector_store: Load a saved vector store and docstore from disk
 - build_multivector_retriever: Create a multi-vector retriever
 - build_rag_chain: Construct a RAG chain for question answering
 
@@ -38,6 +39,7 @@ Main Functions:
 import ast
 import base64
 import csv
+import hashlib
 import io
 import json
 import os
@@ -45,14 +47,19 @@ import os.path
 import pickle
 import re
 import shutil
+import threading
+import time
 import uuid
 import zipfile
 from io import StringIO
 from operator import itemgetter
 from typing import List
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 
 # Third-party imports
+import numpy as np
+import httpx
 import pandas as pd
 import PyPDF2
 import requests
@@ -90,6 +97,12 @@ from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
 # Local imports
 try:
     import app.dataService.globalVariable as GV
+    from app.dataService.rate_limiter import (
+        RateLimitedAzureChatOpenAI,
+        RateLimitedAzureOpenAIEmbeddings,
+        call_with_rate_limit,
+        estimate_tokens,
+    )
     from app.dataService.globalVariable import (
         table_extract_prompt_template,
         table_structure_prompt_template,
@@ -99,6 +112,12 @@ try:
     )
 except ImportError:
     import globalVariable as GV
+    from rate_limiter import (
+        RateLimitedAzureChatOpenAI,
+        RateLimitedAzureOpenAIEmbeddings,
+        call_with_rate_limit,
+        estimate_tokens,
+    )
     from globalVariable import (
         table_extract_prompt_template,
         table_structure_prompt_template,
@@ -107,24 +126,26 @@ except ImportError:
         table_structure_prompt_templatev2
     )
     
-def summarize_texts(texts: List[str], model_name: str = "gpt-3.5-turbo-1106",
-                    max_workers: int = 5) -> list[dict[str, str]]:
-    prompt_text = """You are an assistant tasked with summarizing tables and text. \
+# Model and prompt of the chunk summaries that are embedded into the vectorstores; both are
+# part of the summary cache key (manifest.SummaryCache) and of the vectorstore stage fingerprint
+SUMMARY_MODEL = "gpt-3.5-turbo-1106"
+SUMMARY_PROMPT = """You are an assistant tasked with summarizing tables and text. \
     Give a concise summary of the table or text. Table or text chunk: {element} """
-    prompt = ChatPromptTemplate.from_template(prompt_text)
-    model = AzureChatOpenAI(
-        temperature=0,
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_openai_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-        model=model_name,
-    )
+
+def summarize_texts(texts: List[str], model_name: str = SUMMARY_MODEL,
+                    max_workers: int = 5, summary_cache=None) -> list[dict[str, str]]:
+    prompt = ChatPromptTemplate.from_template(SUMMARY_PROMPT)
+    model = get_chat_model(model=model_name)
     summarize_chain = {"element": lambda x: x} | prompt | model | StrOutputParser()
     
     results = []
     errors = []
 
+    # chunks summarized before (e.g. by an interrupted run) are not summarized again
+    cached = summary_cache.get_many(model_name, SUMMARY_PROMPT, texts) if summary_cache is not None else {}
+    results += [{"original": text, "summary": cached[text]} for text in texts if text in cached]
+    texts = [text for text in texts if text not in cached]
+
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_text = {executor.submit(summarize_single_text, text, summarize_chain): text for text in texts}
         
@@ -134,6 +155,8 @@ def summarize_texts(texts: List[str], model_name: str = "gpt-3.5-turbo-1106",
             results.append({"original": original_text, "summary": summary})
             if error:
                 errors.append(error)
+            elif summary_cache is not None:
+                summary_cache.put(model_name, SUMMARY_PROMPT, original_text, summary)
 
     if errors:
         print(f"Encountered {len(errors)} errors while summarizing texts.")
@@ -141,6 +164,8 @@ def summarize_texts(texts: List[str], model_name: str = "gpt-3.5-turbo-1106",
     return results
 
 def summarize_single_text(text: str, summarize_chain) -> tuple[str, str]:
+    # throttled and transient failures are retried by the rate limiter of the chat model,
+    # so a chunk is only dropped if the request itself is rejected
     try:
         summary = summarize_chain.invoke(text)
         return summary, None
@@ -149,6 +174,33 @@ def summarize_single_text(text: str, summarize_chain) -> tuple[str, str]:
         print(error_message)
         return "Summary unavailable due to processing error.", error_message
 
+def classify_chunk(chunk: str) -> dict:
+    """
+    Judge whether a chunk belongs to a table, a figure or plain text.
+
+    Returns:
+        dict: {"value": "table" | "figure" | "text", "content": table/figure name (e.g. "Table 2") or the text}
+    """
+    table_match = re.search(r"(Table \d+).*", chunk)
+    figure_match = re.search(r"(Figure \d+).*", chunk)
+    if table_match:
+        return {"value": "table", "content": table_match.group(1)}
+    elif figure_match:
+        return {"value": "figure", "content": figure_match.group(1)}
+    else:
+        return {"value": "text", "content": chunk}
+
+def chunk_metadata(chunk: str, doc_id: str, id_key: str = "doc_id") -> dict:
+    """
+    Metadata of a chunk's summary document: its doc id plus the ingest-time chunk type
+    ("chunk_type") and table/figure name ("chunk_name") used by context classification.
+    """
+    chunk_class = classify_chunk(chunk)
+    metadata = {id_key: doc_id, "chunk_type": chunk_class["value"]}
+    if chunk_class["value"] != "text":
+        metadata["chunk_name"] = chunk_class["content"]
+    return metadata
+
 def build_local_document_vector_store(texts: List[str]) -> tuple[FAISS, InMemoryStore]:
     id_key = "doc_id"
     
@@ -164,16 +216,11 @@ def build_local_document_vector_store(texts: List[str]) -> tuple[FAISS, InMemory
         if result["summary"] != "Summary unavailable due to processing error.":
             doc_id = str(uuid.uuid4())
             doc_ids.append(doc_id)
-            summary_texts.append(Document(page_content=result["summary"], metadata={id_key: doc_id}))
+            summary_texts.append(Document(page_content=result["summary"], metadata=chunk_metadata(result["original"], doc_id, id_key)))
             valid_texts.append(result["original"])
     
     # Create vectorstore
-    embedding_model = AzureOpenAIEmbeddings(
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_embedding_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-    )
+    embedding_model = get_embedding_model()
     vectorstore = FAISS.from_documents(summary_texts, embedding_model)
     
     # Create docstore
@@ -182,11 +229,12 @@ def build_local_document_vector_store(texts: List[str]) -> tuple[FAISS, InMemory
     
     return vectorstore, docstore
 
-def save_local_document_vector_store(texts: list[str], output_vectorstore_path: str, output_docstore_path: str, azure_openai_key: str):
+def save_local_document_vector_store(texts: list[str], output_vectorstore_path: str, output_docstore_path: str, azure_openai_key: str,
+                                     summary_cache=None):
     id_key = "doc_id"
     
     # Summarize the texts
-    summary_results = summarize_texts(texts)
+    summary_results = summarize_texts(texts, summary_cache=summary_cache)
     
     # Create documents, filtering out failed summaries
     doc_ids = []
@@ -197,16 +245,11 @@ def save_local_document_vector_store(texts: list[str], output_vectorstore_path:
         if result["summary"] != "Summary unavailable due to processing error.":
             doc_id = str(uuid.uuid4())
             doc_ids.append(doc_id)
-            summary_texts.append(Document(page_content=result["summary"], metadata={id_key: doc_id}))
+            summary_texts.append(Document(page_content=result["summary"], metadata=chunk_metadata(result["original"], doc_id, id_key)))
             valid_texts.append(result["original"])
 
     # Create vectorstore
-    embedding_model = AzureOpenAIEmbeddings(
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_embedding_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-    )
+    embedding_model = get_embedding_model()
     vectorstore = FAISS.from_documents(summary_texts, embedding_model)
     
     # Create docstore
@@ -216,8 +259,178 @@ def save_local_document_vector_store(texts: list[str], output_vectorstore_path:
     # Save the vectorstore and docstore to disk
     vectorstore.save_local(output_vectorstore_path)
 
-    with open(output_docstore_path, "wb") as f:
+    # written to a temporary file first, so an interrupted run never leaves a truncated docstore
+    with open(output_docstore_path + ".tmp", "wb") as f:
         pickle.dump(docstore, f)
+    os.replace(output_docstore_path + ".tmp", output_docstore_path)
+
+
+#####################################################################################
+# Shared HTTP clients, chat models, chains and embedding model
+_http_client = None
+_async_http_client = None
+_chat_models = {}
+_chains = {}
+_embedding_model = None
+_client_lock = threading.Lock()
+
+def get_http_client() -> httpx.Client:
+    """
+    Return the process-wide HTTP client shared by all Azure OpenAI clients.
+
+    Its keep-alive connection pool is sized by `llm.max_connections` in config.yml, so
+    concurrent requests reuse TLS connections instead of opening new ones per call.
+    """
+    global _http_client
+    with _client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=GV.llm_max_connections,
+                    max_keepalive_connections=GV.llm_max_connections,
+                ),
+                timeout=httpx.Timeout(GV.llm_request_timeout, connect=10.0),
+            )
+        return _http_client
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Return the process-wide async HTTP client used by ainvoke/aembed calls.
+
+    Its pool is sized for `qa.async_concurrency` in-flight papers; it must only be used
+    from the async engine loop (see async_engine.py).
+    """
+    global _async_http_client
+    with _client_lock:
+        if _async_http_client is None:
+            max_connections = max(GV.llm_max_connections, GV.qa_async_concurrency)
+            _async_http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                ),
+                timeout=httpx.Timeout(GV.llm_request_timeout, connect=10.0),
+            )
+        return _async_http_client
+
+def get_chat_model(model: str = None, temperature: float = 0, json_mode: bool = False,
+                   deployment: str = None, **kwargs) -> AzureChatOpenAI:
+    """
+    Return a shared AzureChatOpenAI client for the given deployment and model settings.
+
+    Clients are created once per process, reuse the shared HTTP connection pool and are
+    safe to use from several threads. Their requests are paced and retried by the rate
+    limiter of the deployment (see rate_limiter.py).
+
+    Args:
+        model (str, optional): Model name passed to AzureChatOpenAI.
+        temperature (float, optional): Sampling temperature. Defaults to 0.
+        json_mode (bool, optional): Request a JSON object response format. Defaults to False.
+        deployment (str, optional): Azure deployment. Defaults to GV.azure_openai_deployment.
+        **kwargs: Additional model_kwargs (e.g. seed).
+    """
+    deployment = deployment or GV.azure_openai_deployment
+    model_kwargs = dict(kwargs)
+    if json_mode:
+        model_kwargs["response_format"] = {"type": "json_object"}
+    key = (deployment, model, temperature, json.dumps(model_kwargs, sort_keys=True))
+    http_client = get_http_client()
+    http_async_client = get_async_http_client()
+    with _client_lock:
+        if key not in _chat_models:
+            params = {}
+            if model is not None:
+                params["model"] = model
+            if model_kwargs:
+                params["model_kwargs"] = model_kwargs
+            if GV.rate_limit_enabled:
+                # retries are done by the rate limiter, which also adapts the concurrency
+                params["max_retries"] = 0
+            _chat_models[key] = RateLimitedAzureChatOpenAI(
+                temperature=temperature,
+                azure_endpoint=GV.azure_openai_endpoint,
+                azure_deployment=deployment,
+                api_version=GV.azure_openai_version,
+                api_key=GV.azure_openai_key,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                **params,
+            )
+        return _chat_models[key]
+
+def get_cached_chain(name: str, build_chain):
+    """
+    Return the chain registered under `name`, building it with `build_chain()` on first use.
+    """
+    with _client_lock:
+        if name not in _chains:
+            _chains[name] = build_chain()
+        return _chains[name]
+
+def get_embedding_model() -> AzureOpenAIEmbeddings:
+    """
+    Return the process-wide embedding client, creating it on first use.
+
+    The client is thread-safe and is shared by every loaded vectorstore. Its requests
+    are paced and retried by the rate limiter of the embedding deployment.
+    """
+    global _embedding_model
+    http_client = get_http_client()
+    http_async_client = get_async_http_client()
+    with _client_lock:
+        if _embedding_model is None:
+            params = {"max_retries": 0} if GV.rate_limit_enabled else {}
+            _embedding_model = RateLimitedAzureOpenAIEmbeddings(
+                azure_endpoint=GV.azure_openai_endpoint,
+                azure_deployment=GV.azure_embedding_deployment,
+                api_version=GV.azure_openai_version,
+                api_key=GV.azure_openai_key,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                **params,
+            )
+        return _embedding_model
+
+def load_local_document_vector_store(vectorstore_path: str, docstore_path: str, embedding_model=None,
+                                     io_semaphore=None) -> tuple[FAISS, InMemoryStore, dict]:
+    """
+    Load a vectorstore and docstore saved by save_local_document_vector_store.
+
+    File reads happen while holding `io_semaphore` (if given) to bound disk concurrency,
+    deserialization happens outside of it.
+
+    Returns:
+        tuple: (vectorstore, docstore, timings) where timings holds the seconds spent in
+            "io_read", "index_deserialize" and "docstore_deserialize".
+    """
+    import faiss
+
+    if embedding_model is None:
+        embedding_model = get_embedding_model()
+    timings = {}
+
+    time0 = time.time()
+    with io_semaphore if io_semaphore is not None else nullcontext():
+        with open(os.path.join(vectorstore_path, "index.faiss"), "rb") as f:
+            index_bytes = f.read()
+        with open(os.path.join(vectorstore_path, "index.pkl"), "rb") as f:
+            index_meta_bytes = f.read()
+        with open(docstore_path, "rb") as f:
+            docstore_bytes = f.read()
+    timings["io_read"] = time.time() - time0
+
+    time0 = time.time()
+    index = faiss.deserialize_index(np.frombuffer(index_bytes, dtype=np.uint8))
+    summary_docstore, index_to_docstore_id = pickle.loads(index_meta_bytes)
+    vectorstore = FAISS(embedding_model, index, summary_docstore, index_to_docstore_id)
+    timings["index_deserialize"] = time.time() - time0
+
+    time0 = time.time()
+    docstore = pickle.loads(docstore_bytes)
+    timings["docstore_deserialize"] = time.time() - time0
+
+    return vectorstore, docstore, timings
+
 def build_multivector_retriever(vectorstore, docstore, id_key="doc_id"):
     retriever = MultiVectorRetriever(
         vectorstore=vectorstore,
@@ -226,6 +439,122 @@ def build_multivector_retriever(vectorstore, docstore, id_key="doc_id"):
     )
     return retriever
 
+def collect_parent_documents(docstore, doc_ids: list) -> list:
+    """
+    Map summary doc ids to their parent chunks, the same way MultiVectorRetriever does:
+    ids are deduplicated in order and missing parents are dropped.
+    """
+    unique_ids = []
+    for doc_id in doc_ids:
+        if doc_id not in unique_ids:
+            unique_ids.append(doc_id)
+    return [doc for doc in docstore.mget(unique_ids) if doc is not None]
+
+def relevance_from_score(vectorstore, score: float) -> float:
+    """
+    Convert a FAISS search score into a cosine-style relevance (1 = identical, 0 = unrelated).
+
+    The default index returns squared L2 distances; for the unit-length Azure OpenAI
+    embeddings these map to cosine similarity as 1 - d / 2. Inner-product indexes
+    already return the similarity.
+    """
+    strategy = getattr(vectorstore, "distance_strategy", None)
+    if strategy is not None and getattr(strategy, "value", strategy) in ("MAX_INNER_PRODUCT", "DOT_PRODUCT"):
+        return float(score)
+    return 1.0 - float(score) / 2.0
+
+def _scored_parents_(retriever, scored_docs: list, return_relevance: bool):
+    doc_ids = [d.metadata[retriever.id_key] for d, _ in scored_docs if retriever.id_key in d.metadata]
+    parents = collect_parent_documents(retriever.docstore, doc_ids)
+    if not return_relevance:
+        return parents
+    relevance = max((relevance_from_score(retriever.vectorstore, score) for _, score in scored_docs), default=None)
+    return parents, relevance
+
+def retrieve_by_vector(retriever, query_vector, k: int = None, return_relevance: bool = False):
+    """
+    Run a MultiVectorRetriever with an already computed question embedding.
+
+    Equivalent to retriever.invoke(question) for similarity search, but skips the
+    embedding call so one question vector can be reused across all papers.
+
+    Args:
+        retriever (MultiVectorRetriever): The paper's retriever.
+        query_vector (list): Embedding of the question.
+        k (int, optional): Number of summary vectors to search. Defaults to the retriever's setting (4).
+        return_relevance (bool, optional): Also return the relevance of the best summary
+            (see relevance_from_score). Defaults to False.
+
+    Returns:
+        list: Parent chunks of the nearest summaries, or (parent chunks, relevance) with
+            `return_relevance` (relevance is None if the paper has no summaries).
+    """
+    if k is None:
+        k = retriever.search_kwargs.get("k", 4)
+    scored_docs = retriever.vectorstore.similarity_search_with_score_by_vector(query_vector, k=k)
+    return _scored_parents_(retriever, scored_docs, return_relevance)
+
+async def aretrieve_by_vector(retriever, query_vector, k: int = None, return_relevance: bool = False):
+    """
+    Async variant of retrieve_by_vector.
+    """
+    if k is None:
+        k = retriever.search_kwargs.get("k", 4)
+    scored_docs = await retriever.vectorstore.asimilarity_search_with_score_by_vector(query_vector, k=k)
+    return _scored_parents_(retriever, scored_docs, return_relevance)
+
+def retrieve_with_relevance(retriever, question: str, k: int = None) -> tuple:
+    """
+    Run a MultiVectorRetriever on the question text and return (parent chunks, relevance),
+    as retrieve_by_vector with `return_relevance`.
+    """
+    if k is None:
+        k = retriever.search_kwargs.get("k", 4)
+    scored_docs = retriever.vectorstore.similarity_search_with_score(question, k=k)
+    return _scored_parents_(retriever, scored_docs, True)
+
+async def aretrieve_with_relevance(retriever, question: str, k: int = None) -> tuple:
+    if k is None:
+        k = retriever.search_kwargs.get("k", 4)
+    scored_docs = await retriever.vectorstore.asimilarity_search_with_score(question, k=k)
+    return _scored_parents_(retriever, scored_docs, True)
+
+def empty_answer(structure):
+    """
+    Fill an answer structure (the value under "answer_structure") with "Empty" values,
+    the answer the RAG prompt asks for when a paper has no relevant information.
+    """
+    if isinstance(structure, dict):
+        return {key: empty_answer(value) for key, value in structure.items()}
+    if isinstance(structure, list):
+        return [empty_answer(item) for item in structure]
+    return "Empty"
+
+
+_content_hashes = {}
+_content_hashes_lock = threading.Lock()
+
+def file_content_hash(path: str):
+    """
+    SHA-256 of a file's content, or None if the file does not exist.
+
+    Hashes are memoized by (path, size, mtime), so a file is only re-read after it changes.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _content_hashes_lock:
+        if memo_key in _content_hashes:
+            return _content_hashes[memo_key]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    with _content_hashes_lock:
+        _content_hashes[memo_key] = digest.hexdigest()
+    return _content_hashes[memo_key]
 
 def cut_string_to_token_length(string: str, encoding_name: str = "cl100k_base", max_token_length: int = 16000) -> str:
     # Cuts a string to fit within a specified token length.
@@ -241,7 +570,12 @@ def cut_string_to_token_length(string: str, encoding_name: str = "cl100k_base",
     else:
         return string
 
-def build_rag_chain(retriever):
+# Model answering per-paper RAG questions. Bump RAG_PROMPT_VERSION whenever the RAG prompt
+# or the context classification changes, so cached answers (answer_cache.py) are not reused.
+RAG_ANSWER_MODEL = "gpt-4o"
+RAG_PROMPT_VERSION = 2
+
+def build_rag_chain(retriever=None):
     """
     Build a Retrieval-Augmented Generation (RAG) chain using the provided retriever.
 
@@ -249,7 +583,8 @@ def build_rag_chain(retriever):
     then generates an answer based on the retrieved context and the input question.
 
     Args:
-        retriever: The retriever object used to fetch relevant context.
+        retriever: The retriever object used to fetch relevant context. If None, the chain
+            expects the already retrieved context under the "context" input key.
 
     Returns:
         RunnableParallel: A chain that processes input questions and returns both the context and the generated answer.
@@ -265,21 +600,20 @@ def build_rag_chain(retriever):
     Question: {question}
     """
     prompt = ChatPromptTemplate.from_template(template)
-    model = AzureChatOpenAI(
-        temperature=0,
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_openai_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-        model="gpt-4o",
-        model_kwargs={"response_format": {"type": "json_object"}},
-    )
-    retreival_chain = (
-        {
+    model = get_chat_model(model=RAG_ANSWER_MODEL, json_mode=True)
+    if retriever is None:
+        retreival_chain = {
             "question": itemgetter("question"),
-            "ans_format": itemgetter("ans_format")
-        } | RunnablePassthrough.assign(context=(itemgetter("question") | retriever) )
-    )
+            "ans_format": itemgetter("ans_format"),
+            "context": itemgetter("context")
+        } | RunnablePassthrough()
+    else:
+        retreival_chain = (
+            {
+                "question": itemgetter("question"),
+                "ans_format": itemgetter("ans_format")
+            } | RunnablePassthrough.assign(context=(itemgetter("question") | retriever) )
+        )
 
     # Building the main answer chain
     chain_with_sources = retreival_chain | RunnableParallel({
@@ -288,6 +622,41 @@ def build_rag_chain(retriever):
     })
     return chain_with_sources
 
+def get_rag_chain():
+    """
+    Return the prebuilt RAG chain that takes already retrieved context (see build_rag_chain).
+
+    The chain holds no per-paper state, so one instance is shared by all papers and threads.
+    """
+    return get_cached_chain("rag_answer", build_rag_chain)
+
+def build_rag_extension_chain():
+    """
+    Build the chain that fills new columns into rows already extracted from a paper.
+
+    Expects "question", "rows" (the existing answer rows, JSON), "ans_format" (the new columns
+    only) and "context" (the paper's context chunks) and returns the JSON answer string.
+    """
+    template = """Answer the question based only on the following context, which can include text and tables.
+    The rows below were already extracted from this paper for the question: {rows}
+
+    Fill in ONLY the new fields described by this JSON structure: {ans_format}
+    Return JSON with the key "answer_structure" holding a list with exactly one object per row above,
+    in the same order, each containing only the new fields.
+
+    Values of exceptions in JSON should be "Empty".
+
+    Context: {context}
+
+    Question: {question}
+    """
+    prompt = ChatPromptTemplate.from_template(template)
+    model = get_chat_model(model=RAG_ANSWER_MODEL, json_mode=True)
+    return prompt | model | StrOutputParser()
+
+def get_rag_extension_chain():
+    return get_cached_chain("rag_extension", build_rag_extension_chain)
+
 #####################################################################################
 # functional function encapsulation
 import re
@@ -750,9 +1119,16 @@ def describe_figure(image_path, caption, model, api_key):
 
     url = f"{GV.azure_openai_endpoint}/openai/deployments/{GV.azure_openai_deployment}/chat/completions?api-version={GV.azure_openai_version}"
 
-    response = requests.post(url, headers=headers, json=payload)
+    def post():
+        response = requests.post(url, headers=headers, json=payload)
+        response.raise_for_status()
+        return response.json()
 
-    return response.json()["choices"][0]["message"]["content"]
+    # prompt text, the image (765 tokens for 1024x1024 at high detail) and the completion
+    tokens = estimate_tokens(payload["messages"][0]["content"][0]["text"]) + 765 + payload["max_tokens"]
+    result = call_with_rate_limit(GV.azure_openai_deployment, post, tokens,
+                                  lambda r: r.get("usage", {}).get("total_tokens"))
+    return result["choices"][0]["message"]["content"]
 
 def process_figures(pdf_fold, figure_fold, model, openai_api_key):
     """
@@ -803,17 +1179,22 @@ def process_single_pdf_figure(pdf_path, figure_fold, model, openai_api_key):
         figure_fold (str): Path to the folder where the figure JSON file will be saved.
         model (str): Name of the LLM model to use for figure description, such as "gpt-4o", "gpt-4-turbo"
         openai_api_key (str): Azure OpenAI API key for LLM access.
+
+    Returns:
+        bool: False if the figures could not be extracted and an empty list was saved instead.
     """
     print("Processing single PDF for figure extraction")
     if os.path.basename(pdf_path)[-3:] != 'pdf':
         raise Exception("Invalid PDF file")
         return
     pdf_name = os.path.basename(pdf_path).split(".")[0]
+    extracted = True
     try:
         figure_example = extract_pdf_figure(pdf_path)
     except Exception as e:
         print(f"Error processing PDF file {pdf_path}: {str(e)}")
         figure_example = []
+        extracted = False
     for i in range(0, len(figure_example)):
         if "figure_url" not in figure_example[i] or "figure_caption" not in figure_example[i]:
             continue
@@ -825,6 +1206,7 @@ def process_single_pdf_figure(pdf_path, figure_fold, model, openai_api_key):
         figure_example[i]["figure_content"] = response
     with open(os.path.join(figure_fold, pdf_name + ".json"), "w") as f:
         json.dump(figure_example, f)
+    return extracted
 #####################################################################################
 # Table special functions
 def parse_table_content(table_content):
@@ -881,24 +1263,9 @@ def normalize_table_name(figure_name):
 
 def extract_pdf_table_llm_new(pdf_path, model_name):
     # table structure model
-    structure_model = AzureChatOpenAI(
-        model=model_name,
-        temperature=0,
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_openai_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-        model_kwargs={"response_format": {"type": "json_object"}},
-    )
+    structure_model = get_chat_model(model=model_name, json_mode=True)
     # general model
-    model = AzureChatOpenAI(
-        model=model_name,
-        temperature=0,
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_openai_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-    )
+    model = get_chat_model(model=model_name)
     table_extract_prompt = PromptTemplate(
         template = table_extract_prompt_template,
         input_variables=["page_content"]
@@ -1122,11 +1489,15 @@ def process_single_pdf_table(pdf_path, table_folder, model):
         pdf_path (str): Path to the PDF file.
         table_folder (str): Path to the folder where the table JSON file will be saved.
         model (str): Name of the LLM model to use for table extraction, such as "gpt-4o", "gpt-4-turbo"
+
+    Returns:
+        bool: False if the tables could not be extracted and an empty list was saved instead.
     """
     if os.path.basename(pdf_path)[-3:] != 'pdf':
         raise Exception("Invalid PDF file")
     print("Processing single PDF for table extraction")
     pdf_name = os.path.basename(pdf_path).split(".")[0]
+    extracted = True
     try:
         if model == "none":
             table_example = extract_pdf_table_adobe(pdf_path)
@@ -1135,22 +1506,19 @@ def process_single_pdf_table(pdf_path, table_folder, model):
     except Exception as e:
         print(f"Error processing tables in PDF file {pdf_path}: {str(e)}")
         table_example = []
+        extracted = False
     with open(os.path.join(table_folder, pdf_name + ".json"), "w") as f:
         json.dump(table_example, f)
+    return extracted
 
 #####################################################################################
 # meta-information special functions
+META_INFO_MODEL = "gpt-3.5-turbo-1106"
+
 def extract_pdf_meta_information(pdf_path):
     # # ---use pdfminer---
     # print(pdf_path)
-    model = AzureChatOpenAI(
-        model_name="gpt-3.5-turbo-1106",
-        temperature=0,
-        azure_endpoint=GV.azure_openai_endpoint,
-        azure_deployment=GV.azure_openai_deployment,
-        api_version=GV.azure_openai_version,
-        api_key=GV.azure_openai_key,
-    )
+    model = get_chat_model(model=META_INFO_MODEL)
     paper_content = read_pdf(pdf_path, 2)
     # print("Start metainformation extraction")
     # print(paper_content)
@@ -32,11 +32,11 @@ from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 # from langchain_community.embeddings import OpenAIEmbeddings
 
 # Local application imports
-from app.dataService.llm_eval import llm_evaluate_deepeval
 from app.dataService.utils import (
     extract_pdf_figure,
     extract_pdf_meta_information,
 )
+import app.dataService.rate_limiter as rate_limiter
 import app.dataService.summarize as summ
 import base64
 
@@ -137,13 +137,134 @@ def qa():
     data = request.json
     question = data["question"]
     filenames = [filename["name"] for filename in data["filenames"]]
-    summary, ans = current_app.dataService.run_rag_qa(filenames, question, batch_size = 75)
+    # answer structure returned by a previous response, skips designing it again
+    ans_format = data.get("ans_format")
+    # with evaluation.mode "background", answers carry an eval_id whose scores are fetched from /evaluations
+    evaluation_metrics = data.get("evaluation_metrics")
+    stream = data.get("stream", False)
+    if stream:
+        # stream the answer structure, each paper's result and the summary as they become available
+        events = current_app.dataService.stream_rag_qa(filenames, question, batch_size = current_app.dataService.GV.qa_request_concurrency,
+                                                       evaluation_metrics = evaluation_metrics, ans_format = ans_format)
+        if stream == "sse":
+            def generate():
+                for event in events:
+                    yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            mimetype = "text/event-stream"
+        else:
+            def generate():
+                for event in events:
+                    yield json.dumps(event) + "\n"
+            mimetype = "application/x-ndjson"
+        return Response(stream_with_context(generate()), mimetype=mimetype,
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    summary, ans, metadata = current_app.dataService.run_rag_qa(filenames, question, batch_size = current_app.dataService.GV.qa_request_concurrency,
+                                                                evaluation_metrics = evaluation_metrics,
+                                                                return_metadata = True, ans_format = ans_format)
 
     return jsonify({
         "summary": summary,
-        "answer": ans
+        "answer": ans,
+        "ans_format": metadata.pop("ans_format"),
+        "metadata": metadata
+    })
+
+@api.route('/qa/extend', methods=["POST"])
+def extend_qa():
+    data = request.json
+    columns = data["columns"]
+    if isinstance(columns, list):
+        # [{"name": ..., "description": ...}]
+        columns = {column["name"]: column.get("description", column["name"]) for column in columns}
+    extended = current_app.dataService.extend_rag_qa(data["result_id"], columns,
+                                                     batch_size = current_app.dataService.GV.qa_request_concurrency)
+    if extended is None:
+        return {"message": f"Unknown result {data['result_id']}"}, 404
+    ans, ans_format, metadata = extended
+
+    return jsonify({
+        "answer": ans,
+        "ans_format": ans_format,
+        "metadata": metadata
     })
 
+@api.route('/qa_multi', methods=["POST"])
+def qa_multi():
+    data = request.json
+    questions = data["questions"]
+    filenames = [filename["name"] for filename in data["filenames"]]
+    # one retrieval and one answer call per paper for all questions
+    results, metadata = current_app.dataService.run_multi_rag_qa(filenames, questions, batch_size = current_app.dataService.GV.qa_request_concurrency,
+                                                                 evaluation_metrics = data.get("evaluation_metrics"),
+                                                                 ans_formats = data.get("ans_formats"))
+
+    return jsonify({
+        "results": results,
+        "metadata": metadata
+    })
+
+@api.route('/qa/jobs', methods=["POST"])
+def submit_qa_job():
+    data = request.json
+    question = data["question"]
+    filenames = [filename["name"] for filename in data["filenames"]]
+    job = current_app.dataService.jobs.submit(filenames, question, batch_size = current_app.dataService.GV.qa_request_concurrency,
+                                              evaluation_metrics = data.get("evaluation_metrics"),
+                                              ans_format = data.get("ans_format"))
+    return jsonify(job.to_dict()), 202
+
+@api.route('/qa/jobs/<job_id>', methods=["GET"])
+def get_qa_job(job_id):
+    job = current_app.dataService.jobs.get(job_id)
+    if job is None:
+        return {"message": f"Unknown job {job_id}"}, 404
+    return jsonify(job.to_dict())
+
+@api.route('/qa/jobs/<job_id>/results', methods=["GET"])
+def get_qa_job_results(job_id):
+    job = current_app.dataService.jobs.get(job_id)
+    if job is None:
+        return {"message": f"Unknown job {job_id}"}, 404
+    since = request.args.get("since", default=0, type=int)
+    return jsonify(job.partial_results(since))
+
+@api.route('/qa/jobs/<job_id>/cancel', methods=["POST"])
+def cancel_qa_job(job_id):
+    job = current_app.dataService.jobs.cancel(job_id)
+    if job is None:
+        return {"message": f"Unknown job {job_id}"}, 404
+    return jsonify(job.to_dict())
+
+@api.route('/evaluations', methods=["POST"])
+def get_evaluations():
+    data = request.json
+    evaluations = current_app.dataService.evaluations
+    return jsonify({eval_id: evaluations.status(eval_id) for eval_id in data["eval_ids"]})
+
+@api.route('/evaluations/stream', methods=["POST"])
+def stream_evaluations():
+    data = request.json
+    # one NDJSON line per evaluation as soon as it is scored; still pending ones when the timeout expires
+    statuses = current_app.dataService.evaluations.wait(data["eval_ids"], timeout = data.get("timeout", 300))
+    def generate():
+        for status in statuses:
+            yield json.dumps(status) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api.route('/stats/evaluations', methods=["GET"])
+def get_evaluation_stats():
+    return jsonify(current_app.dataService.evaluations.stats())
+
+@api.route('/stats/retrievers', methods=["GET"])
+def get_retriever_stats():
+    return jsonify(current_app.dataService.get_retriever_stats())
+
+@api.route('/stats/rate_limits', methods=["GET"])
+def get_rate_limit_stats():
+    return jsonify(rate_limiter.get_rate_limit_stats())
+
 @api.route('/summarize', methods=["POST"])
 def summarize():
     data = request.json
@@ -162,7 +283,22 @@ def get_eval_scores():
     data = request.json
     question = data['question']
     answer = str(data['answer'])
-    return json.dumps(llm_evaluate_deepeval(metric=['answer_relevancy'], question=question, answer=answer, contexts=""))
+    # "llm" (deepeval judge) or "embedding" (fast cosine-similarity proxy)
+    mode = data.get('mode', current_app.dataService.GV.evaluation_scoring_mode)
+    return json.dumps(current_app.dataService.evaluations.evaluate(['answer_relevancy'], question, answer, "", mode=mode))
+
+@api.route('/get_confidence_scores_batch', methods=['POST'])
+def get_eval_scores_batch():
+    data = request.json
+    # [{"question": ..., "answer": ...}]; identical pairs are scored once
+    cases = [(pair['question'], str(pair['answer']), "") for pair in data['pairs']]
+    statuses = current_app.dataService.evaluations.evaluate_many(
+        ['answer_relevancy'], cases, max_parallel = current_app.dataService.GV.evaluation_max_parallel_batches,
+        mode = data.get('mode', current_app.dataService.GV.evaluation_scoring_mode))
+    return jsonify({
+        "scores": [status["scores"] for status in statuses],
+        "errors": {index: status["error"] for index, status in enumerate(statuses) if status["status"] != "done"}
+    })
 
 if __name__ == '__main__':
     pass